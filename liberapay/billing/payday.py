@@ -18,6 +18,7 @@ from liberapay.billing.transactions import transfer
 from liberapay.exceptions import NegativeBalance
 from liberapay.models.participant import Participant
 from liberapay.utils import NS, group_by
+from liberapay.utils.history import take_balance_snapshots
 from liberapay.website import website
 
 
@@ -80,6 +81,8 @@ class Payday(object):
         self.shuffle(log_dir)
 
         self.end()
+        self.update_receipts(self.id)
+        self.take_balance_snapshots()
 
         self.recompute_stats(limit=recompute_stats)
         if update_cached_amounts:
@@ -176,10 +179,17 @@ class Payday(object):
 
         CREATE TEMPORARY TABLE payday_tips ON COMMIT DROP AS
             SELECT t.id, tipper, tippee, amount, (p2.kind = 'group') AS to_team
-              FROM ( SELECT DISTINCT ON (tipper, tippee) *
-                       FROM tips
+              FROM ( SELECT *
+                       FROM current_tips
                       WHERE mtime < %(ts_start)s
-                   ORDER BY tipper, tippee, mtime DESC
+                      UNION ALL
+                     ( SELECT DISTINCT ON (t.tipper, t.tippee) t.*
+                         FROM current_tips c
+                         JOIN tips t ON t.tipper = c.tipper AND t.tippee = c.tippee
+                        WHERE c.mtime >= %(ts_start)s
+                          AND t.mtime < %(ts_start)s
+                     ORDER BY t.tipper, t.tippee, t.mtime DESC
+                     )
                    ) t
               JOIN payday_participants p ON p.id = t.tipper
               JOIN payday_participants p2 ON p2.id = t.tippee
@@ -644,6 +654,58 @@ class Payday(object):
         """, locals())
         log("Updated stats of payday #%i." % payday_id)
 
+    @classmethod
+    def update_receipts(cls, payday_id):
+        """Store how much each participant received during a payday.
+
+        The transfers are attributed to the first payday that ended after
+        them, so the out-of-band transfers are included in the next payday.
+        """
+        ts_end = cls.db.one("SELECT ts_end FROM paydays WHERE id = %s", (payday_id,))
+        previous_ts_end = cls.db.one("""
+            SELECT ts_end
+              FROM paydays
+             WHERE id < %s
+          ORDER BY id DESC
+             LIMIT 1
+        """, (payday_id,), default='-infinity')
+        cls.db.run("""
+            DELETE FROM payday_receipts WHERE payday = %(payday_id)s;
+
+            INSERT INTO payday_receipts
+                        (payday, participant, npatrons, receipts)
+                 SELECT %(payday_id)s, x.participant, count(DISTINCT x.tipper), sum(x.amount)
+                   FROM ( SELECT t.tippee AS participant, t.tipper, t.amount
+                            FROM transfers t
+                            JOIN participants p ON p.id = t.tippee
+                           WHERE t.timestamp >= %(previous_ts_end)s::timestamptz
+                             AND t.timestamp < %(ts_end)s
+                             AND t.status = 'succeeded'
+                             AND p.kind <> 'group'
+                           UNION ALL
+                          SELECT t.team AS participant, t.tipper, t.amount
+                            FROM transfers t
+                            JOIN participants p ON p.id = t.team
+                           WHERE t.timestamp >= %(previous_ts_end)s::timestamptz
+                             AND t.timestamp < %(ts_end)s
+                             AND t.status = 'succeeded'
+                             AND p.kind = 'group'
+                        ) x
+               GROUP BY x.participant;
+        """, locals())
+        log("Updated receipts of payday #%i." % payday_id)
+
+    @classmethod
+    def recompute_receipts(cls):
+        ids = cls.db.all("""
+            SELECT id
+              FROM paydays
+             WHERE ts_end > ts_start
+          ORDER BY id ASC
+        """)
+        for payday_id in ids:
+            cls.update_receipts(payday_id)
+
     @classmethod
     def recompute_stats(cls, limit=None):
         ids = cls.db.all("""
@@ -760,6 +822,10 @@ class Payday(object):
          RETURNING ts_end AT TIME ZONE 'UTC'
         """, default=NoPayday).replace(tzinfo=pando.utils.utc)
 
+    def take_balance_snapshots(self):
+        take_balance_snapshots(self.db)
+        log("Took the monthly balance snapshots.")
+
     def notify_participants(self):
         previous_ts_end = self.db.one("""
             SELECT ts_end
@@ -946,5 +1012,15 @@ def main(override_payday_checks=False):
         conn.close()
 
 
+def backfill_receipts():  # pragma: no cover
+    from liberapay.main import website
+    from liberapay.billing.payday import Payday
+    Payday.recompute_receipts()
+    website.db.self_check()
+
+
 if __name__ == '__main__':  # pragma: no cover
-    main()
+    if sys.argv[1:] == ['backfill-receipts']:
+        backfill_receipts()
+    else:
+        main()
@@ -2,7 +2,12 @@
 """
 from __future__ import division, print_function, unicode_literals
 
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from decimal import Decimal
+import logging
+from time import mktime
 
 from mangopay.exceptions import APIError
 from mangopay.resources import (
@@ -21,12 +26,14 @@ from liberapay.exceptions import (
     FeeExceedsAmount, TransactionFeeTooHigh, TransferError,
     AccountSuspended, Redirect,
 )
-from liberapay.models import check_db
 from liberapay.models.participant import Participant
 from liberapay.models.exchange_route import ExchangeRoute
 from liberapay.utils import group_by, NS
 
 
+logger = logging.getLogger(__name__)
+
+
 Money.__eq__ = lambda a, b: isinstance(b, Money) and a.__dict__ == b.__dict__
 Money.__repr__ = lambda m: '<Money Amount=%(amount)r Currency=%(currency)r>' % m.__dict__
 
@@ -85,6 +92,10 @@ def payout(db, route, amount, ignore_high_fee=False):
     if payday:
         raise PaydayIsRunning
 
+    withdrawable = participant.withdrawable_balance
+    if amount > withdrawable:
+        raise NotEnoughWithdrawableMoney(Money(withdrawable, 'EUR'))
+
     ba = BankAccount.get(route.address, user_id=participant.mangopay_user_id)
 
     # Do final calculations
@@ -359,6 +370,15 @@ def record_exchange_result(db, exchange_id, remote_id, status, error, participan
             amount = amount - min(e.fee, 0) if status == 'succeeded' else 0
         propagate_exchange(cursor, participant, e, error, amount)
 
+        if amount:
+            # Correct the balance snapshots taken since the exchange was initiated
+            cursor.run("""
+                UPDATE balances_at
+                   SET balance = balance + %s
+                 WHERE participant = %s
+                   AND at > %s
+            """, (amount, participant.id, e.timestamp))
+
         return e
 
 
@@ -377,8 +397,14 @@ def propagate_exchange(cursor, participant, exchange, error, amount):
 
     wallet_id = participant.mangopay_wallet_id
     if amount < 0:
-        bundles = cursor.all("""
+        withdrawable = cursor.one("""
             LOCK TABLE cash_bundles IN EXCLUSIVE MODE;
+            SELECT get_withdrawable_balance(%s, %s);
+        """, (participant.id, QUARANTINE))
+        x = -amount
+        if x > withdrawable:
+            raise NotEnoughWithdrawableMoney(Money(withdrawable, 'EUR'))
+        bundles = cursor.all("""
             SELECT b.*
               FROM cash_bundles b
               JOIN exchanges e ON e.id = b.origin
@@ -388,10 +414,6 @@ def propagate_exchange(cursor, participant, exchange, error, amount):
                AND b.locked_for IS NULL
           ORDER BY b.owner = e.participant DESC, b.ts
         """, (participant.id, QUARANTINE))
-        withdrawable = sum(b.amount for b in bundles)
-        x = -amount
-        if x > withdrawable:
-            raise NotEnoughWithdrawableMoney(Money(withdrawable, 'EUR'))
         for b in bundles:
             if x >= b.amount:
                 cursor.run("""
@@ -479,45 +501,80 @@ def prepare_transfer(db, tipper, tippee, amount, context, wallet_from, wallet_to
 
 
 def lock_bundles(cursor, transfer, bundles=None, prefer_bundles_from=-1):
+    """Lock enough of the tipper's cash bundles to cover the transfer.
+
+    The bundles are sorted and a running sum picks the shortest prefix that
+    covers the amount. That prefix is locked in a single statement. If the last
+    bundle is bigger than what's needed, it's split and only the needed part
+    is locked.
+    """
     assert transfer.status == 'pre'
     cursor.run("LOCK TABLE cash_bundles IN EXCLUSIVE MODE")
-    tipper, tippee = transfer.tipper, transfer.tippee
-    bundles = bundles or cursor.all("""
-        SELECT b.*
-          FROM cash_bundles b
-          JOIN exchanges e ON e.id = b.origin
-         WHERE b.owner = %(tipper)s
+    if bundles:
+        condition = "b.id = ANY(%(bundle_ids)s)"
+        order_by = "array_position(%(bundle_ids)s::bigint[], b.id)"
+        bundle_ids = [b.id for b in bundles]
+    else:
+        condition = """
+               b.owner = %(tipper)s
            AND b.withdrawal IS NULL
            AND b.locked_for IS NULL
-      ORDER BY b.origin = %(prefer_bundles_from)s DESC
+        """
+        order_by = """
+               b.origin = %(prefer_bundles_from)s DESC
              , e.participant = %(tippee)s DESC
              , b.ts
-    """, locals())
-    transferable = sum(b.amount for b in bundles)
-    x = transfer.amount
-    if x > transferable:
+             , b.id
+        """
+        bundle_ids = None
+    r = cursor.one("""
+        WITH candidates AS (
+                 SELECT b.id, b.amount
+                      , sum(b.amount) OVER (ORDER BY {1} ROWS UNBOUNDED PRECEDING) AS running_sum
+                   FROM cash_bundles b
+                   JOIN exchanges e ON e.id = b.origin
+                  WHERE {0}
+             ),
+             selected AS (
+                 SELECT c.*
+                   FROM candidates c
+                  WHERE c.running_sum - c.amount < %(amount)s
+                    AND (SELECT sum(amount) FROM candidates) >= %(amount)s
+             ),
+             locked AS (
+                 UPDATE cash_bundles b
+                    SET locked_for = (CASE
+                            WHEN s.running_sum <= %(amount)s THEN %(t_id)s
+                            ELSE b.locked_for
+                        END)
+                      , amount = (CASE
+                            WHEN s.running_sum <= %(amount)s THEN b.amount
+                            ELSE s.running_sum - %(amount)s
+                        END)
+                   FROM selected s
+                  WHERE b.id = s.id
+              RETURNING b.*, s.running_sum
+             ),
+             split AS (
+                 INSERT INTO cash_bundles
+                             (owner, origin, amount, ts, locked_for, wallet_id)
+                      SELECT l.owner, l.origin, %(amount)s - (l.running_sum - s.amount)
+                           , l.ts, %(t_id)s, l.wallet_id
+                        FROM locked l
+                        JOIN selected s ON s.id = l.id
+                       WHERE l.running_sum > %(amount)s
+                   RETURNING amount
+             )
+        SELECT (SELECT sum(amount) FROM candidates) AS transferable
+             , (SELECT count(*) FROM locked) AS n_locked
+             , (SELECT sum(amount) FROM split) AS split_amount
+    """.format(condition, order_by), dict(
+        tipper=transfer.tipper, tippee=transfer.tippee, amount=transfer.amount,
+        t_id=transfer.id, prefer_bundles_from=prefer_bundles_from,
+        bundle_ids=bundle_ids,
+    ))
+    if not r.n_locked or (r.transferable or 0) < transfer.amount:
         raise NegativeBalance()
-    for b in bundles:
-        if x >= b.amount:
-            cursor.run("""
-                UPDATE cash_bundles
-                   SET locked_for = %s
-                 WHERE id = %s
-            """, (transfer.id, b.id))
-            x -= b.amount
-            if x == 0:
-                break
-        else:
-            cursor.run("""
-                UPDATE cash_bundles
-                   SET amount = (amount - %s)
-                 WHERE id = %s;
-
-                INSERT INTO cash_bundles
-                            (owner, origin, amount, ts, locked_for, wallet_id)
-                     VALUES (%s, %s, %s, %s, %s, %s);
-            """, (x, b.id, transfer.tipper, b.origin, x, b.ts, transfer.id, b.wallet_id))
-            break
 
 
 def record_transfer_result(db, t_id, tr):
@@ -533,12 +590,12 @@ def record_transfer_result(db, t_id, tr):
 def _record_transfer_result(db, t_id, status, error=None):
     balance = None
     with db.get_cursor() as c:
-        tipper, tippee, amount, wallet_to = c.one("""
+        tipper, tippee, amount, wallet_to, timestamp = c.one("""
             UPDATE transfers
                SET status = %s
                  , error = %s
              WHERE id = %s
-         RETURNING tipper, tippee, amount, wallet_to
+         RETURNING tipper, tippee, amount, wallet_to, timestamp
         """, (status, error, t_id))
         if status == 'succeeded':
             # Update the balances
@@ -553,6 +610,20 @@ def _record_transfer_result(db, t_id, status, error=None):
                  WHERE id = %(tipper)s
              RETURNING balance;
 
+            """, locals())
+            # Correct the balance snapshots taken since the transfer was initiated
+            c.run("""
+
+                UPDATE balances_at
+                   SET balance = balance + %(amount)s
+                 WHERE participant = %(tippee)s
+                   AND at > %(timestamp)s;
+
+                UPDATE balances_at
+                   SET balance = balance - %(amount)s
+                 WHERE participant = %(tipper)s
+                   AND at > %(timestamp)s;
+
             """, locals())
             # Transfer the locked bundles to the recipient
             bundles = c.all("""
@@ -575,7 +646,6 @@ def _record_transfer_result(db, t_id, status, error=None):
             """, (tipper, t_id))
         bundles_sum = sum(b.amount for b in bundles)
         assert bundles_sum == amount
-    merge_cash_bundles(db, tippee)
     return balance
 
 
@@ -795,6 +865,130 @@ def merge_cash_bundles(db, p_id):
     """, (p_id,))
 
 
+# A group of bundles with the same owner, origin and wallet is fragmented when
+# it contains more than this number of bundles
+FRAGMENTATION_THRESHOLD = 1
+
+# The number of owners whose bundles are merged in a single transaction
+COMPACTION_BATCH_SIZE = 50
+
+# The maximum number of batches processed by a single run of the job
+COMPACTION_MAX_BATCHES = 20
+
+
+def get_bundles_fragmentation(db, owner=None, limit=None):
+    """Measure how fragmented the cash bundles are.
+
+    Returns a list of `(owner, nbundles, ngroups, excess)` rows, sorted by
+    decreasing excess, where `excess` is the number of bundles that merging
+    would eliminate. Only the bundles that can be merged are counted.
+    """
+    return db.all("""
+        SELECT owner, sum(n)::int AS nbundles, count(*)::int AS ngroups
+             , sum(n - 1)::int AS excess
+          FROM ( SELECT owner, count(*) AS n
+                   FROM cash_bundles
+                  WHERE owner IS NOT NULL
+                    AND disputed IS NOT TRUE
+                    AND locked_for IS NULL
+                    AND (%(owner)s IS NULL OR owner = %(owner)s)
+               GROUP BY owner, origin, wallet_id
+               ) x
+      GROUP BY owner
+        HAVING max(n) > %(threshold)s
+      ORDER BY excess DESC, owner
+         LIMIT %(limit)s
+    """, dict(owner=owner, threshold=FRAGMENTATION_THRESHOLD, limit=limit))
+
+
+def get_total_bundles_fragmentation(db):
+    """Returns the total number of mergeable bundles, and how many of them are
+    in excess.
+    """
+    return db.one("""
+        SELECT coalesce(sum(n), 0)::int AS nbundles
+             , coalesce(sum(n - 1), 0)::int AS excess
+          FROM ( SELECT count(*) AS n
+                   FROM cash_bundles
+                  WHERE owner IS NOT NULL
+                    AND disputed IS NOT TRUE
+                    AND locked_for IS NULL
+               GROUP BY owner, origin, wallet_id
+               ) x
+    """)
+
+
+def compact_cash_bundles(db):
+    """Merge the fragmented cash bundles, in small batches.
+
+    Transfers don't merge the bundles they move, this periodic job does. The
+    bundles are locked row by row, skipping the rows that are already locked,
+    and in small batches, so the job only holds its locks briefly. It does
+    still wait for the transfers and exchanges in progress, because they lock
+    the whole `cash_bundles` table in `EXCLUSIVE` mode, which conflicts with
+    row locks, and they wait for it in turn.
+
+    Returns the number of bundles eliminated.
+    """
+    total = 0
+    for i in range(COMPACTION_MAX_BATCHES):
+        owners = [r.owner for r in get_bundles_fragmentation(db, limit=COMPACTION_BATCH_SIZE)]
+        if not owners:
+            break
+        with db.get_cursor() as cursor:
+            n = merge_cash_bundles_of(cursor, owners)
+        total += n
+        if n == 0:
+            break
+    left = get_total_bundles_fragmentation(db)
+    logger.info(
+        "Compacted cash bundles: %i merged away, %i still in excess out of %i." %
+        (total, left.excess, left.nbundles)
+    )
+    return total
+
+
+def merge_cash_bundles_of(cursor, owners):
+    """Merge the bundles of the given owners, without taking a table lock.
+
+    Each group of bundles is merged into its oldest row. Returns the number of
+    rows deleted.
+    """
+    return cursor.one("""
+        WITH locked AS (
+                 SELECT b.id, b.owner, b.origin, b.wallet_id, b.amount, b.ts
+                   FROM cash_bundles b
+                  WHERE b.owner = ANY(%s)
+                    AND b.disputed IS NOT TRUE
+                    AND b.locked_for IS NULL
+                    FOR UPDATE SKIP LOCKED
+             ),
+             groups AS (
+                 SELECT min(id) AS keep, array_agg(id) AS ids
+                      , sum(amount) AS amount, max(ts) AS ts
+                   FROM locked
+               GROUP BY owner, origin, wallet_id
+                 HAVING count(*) > 1
+             ),
+             updated AS (
+                 UPDATE cash_bundles b
+                    SET amount = g.amount
+                      , ts = g.ts
+                   FROM groups g
+                  WHERE b.id = g.keep
+              RETURNING b.id
+             ),
+             deleted AS (
+                 DELETE FROM cash_bundles b
+                  USING groups g
+                  WHERE b.id = ANY(g.ids)
+                    AND b.id <> g.keep
+              RETURNING b.id
+             )
+        SELECT count(*) FROM deleted
+    """, (list(owners),))
+
+
 def create_debt(db, debtor, creditor, amount, origin):
     return db.one("""
         INSERT INTO debts
@@ -804,25 +998,109 @@ def create_debt(db, debtor, creditor, amount, origin):
     """, (debtor, creditor, amount, origin))
 
 
-def sync_with_mangopay(db):
+# The number of items in a page of results returned by the MangoPay API
+MANGOPAY_PAGE_SIZE = 10
+
+# How far back before the oldest pending row we look for its MangoPay transaction
+SYNC_MARGIN = timedelta(hours=1)
+
+# The number of MangoPay users whose transactions are fetched in parallel
+SYNC_WORKERS = 4
+
+
+def list_user_transactions(user_id, tx_type, page):
+    """Fetch a page of a MangoPay user's transactions, most recent first.
+    """
+    kw = {'page': page} if page > 1 else {}
+    return User(id=user_id).transactions.all(
+        Sort='CreationDate:DESC', Type=tx_type, **kw
+    )
+
+
+def fetch_user_transactions(user_id, tx_type, since):
+    """Fetch the transactions of a MangoPay user back to `since`, and index
+    them by `Tag`.
+    """
+    since = calendar.timegm(since.utctimetuple())
+    by_tag = {}
+    page = 1
+    while True:
+        transactions = list_user_transactions(user_id, tx_type, page)
+        for tr in transactions:
+            by_tag.setdefault(tr.Tag, []).append(tr)
+        if len(transactions) < MANGOPAY_PAGE_SIZE:
+            break
+        if _to_timestamp(transactions[-1].CreationDate) < since:
+            break
+        page += 1
+    return by_tag
+
+
+def _to_timestamp(dt):
+    if isinstance(dt, datetime):
+        if dt.tzinfo:
+            return calendar.timegm(dt.utctimetuple())
+        # The SDK converts timestamps to naive datetimes in local time
+        return mktime(dt.timetuple())
+    return dt
+
+
+def sync_with_mangopay(db, workers=SYNC_WORKERS):
     """We can get out of sync with MangoPay if record_exchange_result wasn't
     completed. This is where we fix that.
+
+    The pending rows are grouped by MangoPay user and transaction type, so that
+    each list of transactions is only fetched once. The fetching is done in
+    parallel, the recording of the results isn't.
     """
-    check_db(db)
+    db.self_check()
 
     exchanges = db.all("""
-        SELECT *, (e.timestamp < current_timestamp - interval '1 day') AS is_old
+        SELECT e.*, (e.timestamp < current_timestamp - interval '1 day') AS is_old
+             , p.mangopay_user_id
+             , (CASE WHEN e.amount > 0 THEN 'PAYIN' ELSE 'PAYOUT' END) AS tx_type
           FROM exchanges e
+          JOIN participants p ON p.id = e.participant
          WHERE e.status = 'pre'
     """)
-    for e in exchanges:
-        p = Participant.from_id(e.participant)
-        transactions = [x for x in User(id=p.mangopay_user_id).transactions.all(
-            Sort='CreationDate:DESC', Type=('PAYIN' if e.amount > 0 else 'PAYOUT')
-        ) if x.Tag == str(e.id)]
+    transfers = db.all("""
+        SELECT t.*, (t.timestamp < current_timestamp - interval '1 day') AS is_old
+             , p.mangopay_user_id
+             , 'TRANSFER' AS tx_type
+          FROM transfers t
+          JOIN participants p ON p.id = t.tipper
+         WHERE t.status = 'pre'
+    """)
+
+    windows = {}
+    for row in exchanges + transfers:
+        k = (row.mangopay_user_id, row.tx_type)
+        windows[k] = min(windows.get(k, row.timestamp), row.timestamp)
+    fetched = {}
+    if windows:
+        with ThreadPoolExecutor(max_workers=min(workers, len(windows))) as executor:
+            futures = {
+                k: executor.submit(fetch_user_transactions, k[0], k[1], since - SYNC_MARGIN)
+                for k, since in windows.items()
+            }
+            fetched = {k: f.result() for k, f in futures.items()}
+
+    def find_transaction(row):
+        transactions = fetched[(row.mangopay_user_id, row.tx_type)].get(str(row.id), ())
         assert len(transactions) < 2
-        if transactions:
-            t = transactions[0]
+        return transactions[0] if transactions else None
+
+    participants = {}
+    if exchanges:
+        participants = {p.id: p for p in db.all("""
+            SELECT p
+              FROM participants p
+             WHERE p.id IN %s
+        """, (tuple(set(e.participant for e in exchanges)),))}
+    for e in exchanges:
+        p = participants[e.participant]
+        t = find_transaction(e)
+        if t:
             error = repr_error(t)
             status = t.Status.lower()
             assert (not error) ^ (status == 'failed')
@@ -831,21 +1109,12 @@ def sync_with_mangopay(db):
             # The exchange didn't happen, mark it as failed
             record_exchange_result(db, e.id, '', 'failed', 'interrupted', p)
 
-    transfers = db.all("""
-        SELECT *, (t.timestamp < current_timestamp - interval '1 day') AS is_old
-          FROM transfers t
-         WHERE t.status = 'pre'
-    """)
     for t in transfers:
-        tipper = Participant.from_id(t.tipper)
-        transactions = [x for x in User(id=tipper.mangopay_user_id).transactions.all(
-            Sort='CreationDate:DESC', Type='TRANSFER'
-        ) if x.Tag == str(t.id)]
-        assert len(transactions) < 2
-        if transactions:
-            record_transfer_result(db, t.id, transactions[0])
+        tr = find_transaction(t)
+        if tr:
+            record_transfer_result(db, t.id, tr)
         elif t.is_old:
             # The transfer didn't happen, mark it as failed
             _record_transfer_result(db, t.id, 'failed', 'interrupted')
 
-    check_db(db)
+    db.self_check()
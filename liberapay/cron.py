@@ -1,8 +1,30 @@
+"""Periodic jobs.
+
+A single scheduler thread keeps track of when each job is due, and starts it in
+a new thread, unless its previous run hasn't finished yet. Exclusive jobs are
+only run by one process at a time: each run is protected by an advisory lock
+specific to the job, and skipped if another process is running it or has run
+it recently. The runs of exclusive jobs are recorded in the `cron_jobs` table,
+the other jobs only keep track of their last run in memory.
+
+Jobs can also be woken up by the database: a `NOTIFY cron, '<job name>'` (for
+example from a trigger) makes the job due immediately in all the processes
+that are listening, see `Cron.listen`. The periodic runs are then only a
+fallback.
+"""
+from __future__ import division, print_function, unicode_literals
+
 from collections import namedtuple
 from datetime import datetime, timedelta
+from functools import partial
 import logging
+import random
+import select
 import threading
-from time import sleep
+from time import sleep, time
+import zlib
+
+from pando.utils import utcnow
 
 
 logger = logging.getLogger('liberapay.cron')
@@ -11,64 +33,243 @@ logger = logging.getLogger('liberapay.cron')
 Weekly = namedtuple('Weekly', 'weekday hour')
 
 
+def get_job_name(func):
+    if isinstance(func, partial):
+        func = func.func
+    return func.__name__
+
+
+class Job(object):
+
+    __slots__ = (
+        'name', 'period', 'func', 'exclusive', 'next_run', 'thread', 'woken',
+        'last_start_time', 'last_success_time', 'last_error_time', 'last_error',
+        'last_duration',
+    )
+
+    def __init__(self, name, period, func, exclusive):
+        self.name = name
+        self.period = period
+        self.func = func
+        self.exclusive = exclusive
+        self.next_run = None
+        self.thread = None
+        self.woken = False
+        self.last_start_time = None
+        self.last_success_time = None
+        self.last_error_time = None
+        self.last_error = None
+        self.last_duration = None
+
+    @property
+    def lock_id(self):
+        return zlib.crc32(('cron:' + self.name).encode('utf8')) & 0x7fffffff
+
+    def seconds_until_next_run(self, jitter, grace=0):
+        """Returns the number of seconds to wait before the next run.
+
+        A weekly job whose time has passed less than `grace` seconds ago is
+        due immediately.
+        """
+        if isinstance(self.period, Weekly):
+            now = datetime.utcnow()
+            then = now.replace(hour=self.period.hour, minute=0, second=0, microsecond=0)
+            days = (self.period.weekday - now.isoweekday()) % 7
+            then += timedelta(days=days)
+            if then < now - timedelta(seconds=grace):
+                then += timedelta(days=7)
+            return max((then - now).total_seconds(), 0)
+        return self.period * (1 + random.uniform(0, jitter))
+
+    @property
+    def min_interval(self):
+        """The minimum number of seconds between two runs of an exclusive job.
+        """
+        if isinstance(self.period, Weekly):
+            return 86400 * 6
+        return self.period / 2
+
+
 class Cron(object):
 
+    # The maximum fraction of its period that is randomly added to the delay
+    # before the next run of a job, so that the jobs don't all run at once
+    jitter = 0.1
+
+    # The channel on which the database sends the names of the jobs to wake up
+    channel = 'cron'
+
+    # The number of seconds after which a run of an exclusive job that hasn't
+    # been recorded as finished is presumed dead, e.g. because its process was
+    # killed, and no longer prevents the other processes from running the job
+    timeout = 3600
+
     def __init__(self, website):
         self.website = website
-        self.conn = None
-        self.has_lock = False
-        self.exclusive_jobs = []
+        self.jobs = []
+        self.cond = threading.Condition()
+        self.thread = None
+        self.listener = None
 
     def __call__(self, period, func, exclusive=False):
         if isinstance(period, int) and period <= 0:
             return
-        if exclusive and not self.has_lock:
-            self.exclusive_jobs.append((period, func))
-            self._wait_for_lock()
-            return
-        def f():
-            if isinstance(period, Weekly):
-                while True:
-                    now = datetime.utcnow()
-                    then = now.replace(hour=period.hour, minute=0, second=0)
-                    days = (now.isoweekday() - period.weekday) % 7
-                    if days:
-                        then += timedelta(days=days)
-                    seconds = (then - now).total_seconds()
-                    if seconds > 0:
-                        sleep(seconds)
-                    elif seconds < -3600:
-                        sleep(86400 * 6)
+        name = get_job_name(func)
+        assert name not in set(j.name for j in self.jobs), name
+        job = Job(name, period, func, exclusive)
+        if isinstance(period, Weekly):
+            job.next_run = time() + job.seconds_until_next_run(self.jitter, grace=3600)
+        else:
+            job.next_run = time() + random.uniform(0, min(period, 60) * self.jitter)
+        with self.cond:
+            self.jobs.append(job)
+            self.cond.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._schedule, name='cron')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _schedule(self):
+        while True:
+            with self.cond:
+                now = time()
+                due = [j for j in self.jobs if j.next_run <= now]
+                if not due:
+                    self.cond.wait(min(j.next_run for j in self.jobs) - now)
+                    continue
+            for job in due:
+                if job.thread and job.thread.is_alive():
+                    if job.woken:
+                        # Try again soon, the current run may have missed the new work
+                        job.next_run = time() + 1
                         continue
+                    job.next_run = time() + job.seconds_until_next_run(self.jitter)
+                    logger.warning("Skipping job %s, its previous run is still going on.", job.name)
+                    continue
+                job.next_run = time() + job.seconds_until_next_run(self.jitter)
+                force, job.woken = job.woken, False
+                job.thread = threading.Thread(
+                    target=self.run_job, args=(job, force), name='cron:' + job.name
+                )
+                job.thread.daemon = True
+                job.thread.start()
+
+    def wake(self, name):
+        """Make a job due immediately.
+
+        Returns `False` if there is no job with that name, `True` otherwise.
+        """
+        with self.cond:
+            for job in self.jobs:
+                if job.name == name:
+                    job.woken = True
+                    job.next_run = time()
+                    self.cond.notify()
+                    return True
+        return False
+
+    def listen(self):
+        """Start a thread that wakes up jobs when the database tells it to.
+        """
+        if self.listener is not None:
+            return
+        self.listener = threading.Thread(target=self._listen, name='cron-listener')
+        self.listener.daemon = True
+        self.listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                with self.website.db.get_connection() as conn:
+                    conn.autocommit = True
                     try:
-                        func()
-                    except Exception as e:
-                        self.website.tell_sentry(e, {})
-                    sleep(86400 * 6)
+                        conn.cursor().run("LISTEN %s" % self.channel)
+                        while True:
+                            if select.select([conn], [], [], 300) == ([], [], []):
+                                continue
+                            conn.poll()
+                            while conn.notifies:
+                                name = conn.notifies.pop(0).payload
+                                if not self.wake(name):
+                                    logger.warning("Received a wakeup for unknown job %r.", name)
+                    finally:
+                        conn.autocommit = False
+            except Exception as e:
+                self.website.tell_sentry(e, {}, allow_reraise=False)
+                sleep(10)
+
+    def run_job(self, job, force=False):
+        """Run a job now, unless it's exclusive and another process has it.
+
+        An exclusive job is claimed in a short transaction, protected by an
+        advisory lock, so no database connection is held while it runs. It's
+        skipped if another process is running it, or if it was started
+        recently, unless `force` is true.
+
+        Returns `False` if the job wasn't run, `True` otherwise.
+        """
+        if not job.exclusive:
+            job.last_start_time = utcnow()
+            job.last_duration = None
+            duration, error = self._run(job)
+            job.last_duration = timedelta(seconds=duration)
+            if error is None:
+                job.last_success_time = job.last_start_time
             else:
-                while True:
-                    try:
-                        func()
-                    except Exception as e:
-                        self.website.tell_sentry(e, {})
-                    sleep(period)
-        t = threading.Thread(target=f)
-        t.daemon = True
-        t.start()
-
-    def _wait_for_lock(self):
-        if self.conn:
-            return  # Already waiting
-        self.conn = self.website.db.get_connection().__enter__()
-        def f():
-            cursor = self.conn.cursor()
-            while True:
-                if cursor.one("SELECT pg_try_advisory_lock(0)"):
-                    self.has_lock = True
-                    break
-                sleep(300)
-            for job in self.exclusive_jobs:
-                self(*job, exclusive=True)
-        t = threading.Thread(target=f)
-        t.daemon = True
-        t.start()
+                job.last_error_time = job.last_start_time
+            job.last_error = error
+            return True
+        with self.website.db.get_cursor() as cursor:
+            if not cursor.one("SELECT pg_try_advisory_xact_lock(%s)", (job.lock_id,)):
+                return False
+            start_time = cursor.one("""
+                INSERT INTO cron_jobs AS j
+                            (name, last_start_time)
+                     VALUES (%(name)s, current_timestamp)
+                ON CONFLICT (name) DO UPDATE
+                        SET last_start_time = excluded.last_start_time
+                          , last_duration = NULL
+                      WHERE ( j.last_duration IS NOT NULL OR
+                              j.last_start_time < current_timestamp - make_interval(secs => %(timeout)s)
+                            )
+                        AND ( %(force)s OR
+                              j.last_start_time <= current_timestamp - make_interval(secs => %(min_interval)s)
+                            )
+                  RETURNING last_start_time
+            """, dict(name=job.name, timeout=self.timeout, force=force,
+                      min_interval=job.min_interval))
+        if not start_time:
+            return False
+        duration, error = self._run(job)
+        self.website.db.run("""
+            UPDATE cron_jobs
+               SET last_duration = make_interval(secs => %(duration)s)
+                 , last_success_time = (CASE WHEN %(error)s IS NULL
+                                             THEN last_start_time
+                                             ELSE last_success_time
+                                        END)
+                 , last_error_time = (CASE WHEN %(error)s IS NULL
+                                           THEN last_error_time
+                                           ELSE last_start_time
+                                      END)
+                 , last_error = %(error)s
+             WHERE name = %(name)s
+               AND last_start_time = %(start_time)s
+        """, dict(name=job.name, duration=duration, error=error, start_time=start_time))
+        return True
+
+    def _run(self, job):
+        """Call the job's function.
+
+        Returns a tuple `(duration, error)`.
+        """
+        start = time()
+        error = None
+        try:
+            job.func()
+        except Exception as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+            self.website.tell_sentry(e, {})
+        duration = time() - start
+        logger.info("Job %s ran in %.3f seconds.", job.name, duration)
+        return duration, error
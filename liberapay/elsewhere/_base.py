@@ -1,9 +1,12 @@
 from __future__ import division, print_function, unicode_literals
 
+from collections import OrderedDict
 from datetime import datetime
 import hashlib
 import json
 import logging
+from threading import Lock
+from time import time
 try:
     from urllib.parse import quote, urlsplit
 except ImportError:
@@ -12,17 +15,21 @@ except ImportError:
 import xml.etree.ElementTree as ET
 
 from babel.dates import format_timedelta
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.parser import parse as parse_date
 from pando import Response
 from pando.utils import utc
 from oauthlib.oauth2 import BackendApplicationClient, TokenExpiredError
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1Session, OAuth2Session
 
 from liberapay.exceptions import LazyResponse
 from liberapay.website import website
 
 from ._exceptions import BadUserId, UserNotFound
-from ._extractors import not_available
+from ._extractors import compile_extractor, etree_to_dict, not_available, prune, required
+from ._paginators import PageIterator
+from ._scheduler import scheduler
 
 
 logger = logging.getLogger('liberapay.elsewhere')
@@ -51,6 +58,36 @@ class RepoInfo(object):
     pass
 
 
+class RequestStats(object):
+    """Thread-safe counters of the requests sent to a platform's API.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def add(self, duration, error=False):
+        with self.lock:
+            self.count += 1
+            self.errors += error
+            self.total_time += duration
+            if duration > self.max_time:
+                self.max_time = duration
+
+    def as_dict(self):
+        with self.lock:
+            return dict(
+                count=self.count,
+                errors=self.errors,
+                total_time=self.total_time,
+                mean_time=self.total_time / self.count if self.count else 0.0,
+                max_time=self.max_time,
+            )
+
+
 class Platform(object):
 
     has_teams = False
@@ -68,10 +105,28 @@ class Platform(object):
     x_avatar_url = not_available
     x_is_team = not_available
 
+    # The keys of `extra_info` that are worth storing, `None` means all of them
+    extra_info_keys = None
+    repo_extra_info_keys = None
+
     required_attrs = ('account_url', 'display_name', 'name')
 
+    # Connection pooling: the number of hosts to keep pools for, and the
+    # number of connections to keep alive in each pool
+    http_pool_connections = 4
+    http_pool_maxsize = 10
+
+    # Maximum number of entries in the user info cache
+    user_info_cache_size = 1000
+
+    # Maximum number of app sessions, the least recently used ones are dropped
+    app_sessions_size = 100
+
+    # The number of threads used to prefetch the next pages of API resources
+    prefetch_workers = 4
+
     def __init__(self, api_key, api_secret, callback_url, api_url=None, auth_url=None,
-                 api_timeout=20.0, app_name=None, app_url=None):
+                 api_timeout=20.0, app_name=None, app_url=None, user_info_cache_ttl=0):
         self.api_key = api_key
         self.api_secret = api_secret
         self.callback_url = callback_url
@@ -85,6 +140,17 @@ class Platform(object):
         self.app_name = app_name
         self.app_url = app_url
         self.credentials_cache = {}
+        self.app_sessions = OrderedDict()
+        self.app_sessions_lock = Lock()
+        self.http_adapter = HTTPAdapter(
+            pool_connections=self.http_pool_connections,
+            pool_maxsize=self.http_pool_maxsize,
+        )
+        self.request_stats = RequestStats()
+        self.user_info_cache = OrderedDict()
+        self.user_info_cache_lock = Lock()
+        self.user_info_cache_ttl = user_info_cache_ttl
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=self.prefetch_workers)
         domain = urlsplit(self.api_url).hostname
         self.domain = domain if '{' not in domain else None
 
@@ -97,6 +163,25 @@ class Platform(object):
         elif api_format:
             raise ValueError('unknown API format: '+str(api_format))
 
+        # Compile the extractors
+        self._extract_user_fields = compile_extractor(self, 'x_', (
+            ('display_name', None),
+            ('email', None),
+            ('avatar_url', None),
+            ('is_team', False),
+        ))
+        if hasattr(self, 'x_repo_id'):
+            self._extract_repo_fields = compile_extractor(self, 'x_repo_', (
+                ('name', required),
+                ('slug', required),
+                ('id', required),
+                ('owner_id', None),
+                ('description', None),
+                ('last_update', None),
+                ('is_fork', None),
+                ('stars_count', None),
+            ))
+
         # Make sure the subclass was implemented properly.
         missing_attrs = [a for a in self.required_attrs if not hasattr(self, a)]
         if missing_attrs:
@@ -117,10 +202,19 @@ class Platform(object):
         kw.setdefault('timeout', self.api_timeout)
         if hasattr(self, 'api_headers'):
             kw.setdefault('headers', {}).update(self.api_headers)
-        response = sess.request(method, url, **kw)
-
         if not is_user_session:
-            limit, remaining, reset = self.get_ratelimit_headers(response)
+            scheduler.before_request(self.name, domain)
+        start_time = time()
+        try:
+            response = sess.request(method, url, **kw)
+        except Exception:
+            self.request_stats.add(time() - start_time, error=True)
+            raise
+        self.request_stats.add(time() - start_time, error=response.status_code >= 400)
+
+        limit, remaining, reset = self.get_ratelimit_headers(response)
+        if not is_user_session:
+            scheduler.after_response(self.name, domain, limit, remaining, reset)
             self.log_ratelimit_headers(domain, limit, remaining, reset)
 
         # Check response status
@@ -135,6 +229,32 @@ class Platform(object):
 
         return response
 
+    def mount_http_adapter(self, sess):
+        """Make a session use this platform's pool of keep-alive connections.
+        """
+        sess.mount('https://', self.http_adapter)
+        sess.mount('http://', self.http_adapter)
+        return sess
+
+    def get_app_session(self, domain):
+        """Returns the session used to make unauthenticated API calls.
+
+        There is one session per domain, shared by all threads. The domains
+        of some platforms are chosen by the users, so only the most recently
+        used sessions are kept.
+        """
+        with self.app_sessions_lock:
+            sess = self.app_sessions.pop(domain, None)
+            if sess is None:
+                sess = self.create_app_session(domain)
+                while len(self.app_sessions) >= self.app_sessions_size:
+                    self.app_sessions.popitem(last=False)
+            self.app_sessions[domain] = sess
+        return sess
+
+    def create_app_session(self, domain):
+        return self.get_auth_session(domain)
+
     def api_get(self, domain, path, sess=None, **kw):
         """
         Given a `path` (e.g. /users/foo), this function sends a GET request to
@@ -229,9 +349,7 @@ class Platform(object):
         if r.user_id is not None:
             r.user_id = str(r.user_id)
             assert len(r.user_id) > 0
-        r.display_name = self.x_display_name(r, info, None)
-        r.email = self.x_email(r, info, None)
-        r.avatar_url = self.x_avatar_url(r, info, None)
+        self._extract_user_fields(r, info)
         if not r.avatar_url:
             gravatar_id = self.x_gravatar_id(r, info, None)
             if r.email and not gravatar_id:
@@ -239,8 +357,9 @@ class Platform(object):
                 gravatar_id = hashlib.md5(bs).hexdigest()
             if gravatar_id:
                 r.avatar_url = 'https://seccdn.libravatar.org/avatar/'+gravatar_id
-        r.is_team = self.x_is_team(r, info, False)
-        r.extra_info = info
+        if isinstance(info, ET.Element):
+            info = etree_to_dict(info)
+        r.extra_info = prune(info, self.extra_info_keys)
         return r
 
     def get_team_members(self, account, domain, page_url=None):
@@ -256,6 +375,14 @@ class Platform(object):
         members = [self.extract_user_info(m, domain) for m in members]
         return members, count, pages_urls
 
+    def iter_team_members(self, account, domain, **budget):
+        """Iterate over the members of a team, see `PageIterator`.
+        """
+        return PageIterator(
+            lambda url: self.get_team_members(account, domain, url),
+            self.prefetch_executor, **budget
+        )
+
     def get_user_info(self, domain, key, value, sess=None):
         """Given a user_name or user_id, get the user's info from the API.
         """
@@ -280,6 +407,35 @@ class Platform(object):
         info = self.api_parser(response)
         return self.extract_user_info(info, domain)
 
+    def get_user_info_cached(self, domain, key, value):
+        """Like `get_user_info`, but the results are cached in memory for
+        `user_info_cache_ttl` seconds, including `UserNotFound` errors.
+        """
+        if not self.user_info_cache_ttl:
+            return self.get_user_info(domain, key, value)
+        cache_key = (domain, key, value)
+        now = time()
+        expires, r = self.user_info_cache.get(cache_key, (0, None))
+        if expires < now:
+            try:
+                r = self.get_user_info(domain, key, value)
+            except UserNotFound as e:
+                r = e
+            with self.user_info_cache_lock:
+                cache = self.user_info_cache
+                cache.pop(cache_key, None)
+                if len(cache) >= self.user_info_cache_size:
+                    # The entries are in insertion order, so the oldest ones,
+                    # which are also the first to expire, come first
+                    while cache and (next(iter(cache.values()))[0] <= now or
+                                     len(cache) >= self.user_info_cache_size):
+                        cache.popitem(last=False)
+                cache[cache_key] = (now + self.user_info_cache_ttl, r)
+        if isinstance(r, UserNotFound):
+            raise r
+        # Return a copy, because `AccountElsewhere.upsert()` modifies it
+        return UserInfo(**r.__dict__)
+
     def get_user_self_info(self, domain, sess):
         """Get the authenticated user's info from the API.
         """
@@ -303,22 +459,25 @@ class Platform(object):
             count = self.x_friends_count(None, account.extra_info, -1)
         return friends, count, pages_urls
 
+    def iter_friends_for(self, account, sess=None, **budget):
+        """Iterate over the friends of a user, see `PageIterator`.
+        """
+        return PageIterator(
+            lambda url: self.get_friends_for(account, url, sess),
+            self.prefetch_executor, **budget
+        )
+
     def extract_repo_info(self, info, source):
         r = RepoInfo()
         r.platform = self.name
-        r.name = self.x_repo_name(r, info)
-        r.slug = self.x_repo_slug(r, info)
-        r.remote_id = str(self.x_repo_id(r, info))
-        r.owner_id = self.x_repo_owner_id(r, info, None)
-        r.description = self.x_repo_description(r, info, None)
-        r.last_update = self.x_repo_last_update(r, info, None)
+        self._extract_repo_fields(r, info)
+        r.remote_id = str(r.id)
+        del r.id
         if r.last_update:
             r.last_update = parse_date(r.last_update)
-        r.is_fork = self.x_repo_is_fork(r, info, None)
-        r.stars_count = self.x_repo_stars_count(r, info, None)
-        r.extra_info = info
         if hasattr(self, 'x_repo_extra_info_drop'):
-            self.x_repo_extra_info_drop(r.extra_info)
+            self.x_repo_extra_info_drop(info)
+        r.extra_info = prune(info, self.repo_extra_info_keys)
         return r
 
     def get_repos(self, account, page_url=None, sess=None):
@@ -345,6 +504,22 @@ class Platform(object):
         repos = [self.extract_repo_info(repo, account.domain) for repo in repos]
         return repos, count, pages_urls
 
+    def iter_repos(self, account, sess=None, **budget):
+        """Iterate over the repositories of a user, see `PageIterator`.
+        """
+        return PageIterator(
+            lambda url: self.get_repos(account, url, sess),
+            self.prefetch_executor, **budget
+        )
+
+    def iter_starred_repos(self, account, sess, **budget):
+        """Iterate over the repositories starred by a user, see `PageIterator`.
+        """
+        return PageIterator(
+            lambda url: self.get_starred_repos(account, sess, url),
+            self.prefetch_executor, **budget
+        )
+
     def get_credentials(self, domain):
         # 0. Single-domain platforms have a single pair of credentials
         if self.single_domain:
@@ -391,17 +566,15 @@ class PlatformOAuth1(Platform):
     authorize_path = '/oauth/authorize'
     access_token_path = '/oauth/access_token'
 
-    def get_app_session(self, domain):
-        return self.get_auth_session(domain)
-
     def get_auth_session(self, domain, token=None):
         args = ()
         if token:
             args = (token['token'], token['token_secret'])
         callback_url = self.callback_url.format(domain=domain)
         client_id, client_secret = self.get_credentials(domain)
-        return OAuth1Session(client_id, client_secret, *args,
-                             callback_uri=callback_url)
+        return self.mount_http_adapter(OAuth1Session(
+            client_id, client_secret, *args, callback_uri=callback_url
+        ))
 
     def get_auth_url(self, domain, **kw):
         sess = self.get_auth_session(domain)
@@ -433,26 +606,24 @@ class PlatformOAuth2(Platform):
 
     session_class = OAuth2Session
 
-    def __init__(self, *args, **kw):
-        Platform.__init__(self, *args, **kw)
+    def create_app_session(self, domain):
         if self.can_auth_with_client_credentials:
-            self.app_sessions = {}
+            client_id = self.get_credentials(domain)[0]
+            return self.mount_http_adapter(
+                self.session_class(client=BackendApplicationClient(client_id))
+            )
+        return self.get_auth_session(domain)
 
     def get_app_session(self, domain):
-        if self.can_auth_with_client_credentials:
-            sess = self.app_sessions.get(domain)
-            if not sess:
-                client_id = self.get_credentials(domain)[0]
-                sess = self.session_class(client=BackendApplicationClient(client_id))
-                self.app_sessions[domain] = sess
-            if not sess.token:
-                access_token_url = self.access_token_url.format(domain=domain)
-                client_id, client_secret = self.get_credentials(domain)
-                sess.fetch_token(access_token_url, client_id=client_id,
-                                 client_secret=client_secret)
-            return sess
-        else:
-            return self.get_auth_session(domain)
+        sess = Platform.get_app_session(self, domain)
+        if self.can_auth_with_client_credentials and not sess.token:
+            with self.app_sessions_lock:
+                if not sess.token:
+                    access_token_url = self.access_token_url.format(domain=domain)
+                    client_id, client_secret = self.get_credentials(domain)
+                    sess.fetch_token(access_token_url, client_id=client_id,
+                                     client_secret=client_secret)
+        return sess
 
     def get_auth_session(self, domain, state=None, token=None, token_updater=None):
         callback_url = self.callback_url.format(domain=domain)
@@ -462,11 +633,11 @@ class PlatformOAuth2(Platform):
             refresh_url = getattr(self, 'refresh_token_url', self.access_token_url)
         else:
             refresh_url = None
-        return self.session_class(
+        return self.mount_http_adapter(self.session_class(
             client_id, state=state, token=token, token_updater=token_updater,
             auto_refresh_url=refresh_url, auto_refresh_kwargs=credentials,
             redirect_uri=callback_url, scope=self.oauth_default_scope
-        )
+        ))
 
     def get_auth_url(self, domain, **kw):
         sess = self.get_auth_session(domain)
@@ -13,3 +13,7 @@ class UserNotFound(ElsewhereError):
 
 class BadUserId(ElsewhereError):
     pass
+
+
+class RatelimitReached(ElsewhereError):
+    """Raised when a background request would have to wait too long."""
@@ -120,3 +120,65 @@ def xpath(path, attr=None, clean=lambda a: a):
             raise ValueError(msg)
         return v
     return f
+
+
+required = object()
+
+
+def compile_extractor(platform, prefix, fields):
+    """Turn the `x_*` methods of a platform into a single extraction function.
+
+    `fields` is a sequence of `(attr, default)` pairs. A `default` of `required`
+    means that the value must be present in the API response. The `x_*` methods
+    are looked up once, and the ones that are `not_available` are replaced by
+    their default values.
+    """
+    steps = []
+    for attr, default in fields:
+        f = getattr(platform, prefix + attr)
+        if getattr(f, '__func__', None) is not_available:
+            if default is required:
+                raise AttributeError('%s%s is required' % (prefix, attr))
+            steps.append((attr, None, default))
+        else:
+            steps.append((attr, f, () if default is required else (default,)))
+    steps = tuple(steps)
+
+    def extract(extracted, info):
+        for attr, f, default in steps:
+            setattr(extracted, attr, default if f is None else f(extracted, info, *default))
+        return extracted
+
+    return extract
+
+
+def etree_to_dict(element):
+    """Convert an XML element into a dict, in a single pass.
+
+    The output has the same structure as `xmltodict.parse(ET.tostring(element))`.
+    """
+    d = {'@' + k: v for k, v in element.attrib.items()}
+    for child in element:
+        v = etree_to_dict(child)[child.tag]
+        if child.tag in d:
+            if not isinstance(d[child.tag], list):
+                d[child.tag] = [d[child.tag]]
+            d[child.tag].append(v)
+        else:
+            d[child.tag] = v
+    text = (element.text or '').strip()
+    if not d:
+        return {element.tag: text or None}
+    if text:
+        d['#text'] = text
+    return {element.tag: d}
+
+
+def prune(info, keys):
+    """Return a copy of the `info` dict containing only the given `keys`.
+
+    If `keys` is `None` then `info` is returned unmodified.
+    """
+    if keys is None or not isinstance(info, dict):
+        return info
+    return {k: info[k] for k in keys if k in info}
@@ -2,6 +2,8 @@
 """
 from __future__ import unicode_literals
 
+from ._scheduler import scheduler
+
 try:
     from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
 except ImportError:
@@ -96,3 +98,94 @@ def keys_paginator(page_key, **kw):
         total_count = paging.get(total_key, -1) if links else len(page)
         return page, total_count, links
     return f
+
+
+class PageIterator(object):
+    """Iterates lazily over the items of a paginated API resource.
+
+    `get_page` is a function that takes the URL of a page (`None` for the first
+    one) and returns a `(items, total_count, links)` tuple, like the `get_*`
+    methods of `Platform`. If an `executor` is given, the next page is fetched
+    in the background while the current one is being consumed.
+
+    The iteration stops after `max_pages` pages or `max_items` items, or when
+    the `keep_going` function returns a falsy value. Once the iteration is
+    over, `complete` tells whether all the items have been seen, `next_url` is
+    the URL of the first page that hasn't been fetched, if any, and
+    `interrupted` is `True` if it was `keep_going` that stopped the iteration.
+    """
+
+    def __init__(self, get_page, executor=None, max_pages=None, max_items=None,
+                 keep_going=None):
+        self.get_page = get_page
+        self.executor = executor
+        self.max_pages = max_pages
+        self.max_items = max_items
+        self.keep_going = keep_going
+        self.total_count = -1
+        self.next_url = None
+        self.complete = False
+        self.interrupted = False
+        self.pages_count = 0
+        self.items_count = 0
+
+    def __iter__(self):
+        for page in self.pages():
+            for item in page:
+                yield item
+
+    def _fetch(self, url, background):
+        if background:
+            with scheduler.background():
+                return self.get_page(url)
+        return self.get_page(url)
+
+    def _submit(self, url):
+        if self.executor:
+            return self.executor.submit(self._fetch, url, scheduler.in_background)
+        return lambda: self.get_page(url)
+
+    def _result(self, pending):
+        if self.executor:
+            return pending.result()
+        return pending()
+
+    def _should_stop(self):
+        if self.max_pages is not None and self.pages_count >= self.max_pages:
+            return True
+        if self.max_items is not None and self.items_count >= self.max_items:
+            return True
+        if self.keep_going and not self.keep_going():
+            self.interrupted = True
+            return True
+        return False
+
+    def pages(self):
+        """Yield the items one page at a time.
+        """
+        if self.pages_count:
+            raise RuntimeError("this iterator has already been consumed")
+        if self.max_pages == 0 or self.max_items == 0:
+            return
+        pending = self._submit(None)
+        while pending is not None:
+            items, self.total_count, links = self._result(pending)
+            self.pages_count += 1
+            truncated = False
+            if self.max_items is not None:
+                truncated = len(items) > self.max_items - self.items_count
+                items = items[:self.max_items - self.items_count]
+            self.items_count += len(items)
+            self.next_url = links.get('next')
+            self.complete = not (self.next_url or truncated)
+            pending = None
+            if self.next_url and not self._should_stop():
+                # Prefetch the next page while the caller processes this one
+                pending = self._submit(self.next_url)
+                self.next_url = None
+            try:
+                yield items
+            except GeneratorExit:
+                if pending is not None and self.executor:
+                    pending.cancel()
+                raise
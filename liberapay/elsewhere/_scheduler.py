@@ -0,0 +1,152 @@
+"""Scheduling of the requests we send to the APIs of other platforms.
+
+Most APIs limit the number of requests we can send in a time window, and tell
+us how much of the quota remains through response headers. The scheduler
+keeps that information in memory, and shares it with the other processes
+through the `platform_ratelimits` table, so that background jobs don't consume
+the part of the quota that is reserved for the requests of users. The table is
+only written to when the quota crosses the reserve, or when the stored info is
+more than a few seconds old, and only read by background requests.
+"""
+from __future__ import division, print_function, unicode_literals
+
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import threading
+from time import sleep, time
+
+from pando.utils import utcnow
+
+from liberapay.website import website
+
+from ._exceptions import RatelimitReached
+
+
+logger = logging.getLogger('liberapay.elsewhere')
+
+
+Ratelimit = namedtuple('Ratelimit', 'limit remaining reset_at ts')
+
+
+class RequestScheduler(object):
+    """Gives priority to interactive requests over background ones.
+
+    Requests are interactive by default, they're never delayed. Requests sent
+    inside a `with scheduler.background():` block are delayed when the quota
+    is running low, until the time window resets.
+    """
+
+    # The fraction of the quota which is reserved for interactive requests
+    reserve = 0.2
+
+    # The maximum number of seconds a background request can be delayed,
+    # `RatelimitReached` is raised if it would have to wait longer than that
+    max_wait = 60
+
+    # The number of seconds after which the info shared through the database
+    # is considered stale
+    sync_interval = 5
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.states = {}
+        self.synced = {}
+
+    def clear(self):
+        with self.lock:
+            self.states.clear()
+            self.synced.clear()
+
+    @contextmanager
+    def background(self):
+        previous = self.in_background
+        self.local.background = True
+        try:
+            yield
+        finally:
+            self.local.background = previous
+
+    @property
+    def in_background(self):
+        return getattr(self.local, 'background', False)
+
+    def before_request(self, platform, domain):
+        """Delay a background request if the quota is running low.
+        """
+        if not self.in_background:
+            return
+        wait = self._get_wait(platform, domain)
+        if wait <= 0:
+            return
+        state = self.states[(platform, domain)]
+        if wait > self.max_wait:
+            raise RatelimitReached(platform, domain, state.reset_at)
+        logger.info('Delaying a background request to %s by %i seconds.' % (domain, wait))
+        sleep(wait)
+
+    def has_quota_to_spare(self, platform, domain):
+        """Returns `False` if a background request would have to be delayed.
+        """
+        return self._get_wait(platform, domain) <= 0
+
+    def _get_wait(self, platform, domain):
+        """Returns the number of seconds until the part of the quota that isn't
+        reserved is available again.
+
+        The info stored by the other processes is fetched if ours is stale.
+        """
+        key = (platform, domain)
+        if time() - self.synced.get(key, 0) > self.sync_interval:
+            stored = website.db.one("""
+                SELECT ratelimit, remaining, reset_at, ts
+                  FROM platform_ratelimits
+                 WHERE platform = %s
+                   AND domain = %s
+            """, (platform, domain))
+            with self.lock:
+                state = self.states.get(key)
+                if stored and (not state or stored.ts > state.ts):
+                    self.states[key] = Ratelimit(*stored)
+                self.synced[key] = time()
+        state = self.states.get(key)
+        if not state or not self._is_low(state.limit, state.remaining):
+            return 0
+        return (state.reset_at - utcnow()).total_seconds()
+
+    def _is_low(self, limit, remaining):
+        return remaining <= limit * self.reserve
+
+    def after_response(self, platform, domain, limit, remaining, reset):
+        """Record the ratelimit info returned by an API.
+        """
+        if None in (limit, remaining, reset):
+            return
+        key = (platform, domain)
+        state = Ratelimit(limit, remaining, reset, utcnow())
+        with self.lock:
+            previous = self.states.get(key)
+            self.states[key] = state
+            crossed = (
+                previous is None or
+                self._is_low(previous.limit, previous.remaining) != self._is_low(limit, remaining)
+            )
+            stale = time() - self.synced.get(key, 0) > self.sync_interval
+            if not (crossed or stale):
+                return
+            self.synced[key] = time()
+        website.db.run("""
+            INSERT INTO platform_ratelimits
+                        (platform, domain, ratelimit, remaining, reset_at, ts)
+                 VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (platform, domain) DO UPDATE
+                    SET ratelimit = excluded.ratelimit
+                      , remaining = excluded.remaining
+                      , reset_at = excluded.reset_at
+                      , ts = excluded.ts
+                  WHERE platform_ratelimits.ts < excluded.ts
+        """, (platform, domain, limit, remaining, reset, state.ts))
+
+
+scheduler = RequestScheduler()
@@ -35,6 +35,7 @@ class Bitbucket(PlatformOAuth1):
     x_email = not_available
     x_avatar_url = any_key('avatar', ('links', 'avatar', 'href'))
     x_is_team = key('type', lambda v: v == 'team')
+    extra_info_keys = ('created_on', 'location', 'website')
 
     def api_get(self, domain, path, sess=None, **kw):
         """Extend to manually retry /users/pypy as /teams/pypy.
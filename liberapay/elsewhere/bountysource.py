@@ -39,7 +39,7 @@ class Bountysource(Platform):
     x_avatar_url = key('image_url')
 
     def get_auth_session(self, domain, token=None):
-        sess = requests.Session()
+        sess = self.mount_http_adapter(requests.Session())
         sess.auth = BountysourceAuth(token)
         return sess
 
@@ -2,7 +2,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 from liberapay.elsewhere._base import PlatformOAuth2
 from liberapay.elsewhere._exceptions import CantReadMembership
-from liberapay.elsewhere._extractors import key, drop_keys
+from liberapay.elsewhere._extractors import key
 from liberapay.elsewhere._paginators import header_links_paginator
 
 
@@ -43,6 +43,10 @@ class GitHub(PlatformOAuth2):
     x_gravatar_id = key('gravatar_id')
     x_avatar_url = key('avatar_url')
     x_is_team = key('type', clean=lambda t: t.lower() == 'organization')
+    extra_info_keys = (
+        'bio', 'blog', 'company', 'created_at', 'followers', 'following',
+        'location', 'public_repos',
+    )
 
     # Repo info extractors
     x_repo_id = key('id')
@@ -53,7 +57,10 @@ class GitHub(PlatformOAuth2):
     x_repo_is_fork = key('fork')
     x_repo_stars_count = key('stargazers_count')
     x_repo_owner_id = key('owner', clean=lambda d: d['id'])
-    x_repo_extra_info_drop = drop_keys(lambda k: k.endswith('_url'))
+    repo_extra_info_keys = (
+        'created_at', 'default_branch', 'forks_count', 'homepage', 'language',
+        'open_issues_count', 'updated_at', 'watchers_count',
+    )
 
     def get_CantReadMembership_url(self, **kw):
         return 'https://github.com/settings/connections/applications/'+self.api_key
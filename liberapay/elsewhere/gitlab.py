@@ -41,6 +41,10 @@ class GitLab(PlatformOAuth2):
     x_display_name = key('name')
     x_email = key('email')
     x_avatar_url = key('avatar_url')
+    extra_info_keys = (
+        'bio', 'created_at', 'linkedin', 'location', 'organization', 'skype',
+        'twitter', 'website_url',
+    )
 
     # Repo info extractors
     x_repo_id = key('id')
@@ -51,3 +55,6 @@ class GitLab(PlatformOAuth2):
     x_repo_is_fork = key('forked_from_project', clean=bool)
     x_repo_stars_count = key('star_count')
     x_repo_owner_id = key('owner', clean=lambda d: d['id'])
+    repo_extra_info_keys = (
+        'created_at', 'default_branch', 'forks_count', 'visibility', 'web_url',
+    )
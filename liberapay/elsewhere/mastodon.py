@@ -48,6 +48,9 @@ class Mastodon(PlatformOAuth2):
     x_user_name = key('username')
     x_display_name = key('display_name')
     x_avatar_url = key('avatar_static')
+    extra_info_keys = (
+        'acct', 'created_at', 'followers_count', 'following_count', 'locked', 'note',
+    )
 
     def x_user_info(self, extracted, info, default):
         if 'accounts' in info:
@@ -59,3 +59,4 @@ class Twitch(PlatformOAuth2):
     x_display_name = key('display_name')
     x_email = key('email')
     x_avatar_url = key('logo')
+    extra_info_keys = ('bio', 'created_at', 'followers', 'url', 'views')
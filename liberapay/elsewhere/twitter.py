@@ -36,3 +36,7 @@ class Twitter(PlatformOAuth1):
     x_avatar_url = key('profile_image_url_https',
                        clean=lambda v: v.replace('_normal.', '.'))
     x_friends_count = key('friends_count')
+    extra_info_keys = (
+        'created_at', 'description', 'followers_count', 'friends_count',
+        'location', 'protected', 'url', 'verified',
+    )
@@ -259,6 +259,11 @@ class InvalidCommunityName(LazyResponse400):
         return _('"{0}" is not a valid community name.', *self.args)
 
 
+class InvalidPageCursor(LazyResponse400):
+    def msg(self, _):
+        return _('"{0}" is not a valid pagination cursor.', *self.args)
+
+
 class TransferError(LazyResponseXXX):
     code = 500
     def msg(self, _):
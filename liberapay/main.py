@@ -1,5 +1,6 @@
 from __future__ import division
 
+from functools import partial
 from ipaddress import ip_address
 import os
 import signal
@@ -19,6 +20,7 @@ from pando.utils import maybe_encode
 
 from liberapay import utils, wireup
 from liberapay.billing.payday import create_payday_issue
+from liberapay.billing.transactions import compact_cash_bundles
 from liberapay.cron import Cron, Weekly
 from liberapay.models.community import Community
 from liberapay.models.participant import Participant
@@ -92,13 +94,17 @@ elif env.clean_assets:
 
 conf = website.app_conf
 if env.run_cron_jobs and conf:
-    cron = Cron(website)
+    cron = website.cron = Cron(website)
     cron(conf.check_db_every, website.db.self_check, True)
     cron(conf.dequeue_emails_every, Participant.dequeue_emails, True)
     cron(conf.send_newsletters_every, Participant.send_newsletters, True)
     cron(conf.refetch_repos_every, refetch_repos, True)
     cron(Weekly(weekday=3, hour=2), create_payday_issue, True)
     cron(conf.clean_up_counters_every, website.db.clean_up_counters, True)
+    cron(conf.compact_cash_bundles_every, partial(compact_cash_bundles, website.db), True)
+    cron(conf.sync_rate_limits_every, website.db.sync_rate_limits)
+    cron(conf.refresh_explore_lists_every, website.db.refresh_explore_lists, True)
+    cron.listen()
 
 
 # Website Algorithm
@@ -218,6 +224,54 @@ def _json(self, obj, code=200):
     raise self
 pando.Response.json = _json
 
+class StreamingBody(object):
+    """A response body that is generated lazily while it's being sent.
+
+    The WSGI server calls `close()` once the response has been sent, or when
+    the client has gone away, so that the generator can release what it holds.
+    """
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.charset = None
+
+    def __iter__(self):
+        charset = self.charset
+        for chunk in self.iterable:
+            if charset and not isinstance(chunk, bytes):
+                chunk = chunk.encode(charset)
+            yield chunk
+
+    def close(self):
+        close = getattr(self.iterable, 'close', None)
+        if close is not None:
+            close()
+
+if hasattr(pando.Response, 'stream'):
+    raise Warning('pando.Response.stream() already exists')
+def _stream(self, iterable, content_type, code=200):
+    self.code = code
+    self.body = StreamingBody(iterable)
+    self.headers[b'Content-Type'] = content_type
+    raise self
+pando.Response.stream = _stream
+
+_to_wsgi = pando.Response.to_wsgi
+def _to_wsgi_streaming(self, environ, start_response, charset):
+    body = self.body
+    if not isinstance(body, StreamingBody):
+        return _to_wsgi(self, environ, start_response, charset)
+    # Let pando send the status and headers, then hand our body to the server
+    # directly, pando's wrapper would neither iterate over it nor close it
+    self.body = b''
+    try:
+        _to_wsgi(self, environ, start_response, charset)
+    finally:
+        self.body = body
+    body.charset = charset
+    return body
+pando.Response.to_wsgi = _to_wsgi_streaming
+
 if hasattr(pando.Response, 'sanitize_untrusted_url'):
     raise Warning('pando.Response.sanitize_untrusted_url() already exists')
 def _sanitize_untrusted_url(response, url):
@@ -266,5 +320,9 @@ if hasattr(pando.Response, 'text'):
     raise Warning('pando.Response.text already exists')
 def _decode_body(self):
     body = self.body
+    if isinstance(body, StreamingBody):
+        self.body = body = ''.join(
+            chunk.decode('utf8') if isinstance(chunk, bytes) else chunk for chunk in body
+        )
     return body.decode('utf8') if isinstance(body, bytes) else body
 pando.Response.text = property(_decode_body)
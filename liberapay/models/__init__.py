@@ -1,8 +1,11 @@
 from __future__ import print_function
 
 from contextlib import contextmanager
+import json
+import logging
 import re
 import sys
+from time import time
 import traceback
 
 from six.moves import input
@@ -13,6 +16,10 @@ from psycopg2 import IntegrityError, ProgrammingError
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 from liberapay.constants import RATE_LIMITS
+from liberapay.security.rate_limiting import rate_limiter
+
+
+logger = logging.getLogger(__name__)
 
 
 @contextmanager
@@ -29,27 +36,240 @@ class DB(Postgres):
             return just_yield(cursor)
         return super(DB, self).get_cursor(**kw)
 
-    def self_check(self):
+    def self_check(self, full=False):
+        """Check the consistency of the ledger.
+
+        By default only the rows that have changed since the last check are
+        verified, pass `full=True` to check everything.
+        """
         with self.get_cursor() as cursor:
-            check_db(cursor)
+            if full:
+                last_tip = _get_last_tip_id(cursor)
+                durations = check_db(cursor)
+                durations += _run_checks(cursor, [
+                    (_check_cash_bundle_totals, ()),
+                    (_check_current_takes, ()),
+                    (_check_current_tips, ()),
+                ])
+                reset_checkpoints(cursor, last_tip)
+            else:
+                durations = check_db_incrementally(cursor)
+        logger.info("%s DB self check took %.3fs (%s)." % (
+            'Full' if full else 'Incremental',
+            sum(d for name, d in durations),
+            ', '.join('%s: %.3fs' % x for x in durations),
+        ))
+        return durations
+
+
+def _run_checks(cursor, checks):
+    """Run the given checks and return how long each one took.
+    """
+    durations = []
+    for check, args in checks:
+        start = time()
+        check(cursor, *args)
+        durations.append((check.__name__.lstrip('_'), time() - start))
+    return durations
 
 
 def check_db(cursor):
     """Runs all available self checks on the given cursor.
     """
-    _check_balances_against_transactions(cursor)
-    _check_tips(cursor)
-    _check_bundles_against_balances(cursor)
-    _check_bundles_grouped_by_origin_against_exchanges(cursor)
-    _check_bundles_grouped_by_withdrawal_against_exchanges(cursor)
+    return _run_checks(cursor, [
+        (_check_balances_against_transactions, ()),
+        (_check_tips, ()),
+        (_check_bundles_against_balances, ()),
+        (_check_bundles_grouped_by_origin_against_exchanges, ()),
+        (_check_bundles_grouped_by_withdrawal_against_exchanges, ()),
+    ])
+
+
+def check_db_incrementally(cursor):
+    """Runs the self checks on the rows that have changed since the last check.
+
+    The `balance_checkpoints` table holds the balance of each participant
+    resulting from the exchanges and transfers up to the watermarks stored in
+    `db_meta`. The rows above the watermarks tell which participants and
+    exchanges need to be checked, so the cost of a check grows with the
+    activity since the previous one, not with the size of the ledger, and the
+    tables that are written to during payday don't need any triggers.
+
+    A watermark only moves past rows that are in a final state, and that can't
+    be preceded by rows that haven't been committed yet, see
+    `_advance_balance_checkpoints`. Changes which don't go through new or
+    pending exchanges and transfers, for example a payin that fails after it
+    has succeeded, are only caught by the full check.
+
+    The cursor must be inside a transaction, otherwise the watermarks would
+    move even when a check fails.
+    """
+    checked_tips_until = cursor.one("""
+        SELECT value
+          FROM db_meta
+         WHERE key = 'checked_tips_until'
+           FOR UPDATE
+    """)
+    # Tips inserted while the checks are running may not be checked, so the
+    # checkpoint can't go beyond the last tip that exists before they start
+    last_tip = _get_last_tip_id(cursor)
+    state = _advance_balance_checkpoints(cursor)
+    participants = cursor.all("""
+        SELECT participant FROM exchanges WHERE id > %(exchanges)s
+         UNION
+        SELECT tipper FROM transfers WHERE id > %(transfers)s
+         UNION
+        SELECT tippee FROM transfers WHERE id > %(transfers)s
+    """, state)
+    exchanges = cursor.all("""
+        SELECT id FROM exchanges WHERE id > %(exchanges)s
+         UNION
+        SELECT refund_ref FROM exchanges WHERE id > %(exchanges)s AND refund_ref IS NOT NULL
+    """, state)
+    checks = [(_check_tips, (checked_tips_until,))]
+    if participants:
+        checks.append((_check_balances_against_checkpoints, (participants, state)))
+        checks.append((_check_bundles_against_balances, (participants,)))
+        checks.append((_check_cash_bundle_totals, (participants,)))
+    if exchanges:
+        checks.append((_check_bundles_grouped_by_origin_against_exchanges, (exchanges,)))
+        checks.append((_check_bundles_grouped_by_withdrawal_against_exchanges, (exchanges,)))
+    durations = _run_checks(cursor, checks)
+    _advance_tips_checkpoint(cursor, last_tip)
+    return durations
+
+
+def reset_checkpoints(cursor, last_tip):
+    """Recompute the checkpoints from scratch, after a successful `check_db`.
+
+    `last_tip` is the ID of the last tip that existed when the check started.
+    """
+    _advance_balance_checkpoints(cursor, rebuild=True)
+    _advance_tips_checkpoint(cursor, last_tip)
+
+
+def _advance_balance_checkpoints(cursor, rebuild=False):
+    """Move the watermarks of the balance checkpoints as far as is safe.
 
+    Every check records the current values of the ID sequences of the
+    `exchanges` and `transfers` tables as the `pending` watermarks. A later
+    check moves the watermarks up to them once all the transactions that were
+    running when they were recorded have ended, as the rows they inserted are
+    then visible. The watermarks also stop below the first exchange or transfer
+    that isn't in a final state, since its effect on the balances can still
+    change.
 
-def _check_tips(cursor):
+    The checkpoints are updated with the rows that the watermarks move past, or
+    recomputed from scratch if `rebuild` is true.
+
+    Returns the new state, a dict containing the `exchanges` and `transfers`
+    watermarks.
+    """
+    state = cursor.one("""
+        SELECT value
+          FROM db_meta
+         WHERE key = 'balance_checkpoints'
+           FOR UPDATE
+    """)
+    old = dict(exchanges=state['exchanges'], transfers=state['transfers'])
+    pending = state['pending']
+    settled = pending and cursor.one("""
+        SELECT coalesce(min(xact_start) > %s::timestamptz, true)
+          FROM pg_stat_activity
+         WHERE usename = current_user
+           AND pid <> pg_backend_pid()
+    """, (pending['since'],))
+    if settled:
+        state['exchanges'], state['transfers'] = cursor.one("""
+            SELECT coalesce((
+                       SELECT min(id) - 1
+                         FROM exchanges
+                        WHERE id > %(old_exchanges)s AND id <= %(exchanges)s
+                          AND status IN ('pre', 'created', 'pre-mandate')
+                   ), %(exchanges)s)
+                 , coalesce((
+                       SELECT min(id) - 1
+                         FROM transfers
+                        WHERE id > %(old_transfers)s AND id <= %(transfers)s
+                          AND status = 'pre'
+                   ), %(transfers)s)
+        """, dict(pending, old_exchanges=old['exchanges'], old_transfers=old['transfers']))
+        pending = None
+    if rebuild:
+        cursor.run("""
+            DELETE FROM balance_checkpoints;
+            INSERT INTO balance_checkpoints
+                        (participant, expected_balance)
+                 SELECT id, expected
+                   FROM ({0}) x;
+        """.format(_EXPECTED_BALANCES.format(
+            exchanges_filter='and id <= %(exchanges)s',
+            transfers_filter='and id <= %(transfers)s',
+        )), state)
+    elif settled:
+        cursor.run("""
+            INSERT INTO balance_checkpoints AS c
+                        (participant, expected_balance)
+                 SELECT id, expected
+                   FROM ({0}) x
+            ON CONFLICT (participant) DO UPDATE
+                    SET expected_balance = c.expected_balance + excluded.expected_balance
+        """.format(_EXPECTED_BALANCES.format(
+            exchanges_filter='and id > %(old_exchanges)s and id <= %(exchanges)s',
+            transfers_filter='and id > %(old_transfers)s and id <= %(transfers)s',
+        )), dict(state, old_exchanges=old['exchanges'], old_transfers=old['transfers']))
+    if pending is None:
+        # The timestamp is taken after the sequences have been read
+        pending = dict(zip(('exchanges', 'transfers', 'since'), cursor.one("""
+            SELECT (SELECT last_value FROM exchanges_id_seq)
+                 , (SELECT last_value FROM transfers_id_seq)
+                 , clock_timestamp()::text
+        """)))
+    state['pending'] = pending
+    cursor.run("""
+        UPDATE db_meta
+           SET value = %s::jsonb
+         WHERE key = 'balance_checkpoints'
+    """, (json.dumps(state),))
+    return state
+
+
+def _get_last_tip_id(cursor):
+    return cursor.one("SELECT coalesce(max(id), 0) FROM tips")
+
+
+def _advance_tips_checkpoint(cursor, last_tip):
+    cursor.run("""
+        UPDATE db_meta
+           SET value = to_jsonb(%s)
+         WHERE key = 'checked_tips_until'
+    """, (last_tip,))
+
+
+def _check_tips(cursor, after=None):
     """
     Checks that there are no rows in tips with duplicate (tipper, tippee, mtime).
 
+    If `after` is given, only the tips whose ID is greater than it are checked.
+
     https://github.com/gratipay/gratipay.com/issues/1704
     """
+    if after is not None:
+        conflicting_tips = cursor.one("""
+            SELECT count(*)
+              FROM tips t
+             WHERE t.id > %s
+               AND EXISTS (
+                       SELECT 1
+                         FROM tips t2
+                        WHERE t2.tipper = t.tipper
+                          AND t2.tippee = t.tippee
+                          AND t2.mtime = t.mtime
+                          AND t2.id <> t.id
+                   )
+        """, (after,))
+        assert conflicting_tips == 0, conflicting_tips
+        return
     conflicting_tips = cursor.one("""
         SELECT count(*)
           FROM
@@ -64,6 +284,47 @@ def _check_tips(cursor):
     assert conflicting_tips == 0, conflicting_tips
 
 
+# The balances computed from the history of transfers and exchanges
+_EXPECTED_BALANCES = """
+    select id, sum(a) as expected
+      from (
+              select participant as id, sum(amount - (CASE WHEN (fee < 0) THEN fee ELSE 0 END)) as a
+                from exchanges
+               where amount > 0
+                 and status = 'succeeded'
+                 {exchanges_filter}
+            group by participant
+
+               union all
+
+              select participant as id, sum(amount - (CASE WHEN (fee > 0) THEN fee ELSE 0 END)) as a
+                from exchanges
+               where amount < 0
+                 and status <> 'failed'
+                 {exchanges_filter}
+            group by participant
+
+               union all
+
+              select tipper as id, sum(-amount) as a
+                from transfers
+               where status = 'succeeded'
+                 {transfers_filter}
+            group by tipper
+
+               union all
+
+              select tippee as id, sum(amount) as a
+                from transfers
+               where status = 'succeeded'
+                 {transfers_filter}
+            group by tippee
+            ) as foo
+    group by id
+"""
+EXPECTED_BALANCES = _EXPECTED_BALANCES.format(exchanges_filter='', transfers_filter='')
+
+
 def _check_balances_against_transactions(cursor):
     """
     Recalculates balances for all participants from transfers and exchanges.
@@ -72,46 +333,33 @@ def _check_balances_against_transactions(cursor):
     """
     b = cursor.all("""
         select p.id, expected, balance as actual
-          from (
-            select id, sum(a) as expected
-              from (
-                      select participant as id, sum(amount - (CASE WHEN (fee < 0) THEN fee ELSE 0 END)) as a
-                        from exchanges
-                       where amount > 0
-                         and status = 'succeeded'
-                    group by participant
-
-                       union all
-
-                      select participant as id, sum(amount - (CASE WHEN (fee > 0) THEN fee ELSE 0 END)) as a
-                        from exchanges
-                       where amount < 0
-                         and status <> 'failed'
-                    group by participant
-
-                       union all
-
-                      select tipper as id, sum(-amount) as a
-                        from transfers
-                       where status = 'succeeded'
-                    group by tipper
-
-                       union all
-
-                      select tippee as id, sum(amount) as a
-                        from transfers
-                       where status = 'succeeded'
-                    group by tippee
-                    ) as foo
-            group by id
-          ) as foo2
+          from ({0}) as foo2
         join participants p on p.id = foo2.id
         where expected <> p.balance
-    """)
+    """.format(EXPECTED_BALANCES))
+    assert len(b) == 0, "conflicting balances:\n" + '\n'.join(str(r) for r in b)
+
+
+def _check_balances_against_checkpoints(cursor, participants, watermarks):
+    """Check the balances of the given participants against their checkpoints
+    plus the exchanges and transfers above the watermarks.
+    """
+    b = cursor.all("""
+        SELECT p.id, coalesce(c.expected_balance, 0) + coalesce(d.expected, 0) AS expected
+             , p.balance AS actual
+          FROM participants p
+     LEFT JOIN balance_checkpoints c ON c.participant = p.id
+     LEFT JOIN ({0}) d ON d.id = p.id
+         WHERE p.id = ANY(%(participants)s)
+           AND coalesce(c.expected_balance, 0) + coalesce(d.expected, 0) <> p.balance
+    """.format(_EXPECTED_BALANCES.format(
+        exchanges_filter='and id > %(exchanges)s',
+        transfers_filter='and id > %(transfers)s',
+    )), dict(watermarks, participants=participants))
     assert len(b) == 0, "conflicting balances:\n" + '\n'.join(str(r) for r in b)
 
 
-def _check_bundles_against_balances(cursor):
+def _check_bundles_against_balances(cursor, participants=None):
     """Check that balances and cash bundles are coherent.
     """
     b = cursor.all("""
@@ -119,15 +367,74 @@ def _check_bundles_against_balances(cursor):
           FROM (
               SELECT owner, sum(amount) AS bundles_total
                 FROM cash_bundles b
+               WHERE (%(ids)s IS NULL OR b.owner = ANY(%(ids)s))
             GROUP BY owner
           ) foo
           JOIN participants p ON p.id = owner
          WHERE bundles_total <> balance
-    """)
+    """, dict(ids=participants))
     assert len(b) == 0, "bundles are out of whack:\n" + '\n'.join(str(r) for r in b)
 
 
-def _check_bundles_grouped_by_origin_against_exchanges(cursor):
+def _check_cash_bundle_totals(cursor, participants=None):
+    """Check that the `cash_bundle_totals` table is coherent with the bundles.
+    """
+    l = cursor.all("""
+        SELECT coalesce(t.owner, b.owner) AS owner, t.available, b.available AS expected
+          FROM ( SELECT owner, available
+                   FROM cash_bundle_totals
+                  WHERE (%(ids)s IS NULL OR owner = ANY(%(ids)s))
+               ) t
+     FULL JOIN ( SELECT owner, sum(amount) AS available
+                   FROM cash_bundles
+                  WHERE owner IS NOT NULL
+                    AND disputed IS NOT TRUE
+                    AND locked_for IS NULL
+                    AND (%(ids)s IS NULL OR owner = ANY(%(ids)s))
+               GROUP BY owner
+               ) b ON b.owner = t.owner
+         WHERE coalesce(t.available, 0) <> coalesce(b.available, 0)
+    """, dict(ids=participants))
+    assert len(l) == 0, "bundle totals are out of whack:\n" + '\n'.join(str(r) for r in l)
+
+
+def _check_current_takes(cursor):
+    """Check that the `current_takes` table is coherent with the `takes` table.
+    """
+    l = cursor.all("""
+        SELECT coalesce(c.team, x.team) AS team, coalesce(c.member, x.member) AS member
+             , c.amount AS current, x.amount AS expected
+          FROM current_takes c
+     FULL JOIN ( SELECT *
+                   FROM ( SELECT DISTINCT ON (team, member) t.*
+                            FROM takes t
+                        ORDER BY team, member, mtime DESC, id DESC
+                        ) x
+                  WHERE x.amount IS NOT NULL
+               ) x ON x.team = c.team AND x.member = c.member
+         WHERE c.amount IS DISTINCT FROM x.amount
+    """)
+    assert len(l) == 0, "current_takes is out of whack:\n" + '\n'.join(str(r) for r in l)
+
+
+def _check_current_tips(cursor):
+    """Check that the `current_tips` table is coherent with the `tips` table.
+    """
+    l = cursor.all("""
+        SELECT coalesce(c.tipper, x.tipper) AS tipper, coalesce(c.tippee, x.tippee) AS tippee
+             , c.id AS current, x.id AS expected
+          FROM current_tips c
+     FULL JOIN ( SELECT DISTINCT ON (tipper, tippee) t.*
+                   FROM tips t
+               ORDER BY tipper, tippee, mtime DESC, id DESC
+               ) x ON x.tipper = c.tipper AND x.tippee = c.tippee
+         WHERE (c.id, c.amount, c.is_funded, c.periodic_amount) IS DISTINCT FROM
+               (x.id, x.amount, x.is_funded, x.periodic_amount)
+    """)
+    assert len(l) == 0, "current_tips is out of whack:\n" + '\n'.join(str(r) for r in l)
+
+
+def _check_bundles_grouped_by_origin_against_exchanges(cursor, exchanges=None):
     """Check that bundles grouped by origin are coherent with exchanges.
     """
     l = cursor.all("""
@@ -147,24 +454,27 @@ def _check_bundles_grouped_by_origin_against_exchanges(cursor):
                   SELECT b.origin, sum(b.amount) as in_wallets
                     FROM cash_bundles b
                    WHERE b.withdrawal IS NULL
+                     AND (%(ids)s IS NULL OR b.origin = ANY(%(ids)s))
                 GROUP BY b.origin
                ) AS b ON b.origin = e.id
           LEFT JOIN (
                   SELECT b2.origin, sum(b2.amount) as withdrawn
                     FROM cash_bundles b2
                    WHERE b2.withdrawal IS NOT NULL
+                     AND (%(ids)s IS NULL OR b2.origin = ANY(%(ids)s))
                 GROUP BY b2.origin
                ) AS b2 ON b2.origin = e.id
+         WHERE (%(ids)s IS NULL OR e.id = ANY(%(ids)s))
         )
         SELECT *
           FROM r
          WHERE total_expected <> total_found
       ORDER BY e_id
-    """)
+    """, dict(ids=exchanges))
     assert len(l) == 0, "bundles are out of whack:\n" + '\n'.join(str(r) for r in l)
 
 
-def _check_bundles_grouped_by_withdrawal_against_exchanges(cursor):
+def _check_bundles_grouped_by_withdrawal_against_exchanges(cursor, exchanges=None):
     """Check that bundles grouped by withdrawal are coherent with exchanges.
     """
     l = cursor.all("""
@@ -184,14 +494,16 @@ def _check_bundles_grouped_by_withdrawal_against_exchanges(cursor):
           LEFT JOIN (
                   SELECT b.withdrawal, sum(b.amount) as withdrawn
                     FROM cash_bundles b
+                   WHERE (%(ids)s IS NULL OR b.withdrawal = ANY(%(ids)s))
                 GROUP BY b.withdrawal
                ) AS b ON b.withdrawal = e.id
+         WHERE (%(ids)s IS NULL OR e.id = ANY(%(ids)s))
         )
         SELECT *
           FROM r
          WHERE total_expected <> total_found
       ORDER BY e_id
-    """)
+    """, dict(ids=exchanges))
     assert len(l) == 0, "bundles are out of whack:\n" + '\n'.join(str(r) for r in l)
 
 
@@ -269,9 +581,7 @@ DB.show_table = SimpleCursorBase.show_table = show_table
 
 def hit_rate_limit(db, key_prefix, key_unique, exception=None):
     try:
-        cap, period = RATE_LIMITS[key_prefix]
-        key = '%s:%s' % (key_prefix, key_unique)
-        r = db.one("SELECT hit_rate_limit(%s, %s, %s)", (key, cap, period))
+        r = rate_limiter.hit(db, key_prefix, key_unique)
     except Exception as e:
         from liberapay.website import website
         website.tell_sentry(e, {})
@@ -292,12 +602,113 @@ def clean_up_counters(db):
 DB.clean_up_counters = clean_up_counters
 
 
+def sync_rate_limits(db):
+    return rate_limiter.flush(db)
+
+DB.sync_rate_limits = sync_rate_limits
+
+
+EXPLORE_LISTS = {
+    'individuals': """
+        SELECT row_number() OVER (ORDER BY p.receiving DESC, p.join_time DESC, p.id DESC) AS rank
+             , p.id AS participant, NULL::int AS nmembers, NULL::timestamptz AS ctime
+             , p.receiving, p.join_time
+          FROM participants p
+         WHERE p.kind = 'individual'
+           AND p.status = 'active'
+           AND (p.goal > 0 OR p.goal IS NULL)
+           AND p.hide_receiving IS NOT TRUE
+           AND p.hide_from_lists = 0
+           AND p.receiving > 0
+           AND EXISTS (SELECT 1 FROM statements s WHERE s.participant = p.id)
+    """,
+    'organizations': """
+        SELECT row_number() OVER (ORDER BY p.receiving DESC, p.join_time DESC, p.id DESC) AS rank
+             , p.id AS participant, NULL::int AS nmembers, NULL::timestamptz AS ctime
+             , p.receiving, p.join_time
+          FROM participants p
+         WHERE p.kind = 'organization'
+           AND p.status = 'active'
+           AND (p.goal > 0 OR p.goal IS NULL)
+           AND p.hide_receiving IS NOT TRUE
+           AND p.hide_from_lists = 0
+           AND p.receiving > 0
+           AND EXISTS (SELECT 1 FROM statements s WHERE s.participant = p.id)
+    """,
+    'teams': """
+        SELECT row_number() OVER (ORDER BY p.receiving DESC, p.join_time DESC, p.id DESC) AS rank
+             , p.id AS participant, t.nmembers::int, NULL::timestamptz AS ctime
+             , p.receiving, p.join_time
+          FROM ( SELECT team AS id, count(member) AS nmembers
+                   FROM current_takes
+               GROUP BY team
+                ) AS t
+          JOIN participants p ON p.id = t.id
+         WHERE (p.goal >= 0 OR p.goal IS NULL)
+           AND p.hide_from_lists = 0
+    """,
+    'pledges': """
+        SELECT row_number() OVER (ORDER BY x.ctime DESC, x.participant DESC) AS rank
+             , x.participant, NULL::int AS nmembers, x.ctime
+             , NULL::numeric AS receiving, NULL::timestamptz AS join_time
+          FROM ( SELECT p.id AS participant
+                      , ( SELECT ctime
+                            FROM current_tips
+                           WHERE tippee = p.id
+                        ORDER BY ctime DESC
+                           LIMIT 1
+                        ) AS ctime
+                   FROM participants p
+                  WHERE p.status = 'stub'
+                    AND p.receiving > 0
+                    AND p.hide_from_lists = 0
+               ) x
+    """,
+    'communities': """
+        SELECT row_number() OVER (ORDER BY c.nmembers DESC, random()) AS rank
+             , c.participant, c.nmembers, c.ctime
+             , NULL::numeric AS receiving, NULL::timestamptz AS join_time
+          FROM communities c
+          JOIN participants cp ON cp.id = c.participant
+         WHERE cp.hide_from_lists = 0
+    """,
+}
+EXPLORE_LISTS_MAX_SIZE = 1000
+
+
+def refresh_explore_lists(db):
+    """Rebuild the precomputed lists that the `/explore/` pages read from.
+
+    Each list is replaced atomically, so readers see either the old or the new
+    version, never a mix of both. The pages are paginated on the values that
+    the lists are sorted by, not on the ranks, so that a refresh doesn't shift
+    the next page of someone who's browsing a list.
+    """
+    for name, query in sorted(EXPLORE_LISTS.items()):
+        with db.get_cursor() as cursor:
+            cursor.run("DELETE FROM explore_listings WHERE list = %s", (name,))
+            cursor.run("""
+                INSERT INTO explore_listings
+                            (list, rank, participant, nmembers, ctime, receiving, join_time)
+                     SELECT %s, x.rank, x.participant, x.nmembers, x.ctime, x.receiving, x.join_time
+                       FROM ({0}) x
+                   ORDER BY x.rank
+                      LIMIT %s
+            """.format(query), (name, EXPLORE_LISTS_MAX_SIZE))
+
+DB.refresh_explore_lists = refresh_explore_lists
+
+
 if __name__ == '__main__':
     from liberapay import wireup
     db = wireup.minimal_algorithm.run()['db']
+    if sys.argv[1:] == ['check']:
+        print('Checking DB...')
+        db.self_check(full=True)
+        sys.exit(0)
     print('Checking DB...')
-    db.self_check()
+    check_db(db)
     r = run_migrations(db)
     if r:
         print('Checking DB...')
-        db.self_check()
+        db.self_check(full=True)
@@ -17,6 +17,9 @@ class InactiveParticipantAdded(Exception): pass
 
 class MixinTeam(object):
 
+    # Bumped by the methods that modify the takes, see `compute_actual_takes`
+    _takes_version = 0
+
     def invite(self, invitee, inviter):
         assert self.kind == 'group'
         with self.db.get_cursor() as c:
@@ -39,6 +42,7 @@ class MixinTeam(object):
         self.set_take_for(member, D_ZERO, self, cursor=cursor)
 
     def remove_all_members(self, cursor=None):
+        self._takes_version += 1
         (cursor or self.db).run("""
             INSERT INTO takes (ctime, member, team, amount, recorder) (
                 SELECT ctime, member, %(id)s, NULL, %(id)s
@@ -118,6 +122,7 @@ class MixinTeam(object):
         if not isinstance(take, (None.__class__, Decimal)):
             take = Decimal(take)
 
+        self._takes_version += 1
         with self.db.get_cursor(cursor) as cursor:
             # Lock to avoid race conditions
             cursor.run("LOCK TABLE takes IN EXCLUSIVE MODE")
@@ -196,9 +201,24 @@ class MixinTeam(object):
 
     def compute_actual_takes(self, cursor=None):
         """Get the takes, compute the actual amounts, and return an OrderedDict.
+
+        When no cursor is given the result is cached on the object, keyed by
+        the version of the takes and the team's income, so that a request
+        doesn't fetch the takes more than once. Calls with a cursor always
+        read the takes from the database, they're part of a transaction.
         """
+        if cursor is None:
+            key = (self._takes_version, self.receiving)
+            cached = self.__dict__.get('_actual_takes')
+            if cached and cached[0] == key:
+                return cached[1]
+            actual_takes = self._compute_actual_takes(self.get_current_takes())
+            self._actual_takes = (key, actual_takes)
+            return actual_takes
+        return self._compute_actual_takes(self.get_current_takes(cursor=cursor))
+
+    def _compute_actual_takes(self, nominal_takes):
         actual_takes = OrderedDict()
-        nominal_takes = self.get_current_takes(cursor=cursor)
         balance = self.receiving
         total_takes = sum(t['amount'] for t in nominal_takes if t['is_identified'])
         ratio = min(balance / total_takes, 1) if total_takes else 0
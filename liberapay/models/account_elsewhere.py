@@ -3,14 +3,12 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from datetime import timedelta
 import json
 import uuid
-import xml.etree.ElementTree as ET
 
 from six.moves.urllib.parse import urlsplit, urlunsplit
 
 from pando.utils import utcnow
 from postgres.orm import Model
 from psycopg2 import IntegrityError
-import xmltodict
 
 from liberapay.constants import AVATAR_QUERY
 from liberapay.elsewhere._exceptions import BadUserId, UserNotFound
@@ -71,8 +69,18 @@ class AccountElsewhere(Model):
 
     @classmethod
     def get_many(cls, platform, user_infos):
-        accounts = []
-        found = cls.db.all("""\
+        """Return the accounts corresponding to the given `user_infos`, in the
+        same order, creating the ones that aren't in the database yet.
+        """
+        found = cls._get_many(cls.db, platform, user_infos)
+        missing = [i for i in user_infos if (i.user_id, i.domain) not in found]
+        if missing:
+            found.update(cls.upsert_many(platform, missing))
+        return [found[(i.user_id, i.domain)] for i in user_infos]
+
+    @staticmethod
+    def _get_many(cursor, platform, user_infos):
+        found = cursor.all("""\
 
             SELECT (e, p)::elsewhere_with_participant
               FROM elsewhere e
@@ -81,17 +89,88 @@ class AccountElsewhere(Model):
              WHERE e.platform = %s
 
         """, (json.dumps([[i.user_id, i.domain] for i in user_infos]), platform))
-        found = {(a.user_id, a.domain): a for a in found}
-        for i in user_infos:
-            if (i.user_id, i.domain) in found:
-                accounts.append(found[(i.user_id, i.domain)])
-            else:
-                accounts.append(cls.upsert(i))
-        return accounts
+        return {(a.user_id, a.domain): a for a in found}
 
     @classmethod
-    def upsert(cls, i):
-        """Insert or update a user's info.
+    def upsert_many(cls, platform, user_infos):
+        """Insert the accounts of many users at once.
+
+        The stub participants and the `elsewhere` rows are created by a single
+        statement. Accounts which conflict with an existing row (e.g. a user
+        who changed their name) fall back to the slower `upsert` method.
+
+        Returns a dict of accounts keyed by `(user_id, domain)`.
+        """
+        new, fallback, seen = [], [], set()
+        for i in user_infos:
+            k = (i.user_id, i.domain)
+            if k in seen:
+                continue
+            seen.add(k)
+            (new if i.user_id else fallback).append(i)
+        if new:
+            rows = []
+            for i in new:
+                # `upsert` modifies its argument, so we work on a copy here
+                c = i.__class__(**i.__dict__)
+                cls._clean_user_info(c)
+                rows.append((c.user_id, c.user_name, c.domain, c.display_name,
+                             c.email, c.avatar_url, bool(c.is_team), c.extra_info))
+            columns = [list(c) for c in zip(*rows)]
+            with cls.db.get_cursor() as cursor:
+                orphans = cursor.all("""
+                    WITH new AS (
+                             SELECT *
+                               FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[],
+                                           %s::text[], %s::text[], %s::boolean[], %s::json[])
+                                 AS t(user_id, user_name, domain, display_name,
+                                      email, avatar_url, is_team, extra_info)
+                         )
+                       , missing AS (
+                             SELECT new.*, nextval('participants_id_seq') AS participant
+                               FROM new
+                              WHERE NOT EXISTS (
+                                        SELECT 1
+                                          FROM elsewhere e
+                                         WHERE e.platform = %s
+                                           AND e.domain = new.domain
+                                           AND ( e.user_id = new.user_id OR
+                                                 lower(e.user_name) = lower(new.user_name) )
+                                    )
+                         )
+                       , stubs AS (
+                             INSERT INTO participants (id, avatar_url)
+                                  SELECT participant, avatar_url
+                                    FROM missing
+                         )
+                       , inserted AS (
+                             INSERT INTO elsewhere
+                                         (participant, platform, user_id, user_name, domain,
+                                          display_name, email, avatar_url, is_team, extra_info)
+                                  SELECT participant, %s, user_id, user_name, domain,
+                                         display_name, email, avatar_url, is_team, extra_info
+                                    FROM missing
+                             ON CONFLICT DO NOTHING
+                               RETURNING participant
+                         )
+                  SELECT m.participant
+                    FROM missing m
+                   WHERE NOT EXISTS (SELECT 1 FROM inserted i WHERE i.participant = m.participant)
+                """, columns + [platform, platform])
+                if orphans:
+                    # Rows were inserted concurrently, drop the useless stubs
+                    cursor.run("DELETE FROM participants WHERE id IN %s", (tuple(orphans),))
+                found = cls._get_many(cursor, platform, new)
+            fallback.extend(i for i in new if (i.user_id, i.domain) not in found)
+        else:
+            found = {}
+        for i in fallback:
+            found[(i.user_id, i.domain)] = cls.upsert(i)
+        return found
+
+    @staticmethod
+    def _clean_user_info(i):
+        """Prepare a `UserInfo` object for insertion into the database.
         """
 
         # Clean up avatar_url
@@ -105,10 +184,13 @@ class AccountElsewhere(Model):
             i.avatar_url = urlunsplit((scheme, netloc, path, query, fragment))
 
         # Serialize extra_info
-        if isinstance(i.extra_info, ET.Element):
-            i.extra_info = xmltodict.parse(ET.tostring(i.extra_info))
         i.extra_info = json.dumps(i.extra_info)
 
+    @classmethod
+    def upsert(cls, i):
+        """Insert or update a user's info.
+        """
+        cls._clean_user_info(i)
         cols, vals = zip(*i.__dict__.items())
         cols = ', '.join(cols)
         placeholders = ', '.join(['%s']*len(vals))
@@ -152,6 +234,20 @@ class AccountElsewhere(Model):
         account.participant.update_avatar()
         return account
 
+    @classmethod
+    def upsert_if_changed(cls, i):
+        """Like `upsert`, but skips the write if we already have the account
+        and its `extra_info` hasn't changed.
+        """
+        if i.user_id and isinstance(i.extra_info, dict):
+            try:
+                account = cls._from_thing('user_id', i.platform, i.user_id, i.domain)
+            except UnknownAccountElsewhere:
+                account = None
+            if account and account.extra_info == json.loads(json.dumps(i.extra_info)):
+                return account
+        return cls.upsert(i)
+
 
     # Connect tokens
     # ==============
@@ -272,7 +368,7 @@ def get_account_elsewhere(website, state, api_lookup=True):
         if not account and not api_lookup:
             raise response.error(404)
         try:
-            user_info = platform.get_user_info(domain, key, uid)
+            user_info = platform.get_user_info_cached(domain, key, uid)
         except NotImplementedError as e:
             raise response.error(400, e.args[0])
         except (BadUserId, UserNotFound) as e:
@@ -284,5 +380,5 @@ def get_account_elsewhere(website, state, api_lookup=True):
             err = _("There doesn't seem to be a user named {0} on {1}.",
                     uid, platform.display_name)
             raise response.error(404, err)
-        account = AccountElsewhere.upsert(user_info)
+        account = AccountElsewhere.upsert_if_changed(user_info)
     return platform, account
@@ -67,17 +67,22 @@ class Community(Model):
     def pretty_name(self):
         return self.name.replace('_', ' ')
 
-    def get_members(self, limit=None, offset=None):
-        return self.db.all("""
-            SELECT p.*::participants
+    def get_members(self, per_page=50, after=None, before=None):
+        """Returns a `Page` of `(ctime, participant)` records.
+        """
+        from liberapay.utils.pagination import Keyset  # avoid circular import
+        keyset = Keyset([('cm.ctime', 'timestamptz'), ('cm.participant', 'bigint')])
+        return keyset.paginate(self.db, """
+            SELECT cm.ctime, p.*::participants AS participant
               FROM community_memberships cm
               JOIN participants p ON p.id = cm.participant
-             WHERE cm.community = %s
+             WHERE cm.community = %(c_id)s
                AND cm.is_on
-          ORDER BY cm.ctime
-             LIMIT %s
-            OFFSET %s;
-        """, (self.id, limit, offset))
+               AND {condition}
+          ORDER BY {order_by}
+             LIMIT {limit}
+        """, dict(c_id=self.id), lambda m: (m.ctime, m.participant.id),
+            per_page, after, before)
 
     def check_membership_status(self, participant):
         return self.db.one("""
@@ -1,11 +1,14 @@
 from __future__ import print_function, unicode_literals
 
 from base64 import b64decode, b64encode
-from decimal import Decimal, ROUND_DOWN, ROUND_UP
+from calendar import timegm
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_DOWN, ROUND_UP
 from email.utils import formataddr
-from hashlib import pbkdf2_hmac, md5
+from hashlib import pbkdf2_hmac, md5, sha256
+import hmac
 from os import urandom
-from time import sleep
+from time import sleep, time
 import uuid
 
 from six.moves.urllib.parse import quote, urlencode
@@ -14,7 +17,7 @@ import aspen_jinja2_renderer
 from html2text import html2text
 import mangopay
 from markupsafe import escape as htmlescape
-from pando.utils import utcnow
+from pando.utils import utc, utcnow
 from postgres.orm import Model
 from psycopg2 import IntegrityError
 from psycopg2.extras import Json
@@ -34,6 +37,7 @@ from liberapay.exceptions import (
     EmailAlreadyAttachedToSelf,
     EmailAlreadyTaken,
     EmailNotVerified,
+    LazyResponse,
     NonexistingElsewhere,
     NoSelfTipping,
     NoTippee,
@@ -53,7 +57,7 @@ from liberapay.exceptions import (
 from liberapay.models._mixin_team import MixinTeam
 from liberapay.models.account_elsewhere import AccountElsewhere
 from liberapay.models.community import Community
-from liberapay.security.crypto import constant_time_compare
+from liberapay.security.crypto import check_signature, constant_time_compare, sign
 from liberapay.utils import (
     deserialize, erase_cookie, serialize, set_cookie,
     emails, i18n, markdown,
@@ -68,6 +72,14 @@ class Participant(Model, MixinTeam):
     ANON = False
     EMAIL_VERIFICATION_TIMEOUT = EMAIL_VERIFICATION_TIMEOUT
 
+    # Recent successful password verifications, {participant_id: (mac, expires)}
+    _password_cache = {}
+    _password_cache_key = urandom(32)
+    _password_cache_size = 10000
+
+    # Set by `authenticate_signed_session`, `(generation, expires, flags)`
+    signed_session = None
+
     def __eq__(self, other):
         if not isinstance(other, Participant):
             return False
@@ -216,13 +228,39 @@ class Participant(Model, MixinTeam):
             if not p.password:
                 return
             cls.db.hit_rate_limit('log-in.password', p.id, TooManyPasswordLogins)
-            algo, rounds, salt, hashed = p.password.split('$', 3)
-            rounds = int(rounds)
-            salt, hashed = b64decode(salt), b64decode(hashed)
-            if constant_time_compare(cls._hash_password(v2, algo, salt, rounds), hashed):
+            if p.check_password(v2):
                 p.authenticated = True
                 return p
 
+    @classmethod
+    def authenticate_signed_session(cls, p_id, generation, expires, flags, signature):
+        """Check a session cookie created by `sign_in` in signed mode.
+
+        The signature and expiration date are checked before the database is
+        queried, so forged and expired cookies cost nothing. A valid cookie is
+        then only rejected if the participant's `session_generation` has been
+        bumped since it was issued.
+        """
+        key = website.env.session_signing_key
+        if not key:
+            return
+        msg = ':'.join((p_id, generation, expires, flags))
+        if not check_signature(key, msg, signature):
+            return
+        try:
+            p_id, generation, expires = int(p_id), int(generation), int(expires)
+        except ValueError:
+            return
+        expires = datetime.fromtimestamp(expires, utc)
+        if expires < utcnow():
+            return
+        p = cls._from_thing('id', p_id)
+        if not p or p.session_generation != generation:
+            return
+        p.signed_session = (generation, expires, flags)
+        p.authenticated = True
+        return p
+
     @classmethod
     def get_chargebacks_account(cls):
         r = cls.db.one("""
@@ -255,6 +293,57 @@ class Participant(Model, MixinTeam):
     def _hash_password(password, algo, salt, rounds):
         return pbkdf2_hmac(algo, password.encode('utf8'), salt, rounds)
 
+    def _password_mac(self, password):
+        msg = '%i$%s$%s' % (self.id, self.password, password)
+        return hmac.new(self._password_cache_key, msg.encode('utf8'), sha256).digest()
+
+    def check_password(self, password):
+        """Returns `True` if `password` matches the participant's password hash.
+
+        Successful verifications are cached in memory for `password_cache_ttl`
+        seconds, so that API clients which send their credentials with every
+        request don't cost us a PBKDF2 computation each time.
+
+        The password is rehashed if the number of rounds isn't the one
+        currently configured.
+        """
+        now = time()
+        cached = self._password_cache.get(self.id)
+        if cached and cached[1] > now:
+            if constant_time_compare(cached[0], self._password_mac(password)):
+                return True
+        algo, rounds, salt, hashed = self.password.split('$', 3)
+        rounds = int(rounds)
+        salt, hashed = b64decode(salt), b64decode(hashed)
+        if not constant_time_compare(self._hash_password(password, algo, salt, rounds), hashed):
+            return False
+        if rounds != website.app_conf.password_rounds:
+            self._rehash_password(password)
+        ttl = website.app_conf.password_cache_ttl
+        if ttl > 0:
+            cache = self._password_cache
+            if len(cache) >= self._password_cache_size:
+                for k, v in list(cache.items()):
+                    if v[1] <= now:
+                        cache.pop(k, None)
+                if len(cache) >= self._password_cache_size:
+                    cache.clear()
+            cache[self.id] = (self._password_mac(password), now + ttl)
+        return True
+
+    def _rehash_password(self, password):
+        try:
+            hashed = self.hash_password(password)
+        except BadPasswordSize:
+            return
+        self.db.run("""
+            UPDATE participants
+               SET password = %s
+             WHERE id = %s
+               AND password = %s
+        """, (hashed, self.id, self.password))
+        self.set_attributes(password=hashed)
+
     @classmethod
     def hash_password(cls, password):
         l = len(password)
@@ -282,6 +371,7 @@ class Participant(Model, MixinTeam):
                      , password_mtime = CURRENT_TIMESTAMP
                  WHERE id = %(p_id)s;
             """, locals())
+        self._password_cache.pop(p_id, None)
 
 
     # Session Management
@@ -314,14 +404,43 @@ class Participant(Model, MixinTeam):
 
     def sign_in(self, cookies, suffix=''):
         assert self.authenticated
+        if website.env.session_signing_key:
+            # The generation may have been bumped since this object was loaded,
+            # e.g. by signing out another instance of the same participant
+            generation = self.db.one("""
+                SELECT session_generation FROM participants WHERE id = %s
+            """, (self.id,))
+            self.set_attributes(session_generation=generation)
+            if self.session_token:
+                # Invalidate the login link the user may have received
+                self.update_session(None, None)
+            flags = 'em' if suffix == '.em' else ''
+            self.set_signed_session_cookie(cookies, self.session_generation, flags)
+            return
         self.start_session(suffix)
         creds = '%s:%s' % (self.id, self.session_token)
         set_cookie(cookies, SESSION, creds, self.session_expires)
 
+    def set_signed_session_cookie(self, cookies, generation, flags):
+        """Give the user a stateless session cookie, signed with the
+        `SESSION_SIGNING_KEY`.
+        """
+        expires = utcnow() + SESSION_TIMEOUT
+        msg = '%i:%i:%i:%s' % (self.id, generation, timegm(expires.timetuple()), flags)
+        creds = msg + ':' + sign(website.env.session_signing_key, msg)
+        set_cookie(cookies, SESSION, creds, expires)
+        self.signed_session = (generation, expires, flags)
+
     def keep_signed_in(self, cookies):
         """Extend the user's current session.
         """
         new_expires = utcnow() + SESSION_TIMEOUT
+        if self.signed_session:
+            # No need to write to the database, we just give a new cookie
+            generation, expires, flags = self.signed_session
+            if new_expires - expires > SESSION_REFRESH:
+                self.set_signed_session_cookie(cookies, generation, flags)
+            return
         if new_expires - self.session_expires > SESSION_REFRESH:
             self.set_session_expires(new_expires)
             token = self.session_token
@@ -330,10 +449,32 @@ class Participant(Model, MixinTeam):
 
     def sign_out(self, cookies):
         """End the user's current session.
+
+        Bumping the session generation revokes all the signed session cookies
+        of the user.
         """
-        self.update_session(None, None)
+        generation = self.db.one("""
+            UPDATE participants
+               SET session_token = NULL
+                 , session_expires = NULL
+                 , session_generation = session_generation + 1
+             WHERE id = %s
+         RETURNING session_generation
+        """, (self.id,))
+        self.set_attributes(
+            session_token=None, session_expires=None, session_generation=generation
+        )
+        self.signed_session = None
         erase_cookie(cookies, SESSION)
 
+    @property
+    def session_from_email(self):
+        """Whether the current session was started by a login link.
+        """
+        if self.signed_session:
+            return self.signed_session[2] == 'em'
+        return (self.session_token or '').endswith('.em')
+
 
     # Permissions
     # ===========
@@ -583,6 +724,7 @@ class Participant(Model, MixinTeam):
                  , avatar_url=NULL
                  , session_token=NULL
                  , session_expires=now()
+                 , session_generation = session_generation + 1
                  , giving=0
                  , receiving=0
                  , npatrons=0
@@ -961,14 +1103,20 @@ class Participant(Model, MixinTeam):
             text_color=website.scss_variables['btn-' + variant + '-color'],
         )
 
-    def get_notifs(self):
-        return self.db.all("""
+    def get_notifs(self, per_page=50, after=None, before=None):
+        """Return a page of web notifications, unread ones first.
+        """
+        from liberapay.utils.pagination import Keyset  # avoid circular import
+        keyset = Keyset([('is_new', 'boolean'), ('id', 'bigint')], descending=True)
+        return keyset.paginate(self.db, """
             SELECT id, event, context, is_new, ts
               FROM notifications
-             WHERE participant = %s
+             WHERE participant = %(p_id)s
                AND web
-          ORDER BY is_new DESC, id DESC
-        """, (self.id,))
+               AND {condition}
+          ORDER BY {order_by}
+             LIMIT {limit}
+        """, dict(p_id=self.id), lambda n: (n.is_new, n.id), per_page, after, before)
 
     def render_notifications(self, state, notifs=None):
         """Render notifications as HTML.
@@ -976,7 +1124,8 @@ class Participant(Model, MixinTeam):
         The `notifs` argument allows rendering arbitrary notifications.
 
         """
-        notifs = notifs or self.get_notifs()
+        if notifs is None:
+            notifs = self.get_notifs()
 
         r = []
         for id, event, notif_context, is_new, ts in notifs:
@@ -1011,14 +1160,7 @@ class Participant(Model, MixinTeam):
     @property
     def withdrawable_balance(self):
         from liberapay.billing.transactions import QUARANTINE
-        return self.db.one("""
-            SELECT COALESCE(sum(amount), 0)
-              FROM cash_bundles
-             WHERE owner = %s
-               AND ts < now() - INTERVAL %s
-               AND disputed IS NOT TRUE
-               AND locked_for IS NULL
-        """, (self.id, QUARANTINE))
+        return self.db.one("SELECT get_withdrawable_balance(%s, %s)", (self.id, QUARANTINE))
 
 
     # Events
@@ -1552,19 +1694,7 @@ class Participant(Model, MixinTeam):
             if not tippee:
                 raise NoTippee(u)
 
-        if self.id == tippee.id:
-            raise NoSelfTipping
-
-        periodic_amount = Decimal(periodic_amount)  # May raise InvalidOperation
-        amount = periodic_amount * PERIOD_CONVERSION_RATES[period]
-
-        if periodic_amount != 0 and amount < DONATION_WEEKLY_MIN or amount > DONATION_WEEKLY_MAX:
-            raise BadAmount(periodic_amount, period)
-
-        amount = amount.quantize(D_CENT, rounding=ROUND_UP)
-
-        if not tippee.accepts_tips and amount != 0:
-            raise UserDoesntAcceptTips(tippee.username)
+        periodic_amount, amount = self._check_tip(tippee, periodic_amount, period)
 
         # Insert tip
         t = (cursor or self.db).one("""\
@@ -1598,6 +1728,122 @@ class Participant(Model, MixinTeam):
         return t
 
 
+    def _check_tip(self, tippee, periodic_amount, period):
+        """Validate a tip, returns the periodic and weekly amounts as Decimals.
+        """
+        if self.id == tippee.id:
+            raise NoSelfTipping
+
+        periodic_amount = Decimal(periodic_amount)  # May raise InvalidOperation
+        amount = periodic_amount * PERIOD_CONVERSION_RATES[period]
+
+        if periodic_amount != 0 and amount < DONATION_WEEKLY_MIN or amount > DONATION_WEEKLY_MAX:
+            raise BadAmount(periodic_amount, period)
+
+        amount = amount.quantize(D_CENT, rounding=ROUND_UP)
+
+        if not tippee.accepts_tips and amount != 0:
+            raise UserDoesntAcceptTips(tippee.username)
+
+        return periodic_amount, amount
+
+
+    def set_tips_bulk(self, tips, prune=False):
+        """Set several tips at once.
+
+        `tips` is a list of `(tippee_username, periodic_amount, period)` tuples.
+        Returns a list of the same length, containing for each tip either the
+        dict of the row inserted in the tips table, or the exception that
+        prevented the tip from being set.
+
+        If the same tippee is listed more than once, the last valid tip wins,
+        and the earlier ones get the same result.
+
+        If `prune` is true, the tips to the participants who aren't in `tips`
+        are set to zero.
+
+        Unlike calling `set_tip_to` in a loop, the tips are inserted by a
+        single query, and the giving and receiving amounts are only updated
+        once, in the same transaction.
+        """
+        assert self.status == 'active'  # sanity check
+
+        tippees = {p.username.lower(): p for p in self.db.all("""
+            SELECT p.*::participants
+              FROM participants p
+             WHERE lower(p.username) = ANY(%s)
+        """, (list(set(t[0].lower() for t in tips)),))}
+
+        results = [None] * len(tips)
+        rows = {}
+        indexes = {}
+        for i, (username, periodic_amount, period) in enumerate(tips):
+            try:
+                tippee = tippees.get(username.lower())
+                if not tippee:
+                    raise NoTippee(username)
+                periodic_amount, amount = self._check_tip(tippee, periodic_amount, period)
+            except (LazyResponse, InvalidOperation, KeyError) as e:
+                results[i] = e
+                continue
+            # Only one row per tippee, otherwise the tips would share an mtime
+            rows[tippee.id] = (tippee.id, amount, period, periodic_amount)
+            indexes.setdefault(tippee.id, []).append(i)
+        rows = list(rows.values())
+        seen = set(p.id for p in tippees.values())
+
+        with self.db.get_cursor() as cursor:
+            inserted = cursor.all("""
+                INSERT INTO tips
+                            (ctime, tipper, tippee, amount, period, periodic_amount)
+                     SELECT COALESCE(t.ctime, CURRENT_TIMESTAMP)
+                          , %(tipper)s, x.tippee, x.amount, x.period::donation_period, x.periodic_amount
+                       FROM unnest(%(tippees)s::bigint[], %(amounts)s::numeric[],
+                                   %(periods)s::text[], %(periodic_amounts)s::numeric[])
+                            AS x(tippee, amount, period, periodic_amount)
+                  LEFT JOIN current_tips t ON t.tipper = %(tipper)s AND t.tippee = x.tippee
+                  RETURNING *
+                          , ( SELECT join_time IS NULL FROM participants WHERE id = tips.tippee ) AS is_pledge
+            """, dict(
+                tipper=self.id,
+                tippees=[r[0] for r in rows],
+                amounts=[r[1] for r in rows],
+                periods=[r[2] for r in rows],
+                periodic_amounts=[r[3] for r in rows],
+            ), back_as=dict)
+            for t in inserted:
+                for i in indexes[t['tippee']]:
+                    results[i] = t
+
+            if prune:
+                inserted += cursor.all("""
+                    INSERT INTO tips
+                                (ctime, tipper, tippee, amount, period, periodic_amount)
+                         SELECT ctime, tipper, tippee, 0, period, 0
+                           FROM current_tips
+                          WHERE tipper = %s
+                            AND amount > 0
+                            AND NOT tippee = ANY(%s)
+                      RETURNING *
+                """, (self.id, list(seen)), back_as=dict)
+
+            updated = self.update_giving(cursor)
+            is_funded = {u.id: u.is_funded for u in updated}
+            for t in inserted:
+                t['is_funded'] = is_funded.get(t['id'], t['is_funded'])
+
+            tippee_ids = set(t['tippee'] for t in inserted) | set(u.tippee for u in updated)
+            for tippee in cursor.all("""
+                SELECT p.*::participants
+                  FROM participants p
+                 WHERE p.id = ANY(%s)
+              ORDER BY p.id
+            """, (list(tippee_ids),)):
+                tippee.update_receiving(cursor)
+
+        return results
+
+
     @staticmethod
     def _zero_tip_dict(tippee):
         if isinstance(tippee, Participant):
@@ -1650,16 +1896,10 @@ class Participant(Model, MixinTeam):
 
             SELECT amount
                  , count(amount) AS ncontributing
-              FROM ( SELECT DISTINCT ON (tipper)
-                            amount
-                          , tipper
-                       FROM tips
-                      WHERE tippee=%s
-                        AND is_funded
-                   ORDER BY tipper
-                          , mtime DESC
-                    ) AS foo
-             WHERE amount > 0
+              FROM current_tips
+             WHERE tippee=%s
+               AND is_funded
+               AND amount > 0
           GROUP BY amount
           ORDER BY amount
 
@@ -1689,57 +1929,47 @@ class Participant(Model, MixinTeam):
 
         tips = self.db.all("""\
 
-            SELECT * FROM (
-                SELECT DISTINCT ON (tippee)
-                       amount
-                     , period
-                     , periodic_amount
-                     , tippee
-                     , t.ctime
-                     , t.mtime
-                     , p.join_time
-                     , p.username
-                     , p.kind
-                     , t.is_funded
-                     , (p.mangopay_user_id IS NOT NULL OR kind = 'group') AS is_identified
-                     , p.is_suspended
-                  FROM tips t
-                  JOIN participants p ON p.id = t.tippee
-                 WHERE tipper = %s
-                   AND p.status = 'active'
-              ORDER BY tippee
-                     , t.mtime DESC
-            ) AS foo
-            ORDER BY amount DESC
-                   , username
+            SELECT amount
+                 , period
+                 , periodic_amount
+                 , tippee
+                 , t.ctime
+                 , t.mtime
+                 , p.join_time
+                 , p.username
+                 , p.kind
+                 , t.is_funded
+                 , (p.mangopay_user_id IS NOT NULL OR kind = 'group') AS is_identified
+                 , p.is_suspended
+              FROM current_tips t
+              JOIN participants p ON p.id = t.tippee
+             WHERE tipper = %s
+               AND p.status = 'active'
+          ORDER BY amount DESC
+                 , username
 
         """, (self.id,))
 
         pledges = self.db.all("""\
 
-            SELECT * FROM (
-                SELECT DISTINCT ON (tippee)
-                       amount
-                     , period
-                     , periodic_amount
-                     , tippee
-                     , t.ctime
-                     , t.mtime
-                     , p.join_time
-                     , p.username
-                     , e.platform
-                     , e.user_name
-                     , e.domain
-                  FROM tips t
-                  JOIN participants p ON p.id = t.tippee
-                  JOIN elsewhere e ON e.participant = t.tippee
-                 WHERE tipper = %s
-                   AND p.status = 'stub'
-              ORDER BY tippee
-                     , t.mtime DESC
-            ) AS foo
-            ORDER BY amount DESC
-                   , lower(user_name)
+            SELECT amount
+                 , period
+                 , periodic_amount
+                 , tippee
+                 , t.ctime
+                 , t.mtime
+                 , p.join_time
+                 , p.username
+                 , e.platform
+                 , e.user_name
+                 , e.domain
+              FROM current_tips t
+              JOIN participants p ON p.id = t.tippee
+              JOIN elsewhere e ON e.participant = t.tippee
+             WHERE tipper = %s
+               AND p.status = 'stub'
+          ORDER BY amount DESC
+                 , lower(user_name)
 
         """, (self.id,))
 
@@ -1769,23 +1999,18 @@ class Participant(Model, MixinTeam):
         """Get the tips this participant is currently sending to others.
         """
         return self.db.all("""
-            SELECT * FROM (
-                SELECT DISTINCT ON (tippee)
-                       amount
-                     , period
-                     , periodic_amount
-                     , tippee
-                     , t.ctime
-                     , p.username
-                     , p.join_time
-                  FROM tips t
-                  JOIN participants p ON p.id = t.tippee
-                 WHERE tipper = %s
-              ORDER BY tippee
-                     , t.mtime DESC
-            ) AS foo
-            ORDER BY amount DESC
-                   , tippee
+            SELECT amount
+                 , period
+                 , periodic_amount
+                 , tippee
+                 , t.ctime
+                 , p.username
+                 , p.join_time
+              FROM current_tips t
+              JOIN participants p ON p.id = t.tippee
+             WHERE tipper = %s
+          ORDER BY amount DESC
+                 , tippee
         """, (self.id,), back_as=dict)
 
 
@@ -2031,16 +2256,28 @@ class Participant(Model, MixinTeam):
              LIMIT 20
         """, (self.id,))
 
-    def get_repos_on_platform(self, platform, limit=50, offset=None):
-        return self.db.all("""
+    def get_repos_on_platform(self, platform, per_page=50, after=None, before=None):
+        """Return a page of this participant's repositories on `platform`.
+
+        Non-forks come first, then repos are sorted by date of last update.
+        """
+        from liberapay.utils.pagination import Keyset  # avoid circular import
+        keyset = Keyset([
+            ('(r.is_fork IS NOT TRUE)', 'boolean'),
+            ('r.last_update', 'timestamptz'),
+            ('r.id', 'bigint'),
+        ], descending=True)
+        return keyset.paginate(self.db, """
             SELECT r
               FROM repositories r
-             WHERE r.participant = %s
-               AND r.platform = %s
-          ORDER BY r.is_fork ASC NULLS FIRST, r.last_update DESC
-             LIMIT %s
-            OFFSET %s
-        """, (self.id, platform, limit, offset))
+             WHERE r.participant = %(p_id)s
+               AND r.platform = %(platform)s
+               AND {condition}
+          ORDER BY {order_by}
+             LIMIT {limit}
+        """, dict(p_id=self.id, platform=platform),
+            lambda r: (r.is_fork is not True, r.last_update, r.id),
+            per_page, after, before)
 
 
     # More Random Stuff
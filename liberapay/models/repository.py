@@ -1,11 +1,14 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
-from time import sleep
 
 from postgres.orm import Model
 
 from liberapay.cron import logger
+from liberapay.elsewhere._exceptions import RatelimitReached
+from liberapay.elsewhere._scheduler import scheduler
 from liberapay.models.participant import Participant
 from liberapay.utils import utcnow
 from liberapay.website import website
@@ -30,75 +33,122 @@ class Repository(Model):
         """, (self.platform, '', str(self.owner_id)))
 
 
+REPO_COLUMNS = (
+    'platform', 'remote_id', 'owner_id', 'name', 'slug', 'description',
+    'last_update', 'is_fork', 'stars_count', 'extra_info', 'info_fetched_at',
+    'participant',
+)
+
+# How many accounts `refetch_repos` processes per run, and in how many threads
+REFETCH_BATCH_SIZE = 20
+REFETCH_WORKERS = 4
+
+# Maximum number of pages fetched for a single account
+REFETCH_MAX_PAGES = 10
+
+
 def upsert_repos(cursor, repos, participant, info_fetched_at):
+    """Insert or update a page of repositories in a single query.
+    """
+    repos = [repo for repo in repos if repo.owner_id and repo.last_update]
     if not repos:
-        return repos
-    r = []
-    for repo in repos:
-        if not repo.owner_id or not repo.last_update:
-            continue
-        repo.participant = participant.id
-        repo.extra_info = json.dumps(repo.extra_info)
-        repo.info_fetched_at = info_fetched_at
-        cols, vals = zip(*repo.__dict__.items())
-        on_conflict_set = ','.join('{0}=excluded.{0}'.format(col) for col in cols)
-        cols = ','.join(cols)
-        placeholders = ('%s,'*len(vals))[:-1]
-        cursor.run("""
-            DELETE FROM repositories
-             WHERE platform = %s
-               AND slug = %s
-               AND remote_id <> %s
-        """, (repo.platform, repo.slug, repo.remote_id))
-        r.append(cursor.one("""
-            INSERT INTO repositories
-                        ({0})
-                 VALUES ({1})
-            ON CONFLICT (platform, remote_id) DO UPDATE
-                    SET {2}
-              RETURNING repositories
-        """.format(cols, placeholders, on_conflict_set), vals))
-    return r
+        return []
+    # A multi-row upsert can't touch the same row twice, keep the last duplicate
+    by_remote_id = OrderedDict((repo.remote_id, repo) for repo in repos)
+    repos = list(OrderedDict((repo.slug, repo) for repo in by_remote_id.values()).values())
+    platform = repos[0].platform
+    cursor.run("""
+        DELETE FROM repositories r
+         USING unnest(%s::text[], %s::text[]) x (slug, remote_id)
+         WHERE r.platform = %s
+           AND r.slug = x.slug
+           AND r.remote_id <> x.remote_id
+    """, ([repo.slug for repo in repos], [repo.remote_id for repo in repos], platform))
+    placeholders = '(' + ','.join(['%s'] * len(REPO_COLUMNS)) + ')'
+    values = ', '.join(
+        cursor.mogrify(placeholders, (
+            repo.platform, repo.remote_id, repo.owner_id, repo.name, repo.slug,
+            repo.description, repo.last_update, repo.is_fork, repo.stars_count,
+            json.dumps(repo.extra_info), info_fetched_at, participant.id,
+        )).decode('utf8')
+        for repo in repos
+    )
+    # The values can contain curly brackets, so we can't use `str.format()` here
+    return cursor.all("""
+        INSERT INTO repositories
+                    ({0})
+             VALUES """.format(', '.join(REPO_COLUMNS)) + values + """
+        ON CONFLICT (platform, remote_id) DO UPDATE
+                SET {0}
+          RETURNING repositories
+    """.format(', '.join('{0}=excluded.{0}'.format(col) for col in REPO_COLUMNS)))
 
 
 def refetch_repos():
+    """Refresh the lists of repositories that haven't been updated in a while.
+
+    Up to `REFETCH_BATCH_SIZE` accounts are processed in parallel.
+    """
+    stale = website.db.all("""
+        SELECT r.participant, r.platform, min(r.info_fetched_at) AS oldest
+          FROM repositories r
+         WHERE r.info_fetched_at < now() - interval '6 days'
+           AND r.participant IS NOT NULL
+      GROUP BY r.participant, r.platform
+      ORDER BY oldest ASC
+         LIMIT %s
+    """, (REFETCH_BATCH_SIZE,))
+    if not stale:
+        return
+    with ThreadPoolExecutor(max_workers=min(REFETCH_WORKERS, len(stale))) as executor:
+        for r in stale:
+            executor.submit(_refetch_repos_safely, r.participant, r.platform)
+
+
+def _refetch_repos_safely(participant_id, platform):
+    try:
+        with scheduler.background():
+            refetch_repos_of(participant_id, platform)
+    except RatelimitReached as e:
+        logger.info("Postponing the refetching of repos: %r" % e)
+    except Exception as e:
+        website.tell_sentry(e, {}, allow_reraise=False)
+
+
+def refetch_repos_of(participant_id, platform):
+    participant = Participant.from_id(participant_id)
+    account = participant.get_account_elsewhere(platform)
+    if not account:
+        return
+    sess = account.get_auth_session()
+    start_time = utcnow()
+    logger.debug(
+        "Refetching repository data for participant ~%s from %s account %s" %
+        (participant.id, account.platform, account.user_id)
+    )
+    platform = account.platform_data
+    domain = account.domain or platform.domain
+    repos = platform.iter_repos(
+        account, sess=sess, max_pages=REFETCH_MAX_PAGES,
+        keep_going=lambda: scheduler.has_quota_to_spare(platform.name, domain),
+    )
     with website.db.get_cursor() as cursor:
-        repo = cursor.one("""
-            SELECT r.participant, r.platform
-              FROM repositories r
-             WHERE r.info_fetched_at < now() - interval '6 days'
-               AND r.participant IS NOT NULL
-          ORDER BY r.info_fetched_at ASC
-             LIMIT 1
-        """)
-        if not repo:
-            return
-        participant = Participant.from_id(repo.participant)
-        account = participant.get_account_elsewhere(repo.platform)
-        sess = account.get_auth_session()
-        start_time = utcnow()
-        logger.debug(
-            "Refetching repository data for participant ~%s from %s account %s" %
-            (participant.id, account.platform, account.user_id)
-        )
-        next_page = None
-        for i in range(10):
-            r = account.platform_data.get_repos(account, page_url=next_page, sess=sess)
-            upsert_repos(cursor, r[0], participant, utcnow())
-            next_page = r[2].get('next')
-            if not next_page:
-                break
-            sleep(1)
-        deleted_count = cursor.one("""
-            WITH deleted AS (
-                     DELETE FROM repositories
-                      WHERE participant = %s
-                        AND platform = %s
-                        AND info_fetched_at < %s
-                  RETURNING id
-                 )
-            SELECT count(*) FROM deleted
-        """, (participant.id, account.platform, start_time))
+        for page in repos.pages():
+            upsert_repos(cursor, page, participant, utcnow())
+        if repos.interrupted:
+            # Don't delete the repos we haven't seen yet, we'll come back later
+            deleted_count = 0
+        else:
+            deleted_count = cursor.one("""
+                WITH deleted AS (
+                         DELETE FROM repositories
+                          WHERE participant = %s
+                            AND platform = %s
+                            AND info_fetched_at < %s
+                      RETURNING id
+                     )
+                SELECT count(*) FROM deleted
+            """, (participant.id, account.platform, start_time))
         event_type = 'fetch_repos:%s' % account.id
-        payload = dict(partial_list=bool(next_page), deleted_count=deleted_count)
+        payload = dict(partial_list=not repos.complete, deleted_count=deleted_count)
         participant.add_event(cursor, event_type, payload)
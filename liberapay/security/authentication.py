@@ -141,8 +141,11 @@ def authenticate_user_if_possible(request, response, state, user, _):
     # We want to try cookie auth first, but we want form auth to supersede it
     p = None
     if SESSION in request.headers.cookie:
-        creds = request.headers.cookie[SESSION].value.split(':', 1)
-        p = Participant.authenticate('id', 'session', *creds)
+        creds = request.headers.cookie[SESSION].value
+        if creds.count(':') == 4:
+            p = Participant.authenticate_signed_session(*creds.split(':'))
+        else:
+            p = Participant.authenticate('id', 'session', *creds.split(':', 1))
         if p:
             state['user'] = p
     session_p, p = p, None
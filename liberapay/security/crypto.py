@@ -3,7 +3,9 @@ Copied from Django
 """
 from __future__ import unicode_literals
 
+from base64 import urlsafe_b64encode
 import hashlib
+import hmac
 import random
 import string
 import time
@@ -62,3 +64,22 @@ def constant_time_compare(val1, val2):
         for x, y in zip(val1, val2):
             result |= ord(x) ^ ord(y)
     return result == 0
+
+
+def sign(key, msg):
+    """
+    Returns an HMAC-SHA256 signature of `msg`, encoded in url-safe base64.
+    """
+    if not isinstance(key, bytes):
+        key = key.encode('utf8')
+    if not isinstance(msg, bytes):
+        msg = msg.encode('utf8')
+    mac = hmac.new(key, msg, hashlib.sha256).digest()
+    return urlsafe_b64encode(mac).rstrip(b'=').decode('ascii')
+
+
+def check_signature(key, msg, signature):
+    """
+    Returns True if `signature` is a valid signature of `msg`.
+    """
+    return constant_time_compare(sign(key, msg), signature)
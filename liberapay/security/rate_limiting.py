@@ -0,0 +1,150 @@
+"""Rate limiting.
+
+The counters live in the `rate_limiting` table so that the limits apply across
+all the processes, but hitting the database for every attempt would make the
+limiter itself a load amplifier during an attack. So each process keeps a local
+copy of the leaky buckets: attempts are rejected in memory when a bucket is
+full, and accepted in memory while a bucket is less than half full and was
+synced recently. The other attempts, and the ones accepted locally since the
+last sync, are sent to the database.
+
+Run `python -m liberapay.security.rate_limiting` to benchmark the limiter.
+"""
+from __future__ import division, print_function, unicode_literals
+
+from threading import Lock
+from time import time
+
+from liberapay.constants import RATE_LIMITS
+
+
+class Bucket(object):
+
+    __slots__ = ('counter', 'ts', 'pending', 'synced_at')
+
+    def __init__(self, now):
+        self.counter = 0
+        self.ts = now
+        self.pending = 0
+        self.synced_at = 0
+
+    def leak(self, cap, period, now):
+        leaked = cap * (now - self.ts) / period
+        self.counter = max(self.counter - leaked, 0)
+        self.ts = now
+
+
+class RateLimiter(object):
+
+    # Attempts are only accepted locally while the bucket is less than half full
+    sync_threshold = 0.5
+
+    # The maximum number of seconds between two syncs of an active bucket
+    sync_interval = 10
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+        self.lock = Lock()
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+    def hit(self, db, key_prefix, key_unique):
+        """Count an attempt.
+
+        Returns the number of attempts left, or `None` if the limit has been
+        reached, in which case the attempt isn't counted.
+        """
+        cap, period = self.limits[key_prefix]
+        key = '%s:%s' % (key_prefix, key_unique)
+        now = time()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = Bucket(now)
+            else:
+                bucket.leak(cap, period, now)
+                if bucket.counter >= cap:
+                    return None
+                if bucket.counter + 1 <= cap * self.sync_threshold and \
+                   now - bucket.synced_at < self.sync_interval:
+                    bucket.counter += 1
+                    bucket.pending += 1
+                    return int(cap - bucket.counter)
+            pending, bucket.pending = bucket.pending, 0
+        return self._sync(db, key, cap, period, pending, True)
+
+    def _sync(self, db, key, cap, period, pending, hit):
+        try:
+            r = db.one("SELECT sync_rate_limit(%s, %s, %s, %s, %s)",
+                       (key, cap, period, pending, hit))
+        except Exception:
+            with self.lock:
+                bucket = self.buckets.get(key)
+                if bucket is not None:
+                    bucket.pending += pending
+            raise
+        now = time()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = Bucket(now)
+            # Attempts may have been accepted locally while we were waiting
+            bucket.counter = (cap if r is None else cap - r) + bucket.pending
+            bucket.ts = bucket.synced_at = now
+        return r
+
+    def flush(self, db):
+        """Send the locally accepted attempts to the database, and forget the
+        buckets that are empty.
+        """
+        now = time()
+        with self.lock:
+            to_sync = []
+            for key, bucket in list(self.buckets.items()):
+                cap, period = self.limits[key.split(':', 1)[0]]
+                bucket.leak(cap, period, now)
+                if bucket.pending:
+                    to_sync.append((key, cap, period, bucket.pending))
+                    bucket.pending = 0
+                elif bucket.counter == 0:
+                    del self.buckets[key]
+        for key, cap, period, pending in to_sync:
+            self._sync(db, key, cap, period, pending, False)
+        return len(to_sync)
+
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+
+def benchmark(db, n=10000):
+    """Measure the number of limiter calls per second, with and without the
+    local buckets.
+    """
+    key_prefix = 'log-in.password'
+    cap, period = RATE_LIMITS[key_prefix]
+
+    def measure(f):
+        start = time()
+        for i in range(n):
+            f(i)
+        return n / (time() - start)
+
+    print("Calls per second, with %i calls spread over %i keys:" % (n, n // 100))
+    r = measure(lambda i: db.one(
+        "SELECT hit_rate_limit(%s, %s, %s)",
+        ('benchmark-db:%i' % (i % (n // 100)), cap, period)
+    ))
+    print("  database only: %.0f" % r)
+    limiter = RateLimiter(RATE_LIMITS)
+    r = measure(lambda i: limiter.hit(db, key_prefix, 'benchmark-local:%i' % (i % (n // 100))))
+    print("  local buckets: %.0f" % r)
+    db.run("DELETE FROM rate_limiting WHERE key LIKE 'benchmark-%%' OR key LIKE %s",
+           (key_prefix + ':benchmark-%',))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    from liberapay.wireup import minimal_algorithm
+    benchmark(minimal_algorithm.run()['db'])
@@ -18,11 +18,13 @@ from liberapay.billing.transactions import (
 )
 from liberapay.constants import SESSION
 from liberapay.elsewhere._base import UserInfo
+from liberapay.elsewhere._scheduler import scheduler
 from liberapay.main import website
 from liberapay.models.account_elsewhere import AccountElsewhere
 from liberapay.models.exchange_route import ExchangeRoute
 from liberapay.models.participant import Participant
 from liberapay.security.csrf import CSRF_TOKEN
+from liberapay.security.rate_limiting import rate_limiter
 from liberapay.testing.vcr import use_cassette
 
 
@@ -148,6 +150,8 @@ class Harness(unittest.TestCase):
                 self.tablenames.insert(0, tablename)
         self.db.run("ALTER SEQUENCE participants_id_seq RESTART WITH 1")
         self.db.run("ALTER SEQUENCE paydays_id_seq RESTART WITH 1")
+        rate_limiter.clear()
+        scheduler.clear()
 
 
     def make_elsewhere(self, platform, user_id, user_name, domain='', **kw):
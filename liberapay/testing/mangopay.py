@@ -1,5 +1,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from time import time
+
 from mangopay.resources import (
     BankAccount, CardRegistration, NaturalUser, Wallet,
 )
@@ -9,6 +11,7 @@ import requests
 from liberapay.models.exchange_route import ExchangeRoute
 from liberapay.testing import Harness
 from liberapay.testing.vcr import use_cassette
+from liberapay.utils import NS
 
 
 class MangopayHarness(Harness):
@@ -52,6 +55,33 @@ class FakeTransfersHarness(Harness):
         super(FakeTransfersHarness, self).tearDown()
 
 
+class FakeTransactions(object):
+    """Stands in for `liberapay.billing.transactions.list_user_transactions`.
+
+    Usage: `with mock.patch.object(transactions, 'list_user_transactions', fake):`
+    """
+
+    def __init__(self, page_size=10):
+        self.page_size = page_size
+        self.transactions = []
+        self.calls = []
+
+    def add(self, user_id, tx_type, tag, status='SUCCEEDED', result_code='000000'):
+        tr = NS(dict(
+            Id=-len(self.transactions) - 1, AuthorId=user_id, Type=tx_type,
+            Tag=str(tag), Status=status, ResultCode=result_code,
+            CreationDate=int(time()),
+        ))
+        self.transactions.append(tr)
+        return tr
+
+    def __call__(self, user_id, tx_type, page):
+        self.calls.append((user_id, tx_type, page))
+        r = [tr for tr in reversed(self.transactions)
+             if tr.AuthorId == user_id and tr.Type == tx_type]
+        return r[(page - 1) * self.page_size:page * self.page_size]
+
+
 def make_mangopay_account(FirstName):
     account = NaturalUser()
     account.FirstName = FirstName
@@ -1,68 +1,115 @@
+import csv
 from datetime import datetime
 from decimal import Decimal
+from io import BytesIO, StringIO
 
-from pando import Response
-from psycopg2 import IntegrityError
+from pando import json, Response
+from psycopg2.extensions import cursor as psycopg2_cursor
+from six import PY2
 
+from ..renderers.csv_dump import maybe_encode
 from ..website import website
 
 
+BALANCE_DELTAS = """
+    SELECT participant, amount - (CASE WHEN (fee < 0) THEN fee ELSE 0 END) AS delta
+      FROM exchanges
+     WHERE timestamp >= %(start)s::timestamptz AND timestamp < %(end)s
+       AND amount > 0
+       AND status = 'succeeded'
+       {exchanges_filter}
+     UNION ALL
+    SELECT participant, amount - (CASE WHEN (fee > 0) THEN fee ELSE 0 END) AS delta
+      FROM exchanges
+     WHERE timestamp >= %(start)s::timestamptz AND timestamp < %(end)s
+       AND amount < 0
+       AND status <> 'failed'
+       {exchanges_filter}
+     UNION ALL
+    SELECT tipper AS participant, -amount AS delta
+      FROM transfers
+     WHERE timestamp >= %(start)s::timestamptz AND timestamp < %(end)s
+       AND status = 'succeeded'
+       {tipper_filter}
+     UNION ALL
+    SELECT tippee AS participant, amount AS delta
+      FROM transfers
+     WHERE timestamp >= %(start)s::timestamptz AND timestamp < %(end)s
+       AND status = 'succeeded'
+       {tippee_filter}
+"""
+
+
+def get_balance_at(db, participant_id, ts):
+    """Returns the balance of a participant at time `ts`.
+
+    The computation starts from the latest snapshot in `balances_at`, so it
+    only has to sum up the events that happened since then, which is less than
+    a month's worth of events for participants who were active in the past.
+    """
+    start, balance = db.one("""
+        SELECT at, balance
+          FROM balances_at
+         WHERE participant = %s
+           AND at <= %s
+      ORDER BY at DESC
+         LIMIT 1
+    """, (participant_id, ts), default=('-infinity', Decimal('0.00')))
+    delta = db.one("""
+        SELECT COALESCE(sum(delta), 0) FROM ( {0} ) x
+    """.format(BALANCE_DELTAS.format(
+        exchanges_filter='AND participant = %(p_id)s',
+        tipper_filter='AND tipper = %(p_id)s',
+        tippee_filter='AND tippee = %(p_id)s',
+    )), dict(p_id=participant_id, start=start, end=ts))
+    return balance + delta
+
+
 def get_end_of_year_balance(db, participant, year, current_year):
     if year == current_year:
         return participant.balance
     if year < participant.join_time.year:
         return Decimal('0.00')
+    return get_balance_at(db, participant.id, datetime(year+1, 1, 1))
 
-    balance = db.one("""
-        SELECT balance
-          FROM balances_at
-         WHERE participant = %s
-           AND "at" = %s
-    """, (participant.id, datetime(year+1, 1, 1)))
-    if balance is not None:
-        return balance
 
-    id = participant.id
-    start_balance = get_end_of_year_balance(db, participant, year-1, current_year)
-    delta = db.one("""
-        SELECT (
-                  SELECT COALESCE(sum(amount - (CASE WHEN (fee < 0) THEN fee ELSE 0 END)), 0) AS a
-                    FROM exchanges
-                   WHERE participant = %(id)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND amount > 0
-                     AND status = 'succeeded'
-               ) + (
-                  SELECT COALESCE(sum(amount - (CASE WHEN (fee > 0) THEN fee ELSE 0 END)), 0) AS a
-                    FROM exchanges
-                   WHERE participant = %(id)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND amount < 0
-                     AND status <> 'failed'
-               ) + (
-                  SELECT COALESCE(sum(-amount), 0) AS a
-                    FROM transfers
-                   WHERE tipper = %(id)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND status = 'succeeded'
-               ) + (
-                  SELECT COALESCE(sum(amount), 0) AS a
-                    FROM transfers
-                   WHERE tippee = %(id)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND status = 'succeeded'
-               ) AS delta
-    """, locals())
-    balance = start_balance + delta
-    try:
+def take_balance_snapshots(db):
+    """Store the closing balances of the months that have ended since the last
+    call.
+
+    A snapshot is only stored for the participants whose balance changed
+    during the month.
+    """
+    last_snapshot, first_event, end_of_month = db.one("""
+        SELECT (SELECT max(at) FROM balances_at)
+             , (SELECT date_trunc('month', min(timestamp)) FROM exchanges)
+             , date_trunc('month', current_timestamp)
+    """)
+    start = last_snapshot or first_event
+    if start is None:
+        return
+    while start < end_of_month:
+        end = db.one("SELECT %s + interval '1 month'", (start,))
         db.run("""
             INSERT INTO balances_at
                         (participant, at, balance)
-                 VALUES (%s, %s, %s)
-        """, (participant.id, datetime(year+1, 1, 1), balance))
-    except IntegrityError:
-        pass
-    return balance
+                 SELECT d.participant, %(end)s, COALESCE((
+                            SELECT b.balance
+                              FROM balances_at b
+                             WHERE b.participant = d.participant
+                               AND b.at <= %(start)s
+                          ORDER BY b.at DESC
+                             LIMIT 1
+                        ), 0) + d.delta
+                   FROM ( SELECT participant, sum(delta) AS delta
+                            FROM ( {0} ) x
+                        GROUP BY participant
+                        ) d
+            ON CONFLICT (participant, at) DO NOTHING
+        """.format(BALANCE_DELTAS.format(
+            exchanges_filter='', tipper_filter='', tippee_filter=''
+        )), dict(start=start, end=end))
+        start = end
 
 
 def iter_payday_events(db, participant, year=None):
@@ -70,26 +117,27 @@ def iter_payday_events(db, participant, year=None):
     """
     current_year = datetime.utcnow().year
     year = year or current_year
+    start, end = datetime(year, 1, 1), datetime(year+1, 1, 1)
 
     id = participant.id
     exchanges = db.all("""
         SELECT *
           FROM exchanges
          WHERE participant=%(id)s
-           AND extract(year from timestamp) = %(year)s
+           AND timestamp >= %(start)s AND timestamp < %(end)s
     """, locals(), back_as=dict)
     transfers = db.all("""
         SELECT t.*, p.username, (SELECT username FROM participants WHERE id = team) AS team_name
           FROM transfers t
           JOIN participants p ON p.id = tipper
          WHERE t.tippee=%(id)s
-           AND extract(year from t.timestamp) = %(year)s
+           AND t.timestamp >= %(start)s AND t.timestamp < %(end)s
         UNION ALL
         SELECT t.*, p.username, (SELECT username FROM participants WHERE id = team) AS team_name
           FROM transfers t
           JOIN participants p ON p.id = tippee
          WHERE t.tipper=%(id)s
-           AND extract(year from t.timestamp) = %(year)s
+           AND t.timestamp >= %(start)s AND t.timestamp < %(end)s
     """, locals(), back_as=dict)
 
     if not (exchanges or transfers):
@@ -184,91 +232,203 @@ def iter_payday_events(db, participant, year=None):
     yield dict(kind='day-close', balance=balance)
 
 
-def export_history(participant, year, mode, key, back_as='namedtuple', require_key=False):
-    db = participant.db
-    base_url = website.canonical_url + '/~'
-    params = dict(id=participant.id, year=year, base_url=base_url)
-    out = {}
-    if mode == 'aggregate':
-        out['given'] = lambda: db.all("""
+EXPORT_QUERIES = {
+    'aggregate': {
+        'given': """
             SELECT (%(base_url)s || t.tippee::text) AS donee_url,
                    min(p.username) AS donee_username, sum(t.amount) AS amount
               FROM transfers t
               JOIN participants p ON p.id = t.tippee
              WHERE t.tipper = %(id)s
-               AND extract(year from t.timestamp) = %(year)s
+               AND t.timestamp >= %(start)s AND t.timestamp < %(end)s
                AND t.status = 'succeeded'
                AND t.context IN ('tip', 'take')
                AND t.refund_ref IS NULL
           GROUP BY t.tippee
-        """, params, back_as=back_as)
-        out['reimbursed'] = lambda: db.all("""
+        """,
+        'reimbursed': """
             SELECT (%(base_url)s || t.tippee::text) AS recipient_url,
                    min(p.username) AS recipient_username, sum(t.amount) AS amount
               FROM transfers t
               JOIN participants p ON p.id = t.tippee
              WHERE t.tipper = %(id)s
-               AND extract(year from t.timestamp) = %(year)s
+               AND t.timestamp >= %(start)s AND t.timestamp < %(end)s
                AND t.status = 'succeeded'
                AND t.context = 'expense'
           GROUP BY t.tippee
-        """, params, back_as=back_as)
-        out['taken'] = lambda: db.all("""
+        """,
+        'taken': """
             SELECT (%(base_url)s || t.team::text) AS team_url,
                    min(p.username) AS team_username, sum(t.amount) AS amount
               FROM transfers t
               JOIN participants p ON p.id = t.team
              WHERE t.tippee = %(id)s
                AND t.context = 'take'
-               AND extract(year from t.timestamp) = %(year)s
+               AND t.timestamp >= %(start)s AND t.timestamp < %(end)s
                AND t.status = 'succeeded'
           GROUP BY t.team
-        """, params, back_as=back_as)
-    else:
-        out['exchanges'] = lambda: db.all("""
-            SELECT timestamp, amount, fee, status, note
+        """,
+    },
+    'detailed': {
+        'exchanges': """
+            SELECT timestamp, amount, fee, status, note, id
               FROM exchanges
              WHERE participant = %(id)s
-               AND extract(year from timestamp) = %(year)s
-          ORDER BY id ASC
-        """, params, back_as=back_as)
-        out['given'] = lambda: db.all("""
+               AND timestamp >= %(start)s AND timestamp < %(end)s
+               AND (timestamp, id) > (%(after_ts)s, %(after_id)s)
+          ORDER BY timestamp, id
+             LIMIT %(limit)s
+        """,
+        'given': """
             SELECT timestamp, (%(base_url)s || t.tippee::text) AS donee_url,
-                   p.username AS donee_username, t.amount, t.context
+                   p.username AS donee_username, t.amount, t.context, t.id
               FROM transfers t
               JOIN participants p ON p.id = t.tippee
              WHERE t.tipper = %(id)s
-               AND extract(year from t.timestamp) = %(year)s
+               AND t.timestamp >= %(start)s AND t.timestamp < %(end)s
+               AND (t.timestamp, t.id) > (%(after_ts)s, %(after_id)s)
                AND t.status = 'succeeded'
-          ORDER BY t.id ASC
-        """, params, back_as=back_as)
-        out['taken'] = lambda: db.all("""
+          ORDER BY t.timestamp, t.id
+             LIMIT %(limit)s
+        """,
+        'taken': """
             SELECT timestamp, (%(base_url)s || t.team::text) AS team_url,
-                   p.username AS team_username, t.amount
+                   p.username AS team_username, t.amount, t.id
               FROM transfers t
               JOIN participants p ON p.id = t.team
              WHERE t.tippee = %(id)s
                AND t.context = 'take'
-               AND extract(year from t.timestamp) = %(year)s
+               AND t.timestamp >= %(start)s AND t.timestamp < %(end)s
+               AND (t.timestamp, t.id) > (%(after_ts)s, %(after_id)s)
                AND t.status = 'succeeded'
-          ORDER BY t.id ASC
-        """, params, back_as=back_as)
-        out['received'] = lambda: db.all("""
-            SELECT timestamp, amount, context
+          ORDER BY t.timestamp, t.id
+             LIMIT %(limit)s
+        """,
+        'received': """
+            SELECT timestamp, amount, context, id
               FROM transfers
              WHERE tippee = %(id)s
                AND context <> 'take'
-               AND extract(year from timestamp) = %(year)s
+               AND timestamp >= %(start)s AND timestamp < %(end)s
+               AND (timestamp, id) > (%(after_ts)s, %(after_id)s)
                AND status = 'succeeded'
-          ORDER BY id ASC
-        """, params, back_as=back_as)
+          ORDER BY timestamp, id
+             LIMIT %(limit)s
+        """,
+    },
+}
 
-    if key:
+
+def get_export_period(participant, year, current_year):
+    """Parse the `year` parameter of an export request.
+
+    Accepts a single year (`2017`), an inclusive range of years (`2015-2017`),
+    or `all` for the entire history of the account.
+
+    Returns a half-open `(start, end)` range of timestamps.
+    """
+    if year == 'all':
+        first, last = participant.join_time.year, current_year
+    else:
         try:
-            return out[key]()
-        except KeyError:
+            first, _, last = year.partition('-')
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise Response(400, "bad year")
+    if first > last:
+        raise Response(400, "bad year")
+    try:
+        return datetime(first, 1, 1), datetime(last + 1, 1, 1)
+    except (OverflowError, ValueError):
+        raise Response(400, "bad year")
+
+
+def _get_export_queries(participant, start, end, mode, key, require_key):
+    paged = mode != 'aggregate'
+    queries = EXPORT_QUERIES['detailed' if paged else 'aggregate']
+    if key:
+        if key not in queries:
             raise Response(400, "bad key `%s`" % key)
+        queries = {key: queries[key]}
     elif require_key:
         raise Response(400, "missing `key` parameter")
-    else:
-        return {k: v() for k, v in out.items()}
+    base_url = website.canonical_url + '/~'
+    params = dict(id=participant.id, start=start, end=end, base_url=base_url)
+    return queries, params, paged
+
+
+def stream_history(participant, start, end, mode, key, fmt, require_key=False):
+    """Returns an iterator of CSV or JSON chunks.
+
+    The detailed history is fetched in pages, so neither the memory used nor
+    the time a database connection is held depends on the size of the export.
+    """
+    queries, params, paged = _get_export_queries(
+        participant, start, end, mode, key, require_key
+    )
+    if fmt == 'csv':
+        return _stream_csv(participant.db, queries[key], params, paged)
+    elif fmt == 'json':
+        return _stream_json(participant.db, queries, params, paged, key)
+    raise ValueError(fmt)
+
+
+def _iter_export_query(db, sql, params, paged, page_size=1000):
+    """Yields the column names, then pages of rows.
+
+    The paged queries are keyset on `(timestamp, id)`: they select the
+    timestamp as their first column and the id as their last one, which isn't
+    part of the output. Each page is fetched in its own short transaction, so
+    a slow client doesn't keep a connection busy. The aggregate queries return
+    one row per counterparty, they're fetched in a single page.
+    """
+    params = dict(params, after_ts=params['start'], after_id=0, limit=page_size)
+    names = None
+    while True:
+        with db.get_cursor(cursor_factory=psycopg2_cursor) as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            if names is None:
+                names = [col[0] for col in cursor.description]
+        if not paged:
+            yield names
+            yield rows
+            return
+        if params['after_id'] == 0:
+            yield names[:-1]
+        if rows:
+            yield [row[:-1] for row in rows]
+        if len(rows) < page_size:
+            return
+        params['after_ts'], params['after_id'] = rows[-1][0], rows[-1][-1]
+
+
+def _stream_csv(db, sql, params, paged):
+    f = BytesIO() if PY2 else StringIO()
+    w = csv.writer(f)
+    batches = _iter_export_query(db, sql, params, paged)
+    w.writerow([maybe_encode(name) for name in next(batches)])
+    for rows in batches:
+        w.writerows(rows)
+        yield f.getvalue()
+        f.seek(0)
+        f.truncate()
+    yield f.getvalue()
+
+
+def _stream_json(db, queries, params, paged, key):
+    if not key:
+        yield '{'
+    for i, (k, sql) in enumerate(queries.items()):
+        if not key:
+            yield '%s%s: ' % (', ' if i else '', json.dumps(k))
+        batches = _iter_export_query(db, sql, params, paged)
+        names = next(batches)
+        sep = '['
+        for rows in batches:
+            yield sep + ', '.join(json.dumps(dict(zip(names, row))) for row in rows)
+            sep = ', '
+        yield '[]' if sep == '[' else ']'
+    if not key:
+        yield '}'
@@ -0,0 +1,117 @@
+"""Keyset pagination, also known as the "seek method".
+
+Instead of skipping rows with `OFFSET`, each page starts right after the last
+row of the previous one. Given the right multicolumn index the database jumps
+directly to the start of the page, so deep pages cost the same as the first one.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+from six.moves.urllib.parse import urlencode
+
+from liberapay.exceptions import InvalidPageCursor
+from liberapay.utils import b64decode_s, b64encode_s
+
+
+class Keyset(object):
+    """Describes the sort order of a paginated listing.
+
+    `columns` is a sequence of `(sql_expression, sql_type)` pairs which together
+    must uniquely identify a row. They're all sorted in the same direction, so
+    that the boundary can be expressed as a single row comparison, which
+    PostgreSQL can satisfy with an index on the same columns.
+    """
+
+    def __init__(self, columns, descending=False):
+        self.columns = columns
+        self.descending = descending
+
+    def encode_cursor(self, values):
+        return b64encode_s(json.dumps(list(values), default=str))
+
+    def decode_cursor(self, cursor):
+        values = b64decode_s(cursor, default=None)
+        try:
+            values = json.loads(values) if values else None
+        except ValueError:
+            values = None
+        if not isinstance(values, list) or len(values) != len(self.columns):
+            raise InvalidPageCursor(cursor)
+        return values
+
+    def sql(self, values=None, backward=False):
+        """Returns a `(condition, order_by, params)` tuple of SQL fragments.
+        """
+        descending = self.descending != backward
+        order_by = ', '.join(
+            '%s %s' % (expr, 'DESC' if descending else 'ASC') for expr, t in self.columns
+        )
+        if values is None:
+            return 'true', order_by, {}
+        condition = '(%s) %s (%s)' % (
+            ', '.join(expr for expr, t in self.columns),
+            '<' if descending else '>',
+            ', '.join('%%(keyset_%i)s::%s' % (i, t) for i, (expr, t) in enumerate(self.columns)),
+        )
+        params = {'keyset_%i' % i: v for i, v in enumerate(values)}
+        return condition, order_by, params
+
+    def paginate(self, db, query, params, key, per_page, after=None, before=None):
+        """Fetch one page of results.
+
+        `query` must contain `{condition}`, `{order_by}` and `{limit}`
+        placeholders, and `params` must be a dict. `key` is a function that
+        extracts the values of the keyset columns from a row.
+
+        Returns a `Page`.
+        """
+        backward = bool(before) and not after
+        values = after or before
+        values = self.decode_cursor(values) if values else None
+        condition, order_by, keyset_params = self.sql(values, backward)
+        sql = query.format(condition=condition, order_by=order_by, limit=int(per_page) + 1)
+        rows = db.all(sql, dict(params, **keyset_params))
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backward:
+            rows.reverse()
+        page = Page(rows)
+        if not rows:
+            return page
+        has_next = backward or has_more
+        has_prev = has_more if backward else values is not None
+        if has_next:
+            page.next_cursor = self.encode_cursor(key(rows[-1]))
+        if has_prev:
+            page.prev_cursor = self.encode_cursor(key(rows[0]))
+        return page
+
+
+class Page(list):
+    """A list of rows, plus the cursors of the neighbouring pages.
+    """
+
+    next_cursor = None
+    prev_cursor = None
+
+    def next_url(self, request):
+        if self.next_cursor:
+            return build_page_url(request, after=self.next_cursor)
+
+    def prev_url(self, request):
+        if self.prev_cursor:
+            return build_page_url(request, before=self.prev_cursor)
+
+
+def build_page_url(request, **cursor):
+    """Returns the current URL with the pagination cursor replaced.
+    """
+    tupled = []
+    for k, vals in request.qs.items():
+        if k in ('after', 'before'):
+            continue
+        for v in vals:
+            tupled.append((k, v))
+    tupled.extend(cursor.items())
+    return request.path.raw + '?' + urlencode(tupled)
@@ -120,6 +120,7 @@ class AppConf(object):
         bountysource_secret=str,
         check_db_every=int,
         clean_up_counters_every=int,
+        compact_cash_bundles_every=int,
         dequeue_emails_every=int,
         facebook_callback=str,
         facebook_id=str,
@@ -145,10 +146,12 @@ class AppConf(object):
         openstreetmap_callback=str,
         openstreetmap_id=str,
         openstreetmap_secret=str,
+        password_cache_ttl=int,
         password_rounds=int,
         payday_label=str,
         payday_repo=str,
         refetch_repos_every=int,
+        refresh_explore_lists_every=int,
         s3_endpoint=str,
         s3_public_access_key=str,
         s3_secret_key=str,
@@ -157,6 +160,7 @@ class AppConf(object):
         send_newsletters_every=int,
         show_sandbox_warning=bool,
         socket_timeout=float,
+        sync_rate_limits_every=int,
         smtp_host=str,
         smtp_port=int,
         smtp_username=str,
@@ -168,6 +172,7 @@ class AppConf(object):
         twitter_callback=str,
         twitter_id=str,
         twitter_secret=str,
+        user_info_cache_ttl=int,
     )
 
     def __init__(self, d):
@@ -408,6 +413,7 @@ def accounts_elsewhere(app_conf, asset, canonical_url, db):
             for k, v in app_conf.__dict__.items() if k.startswith(cls.name+'_')
         }
         conf.setdefault('api_timeout', app_conf.socket_timeout)
+        conf.setdefault('user_info_cache_ttl', app_conf.user_info_cache_ttl)
         conf.setdefault('app_name', app_conf.app_name)
         conf.setdefault('app_url', canonical_url)
         if hasattr(cls, 'register_app'):
@@ -574,6 +580,7 @@ def env():
         RUN_CRON_JOBS=is_yesish,
         OVERRIDE_PAYDAY_CHECKS=is_yesish,
         OVERRIDE_QUERY_CACHE=is_yesish,
+        SESSION_SIGNING_KEY=str,
     )
 
     logging.basicConfig(level=getattr(logging, env.logging_level.upper()))
@@ -12,7 +12,8 @@ INSERT INTO app_conf (key, value) VALUES
     ('bountysource_secret', '""'::jsonb),
     ('check_db_every', '600'::jsonb),
     ('clean_up_counters_every', '3600'::jsonb),
-    ('dequeue_emails_every', '60'::jsonb),
+    ('compact_cash_bundles_every', '600'::jsonb),
+    ('dequeue_emails_every', '600'::jsonb),
     ('facebook_callback', '"http://localhost:8339/on/facebook/associate"'::jsonb),
     ('facebook_id', '"1418954898427187"'::jsonb),
     ('facebook_secret', '"3bcb5dc6ce821e5202870c1e6ef5bbc4"'::jsonb),
@@ -37,21 +38,25 @@ INSERT INTO app_conf (key, value) VALUES
     ('openstreetmap_callback', '"http://127.0.0.1:8339/on/openstreetmap/associate"'::jsonb),
     ('openstreetmap_id', '"w4eQbkobmMzpkJFwS4tM16a3lq9AFbcoNCKNcGBE"'::jsonb),
     ('openstreetmap_secret', '"W08UgEhxQnh7nMzB7GfSFcqcwPnZMmKMNyxWdcw4"'::jsonb),
+    ('password_cache_ttl', '300'::jsonb),
     ('password_rounds', '1'::jsonb),
     ('payday_repo', '"liberapay-bot/test"'::jsonb),
     ('payday_label', '"Payday"'::jsonb),
     ('refetch_repos_every', '60'::jsonb),
+    ('refresh_explore_lists_every', '300'::jsonb),
     ('s3_endpoint', '""'::jsonb),
     ('s3_payday_logs_bucket', '""'::jsonb),
     ('s3_public_access_key', '""'::jsonb),
     ('s3_secret_key', '""'::jsonb),
     ('s3_region', '"eu-west-1"'::jsonb),
-    ('send_newsletters_every', '60'::jsonb),
+    ('send_newsletters_every', '600'::jsonb),
     ('show_sandbox_warning', 'true'::jsonb),
     ('socket_timeout', '10.0'::jsonb),
+    ('sync_rate_limits_every', '10'::jsonb),
     ('trusted_proxies', '[]'::jsonb),
     ('twitch_id', '"9ro3g4slh0de5yijy6rqb2p0jgd7hi"'::jsonb),
     ('twitch_secret', '"o090sc7828d7gljtrqc5n4vcpx3bfx"'::jsonb),
     ('twitter_callback', '"http://127.0.0.1:8339/on/twitter/associate"'::jsonb),
     ('twitter_id', '"h8bBZtoPNz63S5RkZdbo9R5zb"'::jsonb),
-    ('twitter_secret', '"Jye64vkWxa2dQu64feTnk0BM3j4JO8ZlTa4EQvMDwrweLkwPaw"'::jsonb);
+    ('twitter_secret', '"Jye64vkWxa2dQu64feTnk0BM3j4JO8ZlTa4EQvMDwrweLkwPaw"'::jsonb),
+    ('user_info_cache_ttl', '600'::jsonb);
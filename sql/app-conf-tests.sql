@@ -6,10 +6,14 @@ DO $$
 BEGIN
     PERFORM update_app_conf('check_db_every', '0'::jsonb);
     PERFORM update_app_conf('clean_up_counters_every', '0'::jsonb);
+    PERFORM update_app_conf('compact_cash_bundles_every', '0'::jsonb);
+    PERFORM update_app_conf('sync_rate_limits_every', '0'::jsonb);
     PERFORM update_app_conf('dequeue_emails_every', '0'::jsonb);
     PERFORM update_app_conf('update_homepage_every', '0'::jsonb);
     PERFORM update_app_conf('send_newsletters_every', '0'::jsonb);
     PERFORM update_app_conf('refetch_repos_every', '0'::jsonb);
+    PERFORM update_app_conf('refresh_explore_lists_every', '0'::jsonb);
+    PERFORM update_app_conf('user_info_cache_ttl', '0'::jsonb);
 END;
 $$;
 
@@ -0,0 +1,348 @@
+CREATE TABLE explore_listings
+( list          text            NOT NULL
+, rank          int             NOT NULL
+, participant   bigint          NOT NULL REFERENCES participants
+, nmembers      int
+, ctime         timestamptz
+, receiving     numeric(35,2)
+, join_time     timestamptz
+, PRIMARY KEY (list, rank)
+);
+INSERT INTO app_conf (key, value) VALUES
+    ('refresh_explore_lists_every', '300'::jsonb);
+CREATE INDEX community_memberships_ctime_idx ON community_memberships (community, ctime, participant) WHERE is_on;
+CREATE INDEX repositories_keyset_idx ON repositories (participant, platform, (is_fork IS NOT TRUE), last_update, id);
+CREATE INDEX notifications_keyset_idx ON notifications (participant, is_new, id) WHERE web;
+CREATE INDEX events_keyset_idx ON events (participant, ts, id);
+CREATE INDEX transfers_tipper_timestamp_idx ON transfers (tipper, timestamp);
+CREATE INDEX transfers_tippee_timestamp_idx ON transfers (tippee, timestamp);
+CREATE INDEX exchanges_participant_timestamp_idx ON exchanges (participant, timestamp);
+DROP INDEX transfers_tipper_idx;
+DROP INDEX transfers_tippee_idx;
+DROP INDEX exchanges_participant_idx;
+-- balances_at now holds monthly snapshots, backfill them so that payday only
+-- has to take the snapshots of the months that end after the deployment
+DELETE FROM balances_at;
+DO $$
+DECLARE
+    _start timestamptz := (SELECT date_trunc('month', min(timestamp)) FROM exchanges);
+    _end timestamptz;
+BEGIN
+    WHILE _start < date_trunc('month', current_timestamp) LOOP
+        _end := _start + interval '1 month';
+        INSERT INTO balances_at
+                    (participant, at, balance)
+             SELECT d.participant, _end, COALESCE((
+                        SELECT b.balance
+                          FROM balances_at b
+                         WHERE b.participant = d.participant
+                           AND b.at <= _start
+                      ORDER BY b.at DESC
+                         LIMIT 1
+                    ), 0) + d.delta
+               FROM ( SELECT participant, sum(delta) AS delta
+                        FROM ( SELECT participant, amount - (CASE WHEN (fee < 0) THEN fee ELSE 0 END) AS delta
+                                 FROM exchanges
+                                WHERE timestamp >= _start AND timestamp < _end
+                                  AND amount > 0
+                                  AND status = 'succeeded'
+                                UNION ALL
+                               SELECT participant, amount - (CASE WHEN (fee > 0) THEN fee ELSE 0 END) AS delta
+                                 FROM exchanges
+                                WHERE timestamp >= _start AND timestamp < _end
+                                  AND amount < 0
+                                  AND status <> 'failed'
+                                UNION ALL
+                               SELECT tipper AS participant, -amount AS delta
+                                 FROM transfers
+                                WHERE timestamp >= _start AND timestamp < _end
+                                  AND status = 'succeeded'
+                                UNION ALL
+                               SELECT tippee AS participant, amount AS delta
+                                 FROM transfers
+                                WHERE timestamp >= _start AND timestamp < _end
+                                  AND status = 'succeeded'
+                             ) x
+                    GROUP BY participant
+                    ) d;
+        _start := _end;
+    END LOOP;
+END;
+$$;
+CREATE TABLE payday_receipts
+( payday        int             NOT NULL REFERENCES paydays
+, participant   bigint          NOT NULL REFERENCES participants
+, npatrons      int             NOT NULL
+, receipts      numeric(35,2)   NOT NULL
+, PRIMARY KEY (participant, payday)
+);
+CREATE INDEX payday_receipts_payday_idx ON payday_receipts (payday);
+CREATE UNLOGGED TABLE platform_ratelimits
+( platform    text          NOT NULL
+, domain      text          NOT NULL
+, ratelimit   int           NOT NULL
+, remaining   int           NOT NULL
+, reset_at    timestamptz   NOT NULL
+, ts          timestamptz   NOT NULL
+, PRIMARY KEY (platform, domain)
+);
+
+INSERT INTO app_conf (key, value) VALUES
+    ('user_info_cache_ttl', '600'::jsonb);
+
+INSERT INTO app_conf (key, value) VALUES
+    ('password_cache_ttl', '300'::jsonb);
+
+ALTER TABLE participants ADD COLUMN session_generation int NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION sync_rate_limit(a_key text, cap int, period float, pending int, hit boolean) RETURNS int AS $$
+    DECLARE
+        c int;
+    BEGIN
+        INSERT INTO rate_limiting AS r
+                    (key, counter, ts)
+             VALUES (a_key, pending, current_timestamp)
+        ON CONFLICT (key) DO UPDATE
+                SET counter = r.counter + pending - least(compute_leak(cap, period, r.ts), r.counter)
+                  , ts = current_timestamp
+          RETURNING counter INTO c;
+        IF NOT hit THEN
+            RETURN cap - c;
+        END IF;
+        IF c >= cap THEN
+            RETURN NULL;
+        END IF;
+        UPDATE rate_limiting SET counter = counter + 1 WHERE key = a_key;
+        RETURN cap - c - 1;
+    END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO app_conf (key, value) VALUES
+    ('sync_rate_limits_every', '10'::jsonb);
+
+CREATE TABLE balance_checkpoints
+( participant        bigint          PRIMARY KEY
+, expected_balance   numeric(35,2)   NOT NULL
+);
+INSERT INTO db_meta (key, value)
+     SELECT 'balance_checkpoints', jsonb_build_object(
+                'exchanges', coalesce(
+                    (SELECT min(id) - 1 FROM exchanges WHERE status IN ('pre', 'created', 'pre-mandate')),
+                    (SELECT max(id) FROM exchanges),
+                    0
+                ),
+                'transfers', coalesce(
+                    (SELECT min(id) - 1 FROM transfers WHERE status = 'pre'),
+                    (SELECT max(id) FROM transfers),
+                    0
+                ),
+                'pending', null
+            );
+INSERT INTO balance_checkpoints (participant, expected_balance)
+     SELECT id, sum(a)
+       FROM ( SELECT participant AS id, amount - (CASE WHEN (fee < 0) THEN fee ELSE 0 END) AS a
+                FROM exchanges
+               WHERE amount > 0
+                 AND status = 'succeeded'
+                 AND id <= (SELECT (value->>'exchanges')::bigint FROM db_meta WHERE key = 'balance_checkpoints')
+               UNION ALL
+              SELECT participant AS id, amount - (CASE WHEN (fee > 0) THEN fee ELSE 0 END) AS a
+                FROM exchanges
+               WHERE amount < 0
+                 AND status <> 'failed'
+                 AND id <= (SELECT (value->>'exchanges')::bigint FROM db_meta WHERE key = 'balance_checkpoints')
+               UNION ALL
+              SELECT tipper AS id, -amount AS a
+                FROM transfers
+               WHERE status = 'succeeded'
+                 AND id <= (SELECT (value->>'transfers')::bigint FROM db_meta WHERE key = 'balance_checkpoints')
+               UNION ALL
+              SELECT tippee AS id, amount AS a
+                FROM transfers
+               WHERE status = 'succeeded'
+                 AND id <= (SELECT (value->>'transfers')::bigint FROM db_meta WHERE key = 'balance_checkpoints')
+            ) x
+   GROUP BY id;
+INSERT INTO db_meta (key, value)
+     SELECT 'checked_tips_until', to_jsonb(coalesce(max(id), 0)) FROM tips;
+CREATE INDEX cash_bundles_origin_idx ON cash_bundles (origin);
+CREATE INDEX cash_bundles_withdrawal_idx ON cash_bundles (withdrawal) WHERE withdrawal IS NOT NULL;
+CREATE INDEX exchanges_refund_ref_idx ON exchanges (refund_ref) WHERE refund_ref IS NOT NULL;
+
+INSERT INTO app_conf (key, value) VALUES
+    ('compact_cash_bundles_every', '600'::jsonb);
+
+CREATE INDEX cash_bundles_withdrawable_idx ON cash_bundles (owner, ts, amount)
+    WHERE disputed IS NOT TRUE AND locked_for IS NULL;
+CREATE TABLE cash_bundle_totals
+( owner       bigint          PRIMARY KEY
+, available   numeric(35,2)   NOT NULL
+, newest_ts   timestamptz     NOT NULL
+);
+INSERT INTO cash_bundle_totals (owner, available, newest_ts)
+     SELECT owner, sum(amount), max(ts)
+       FROM cash_bundles
+      WHERE owner IS NOT NULL
+        AND disputed IS NOT TRUE
+        AND locked_for IS NULL
+   GROUP BY owner;
+CREATE FUNCTION update_cash_bundle_totals() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' AND OLD.owner IS NOT NULL AND
+           OLD.disputed IS NOT TRUE AND OLD.locked_for IS NULL THEN
+            UPDATE cash_bundle_totals
+               SET available = available - OLD.amount
+             WHERE owner = OLD.owner;
+        END IF;
+        IF TG_OP <> 'DELETE' AND NEW.owner IS NOT NULL AND
+           NEW.disputed IS NOT TRUE AND NEW.locked_for IS NULL THEN
+            INSERT INTO cash_bundle_totals AS t
+                        (owner, available, newest_ts)
+                 VALUES (NEW.owner, NEW.amount, NEW.ts)
+            ON CONFLICT (owner) DO UPDATE
+                    SET available = t.available + excluded.available
+                      , newest_ts = greatest(t.newest_ts, excluded.newest_ts);
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER update_cash_bundle_totals
+    AFTER INSERT OR UPDATE OF owner, amount, ts, disputed, locked_for OR DELETE ON cash_bundles
+    FOR EACH ROW EXECUTE PROCEDURE update_cash_bundle_totals();
+-- `newest_ts` is never decreased, so it's an upper bound: when it's older than
+-- the quarantine we know that all the available money is withdrawable
+CREATE FUNCTION get_withdrawable_balance(p_id bigint, quarantine interval) RETURNS numeric AS $$
+    SELECT coalesce((
+        SELECT t.available - (CASE
+                   WHEN t.newest_ts < current_timestamp - quarantine THEN 0
+                   ELSE coalesce((
+                       SELECT sum(b.amount)
+                         FROM cash_bundles b
+                        WHERE b.owner = p_id
+                          AND b.ts >= current_timestamp - quarantine
+                          AND b.disputed IS NOT TRUE
+                          AND b.locked_for IS NULL
+                   ), 0)
+               END)
+          FROM cash_bundle_totals t
+         WHERE t.owner = p_id
+    ), 0);
+$$ LANGUAGE sql STABLE;
+
+DROP VIEW current_takes;
+CREATE TABLE current_takes
+( id                int                  NOT NULL
+, ctime             timestamptz          NOT NULL
+, mtime             timestamptz          NOT NULL
+, member            bigint               NOT NULL REFERENCES participants
+, team              bigint               NOT NULL REFERENCES participants
+, amount            numeric(35,2)        NOT NULL CHECK (amount >= 0)
+, recorder          bigint               NOT NULL REFERENCES participants
+, PRIMARY KEY (team, member)
+);
+CREATE INDEX current_takes_member_idx ON current_takes (member);
+INSERT INTO current_takes
+     SELECT *
+       FROM ( SELECT DISTINCT ON (member, team) t.*
+                FROM takes t
+            ORDER BY member, team, mtime DESC
+            ) x
+      WHERE x.amount IS NOT NULL;
+CREATE FUNCTION update_current_takes() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.amount IS NULL THEN
+            DELETE FROM current_takes
+             WHERE team = NEW.team
+               AND member = NEW.member
+               AND mtime <= NEW.mtime;
+        ELSE
+            INSERT INTO current_takes AS t
+                        (id, ctime, mtime, member, team, amount, recorder)
+                 VALUES (NEW.id, NEW.ctime, NEW.mtime, NEW.member, NEW.team, NEW.amount, NEW.recorder)
+            ON CONFLICT (team, member) DO UPDATE
+                    SET id = excluded.id
+                      , ctime = excluded.ctime
+                      , mtime = excluded.mtime
+                      , amount = excluded.amount
+                      , recorder = excluded.recorder
+                  WHERE t.mtime <= excluded.mtime;
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER update_current_takes AFTER INSERT ON takes
+    FOR EACH ROW EXECUTE PROCEDURE update_current_takes();
+CREATE INDEX takes_team_member_mtime_idx ON takes (team, member, mtime DESC);
+
+DROP VIEW current_tips;
+DROP FUNCTION update_tip();
+CREATE TABLE current_tips
+( id                int                  NOT NULL
+, ctime             timestamptz          NOT NULL
+, mtime             timestamptz          NOT NULL
+, tipper            bigint               NOT NULL REFERENCES participants
+, tippee            bigint               NOT NULL REFERENCES participants
+, amount            numeric(35,2)        NOT NULL CHECK (amount >= 0)
+, is_funded         boolean              NOT NULL
+, period            donation_period      NOT NULL
+, periodic_amount   numeric(35,2)        NOT NULL
+, PRIMARY KEY (tipper, tippee)
+);
+CREATE UNIQUE INDEX current_tips_id_idx ON current_tips (id);
+CREATE INDEX current_tips_tippee_idx ON current_tips (tippee);
+INSERT INTO current_tips
+     SELECT DISTINCT ON (tipper, tippee) *
+       FROM tips
+   ORDER BY tipper, tippee, mtime DESC, id DESC;
+CREATE FUNCTION update_current_tips() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO current_tips AS t
+                        (id, ctime, mtime, tipper, tippee, amount, is_funded, period, periodic_amount)
+                 VALUES (NEW.id, NEW.ctime, NEW.mtime, NEW.tipper, NEW.tippee, NEW.amount,
+                         NEW.is_funded, NEW.period, NEW.periodic_amount)
+            ON CONFLICT (tipper, tippee) DO UPDATE
+                    SET id = excluded.id
+                      , ctime = excluded.ctime
+                      , mtime = excluded.mtime
+                      , amount = excluded.amount
+                      , is_funded = excluded.is_funded
+                      , period = excluded.period
+                      , periodic_amount = excluded.periodic_amount
+                  WHERE t.mtime <= excluded.mtime;
+        ELSE
+            UPDATE current_tips
+               SET is_funded = NEW.is_funded
+             WHERE id = NEW.id;
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER update_current_tips AFTER INSERT OR UPDATE OF is_funded ON tips
+    FOR EACH ROW EXECUTE PROCEDURE update_current_tips();
+
+CREATE TABLE cron_jobs
+( name                text           PRIMARY KEY
+, last_start_time     timestamptz
+, last_success_time   timestamptz
+, last_error_time     timestamptz
+, last_error          text
+, last_duration       interval
+);
+
+CREATE FUNCTION wake_cron_job() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('cron', TG_ARGV[0]);
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER wake_dequeue_emails AFTER INSERT ON notifications
+    FOR EACH ROW WHEN (NEW.email AND NEW.email_sent IS NOT true)
+    EXECUTE PROCEDURE wake_cron_job('dequeue_emails');
+CREATE TRIGGER wake_send_newsletters AFTER INSERT OR UPDATE OF scheduled_for ON newsletter_texts
+    FOR EACH ROW WHEN (NEW.sent_at IS NULL)
+    EXECUTE PROCEDURE wake_cron_job('send_newsletters');
+UPDATE app_conf
+   SET value = '600'::jsonb
+ WHERE key IN ('dequeue_emails_every', 'send_newsletters_every')
+   AND value = '60'::jsonb;
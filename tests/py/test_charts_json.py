@@ -13,6 +13,51 @@ def today():
     return datetime.datetime.utcnow().date().strftime('%Y-%m-%d')
 
 
+def compute_receipts_from_transfers(db, participant):
+    """The algorithm used before the `payday_receipts` table was introduced.
+    """
+    paydays = db.all("""
+          SELECT p.ts_end
+               , p.ts_start::date   AS date
+               , 0                  AS npatrons
+               , 0.00               AS receipts
+            FROM paydays p
+           WHERE stage IS NULL
+        ORDER BY ts_end ASC
+    """, back_as=dict)
+    if not paydays:
+        return []
+    col = 'team' if participant.kind == 'group' else 'tippee'
+    transfers = db.all("""
+       SELECT timestamp, amount, tipper
+         FROM transfers t
+        WHERE t.{0} = %s
+          AND status = 'succeeded'
+          AND t.timestamp < %s
+     ORDER BY id ASC
+    """.format(col), (participant.id, paydays[-1]['ts_end']), back_as=dict)
+    if not transfers:
+        return []
+    paydays_i = iter(paydays)
+    curpayday = next(paydays_i)
+    patrons = set()
+    for transfer in transfers:
+        while transfer['timestamp'] >= curpayday['ts_end']:
+            curpayday = next(paydays_i)
+            patrons.clear()
+        tipper = transfer['tipper']
+        if tipper not in patrons:
+            curpayday['npatrons'] += 1
+            patrons.add(tipper)
+        curpayday['receipts'] += transfer['amount']
+    for payday in paydays:
+        payday['date'] = str(payday['date'])
+        payday['receipts'] = float(payday['receipts'])
+        del payday['ts_end']
+    paydays.reverse()
+    return paydays
+
+
 class TestChartsJson(FakeTransfersHarness):
 
     def setUp(self):
@@ -134,6 +179,29 @@ class TestChartsJson(FakeTransfersHarness):
 
         assert actual == expected
 
+    def test_receipts_match_the_transfers(self):
+        team = self.make_participant('team', kind='group')
+        team.set_take_for(self.carl, 1, team)
+        self.alice.set_tip_to(team, '0.30')
+        self.run_payday()
+        self.make_transfer(self.alice.id, self.carl.id, 4)
+        self.bob.set_tip_to(self.carl, '0.00')
+        self.run_payday()
+        self.run_payday()
+        for p in (self.alice, self.carl, team):
+            actual = json.loads(self.client.GxT('/%s/charts.json' % p.username).text)
+            assert actual == compute_receipts_from_transfers(self.db, p)
+
+    def test_receipts_can_be_backfilled(self):
+        self.run_payday()
+        self.make_transfer(self.alice.id, self.carl.id, 4)
+        self.run_payday()
+        expected = json.loads(self.client.GET('/carl/charts.json').text)
+        self.db.run("DELETE FROM payday_receipts")
+        Payday.recompute_receipts()
+        actual = json.loads(self.client.GET('/carl/charts.json').text)
+        assert actual == expected
+
     def test_transfer_volume(self):
         dana = self.make_participant('dana')
         dana.close(None)
@@ -292,6 +292,7 @@ class TestClosing(FakeTransfersHarness):
         assert alice.receiving == new_alice.receiving == 0
         assert alice.npatrons == new_alice.npatrons == 0
         assert alice.session_token == new_alice.session_token == None
+        assert alice.session_generation == new_alice.session_generation == 1
         assert alice.session_expires.year == new_alice.session_expires.year == date.today().year
         emails = alice.get_emails()
         assert len(emails) == 1
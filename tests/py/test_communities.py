@@ -162,10 +162,18 @@ class TestForCommunityJson(Harness):
         json.loads(response.text)
         # assert len(result['animators']) == 1  # Not implemented yet
 
-    def test_offset(self):
-        response = self.client.GET('/for/test/index.json?offset=1')
-        json.loads(response.text)
-        # assert len(result['animators']) == 1  # Not implemented yet
+    def test_pagination(self):
+        response = self.client.GET('/for/test/index.json?limit=1')
+        result = json.loads(response.text)
+        assert [m['username'] for m in result['members']] == ['alice']
+        assert result['prev_page'] is None
+        response = self.client.GET(result['next_page'])
+        result = json.loads(response.text)
+        assert [m['username'] for m in result['members']] == ['bob']
+        assert result['next_page'] is None
+        response = self.client.GET(result['prev_page'])
+        result = json.loads(response.text)
+        assert [m['username'] for m in result['members']] == ['alice']
 
     def test_max_limit(self):
         for i in range(110):
@@ -178,6 +186,6 @@ class TestForCommunityJson(Harness):
         response = self.client.GxT('/for/test/index.json?limit=abc')
         assert response.code == 400
 
-    def test_invalid_offset(self):
-        response = self.client.GxT('/for/test/index.json?offset=abc')
+    def test_invalid_cursor(self):
+        response = self.client.GxT('/for/test/index.json?after=abc')
         assert response.code == 400
@@ -0,0 +1,110 @@
+from __future__ import print_function, unicode_literals
+
+import json
+import select
+
+from liberapay.cron import Cron, Job
+from liberapay.testing import Harness
+
+
+class TestCron(Harness):
+
+    def setUp(self):
+        super(TestCron, self).setUp()
+        self.cron = Cron(self.client.website)
+        self.calls = 0
+
+    def job(self):
+        self.calls += 1
+
+    def test_run_job_records_the_run(self):
+        job = Job('job', 60, self.job, True)
+        assert self.cron.run_job(job) is True
+        assert self.calls == 1
+        r = self.db.one("SELECT * FROM cron_jobs WHERE name = 'job'")
+        assert r.last_success_time == r.last_start_time
+        assert r.last_error is None
+        assert r.last_duration is not None
+
+    def test_run_job_records_errors(self):
+        def fail():
+            raise ValueError('oops')
+        self.client.website.env.sentry_reraise = False
+        try:
+            self.cron.run_job(Job('fail', 60, fail, True))
+        finally:
+            self.client.website.env.sentry_reraise = True
+        r = self.db.one("SELECT * FROM cron_jobs WHERE name = 'fail'")
+        assert r.last_error == 'ValueError: oops'
+        assert r.last_error_time == r.last_start_time
+        assert r.last_success_time is None
+
+    def test_non_exclusive_job_records_the_run_in_memory(self):
+        job = Job('job', 60, self.job, False)
+        assert self.cron.run_job(job) is True
+        assert self.cron.run_job(job) is True
+        assert self.calls == 2
+        assert job.last_success_time == job.last_start_time
+        assert job.last_duration is not None
+        assert self.db.one("SELECT count(*) FROM cron_jobs") == 0
+
+    def test_exclusive_job_is_not_run_twice_in_a_row(self):
+        job = Job('job', 60, self.job, True)
+        assert self.cron.run_job(job) is True
+        assert self.cron.run_job(job) is False
+        assert self.calls == 1
+        assert self.cron.run_job(job, force=True) is True
+        assert self.calls == 2
+
+    def test_exclusive_job_is_skipped_when_locked_elsewhere(self):
+        job = Job('job', 60, self.job, True)
+        with self.db.get_cursor() as cursor:
+            assert cursor.one("SELECT pg_try_advisory_xact_lock(%s)", (job.lock_id,))
+            assert self.cron.run_job(job) is False
+        assert self.calls == 0
+
+    def test_exclusive_job_is_skipped_while_it_runs_elsewhere(self):
+        job = Job('job', 60, self.job, True)
+        self.db.run("""
+            INSERT INTO cron_jobs (name, last_start_time)
+                 VALUES ('job', current_timestamp - interval '30 minutes')
+        """)
+        assert self.cron.run_job(job, force=True) is False
+        assert self.calls == 0
+        # The run is presumed dead after a while
+        self.db.run("""
+            UPDATE cron_jobs SET last_start_time = current_timestamp - interval '2 hours'
+        """)
+        assert self.cron.run_job(job) is True
+        assert self.calls == 1
+
+    def test_admin_can_see_the_jobs(self):
+        self.cron.run_job(Job('job', 60, self.job, True))
+        admin = self.make_participant('admin', privileges=1)
+        r = self.client.GET('/admin/cron.json', auth_as=admin)
+        assert [j['name'] for j in json.loads(r.text)] == ['job']
+        r = self.client.GET('/admin/cron', auth_as=admin)
+        assert r.code == 200
+        assert 'job' in r.text
+
+    def test_wake_makes_the_job_due_immediately(self):
+        job = Job('job', 3600, self.job, True)
+        job.next_run = float('inf')
+        self.cron.jobs.append(job)
+        assert self.cron.wake('job') is True
+        assert job.woken is True
+        assert job.next_run < float('inf')
+        assert self.cron.wake('unknown') is False
+
+    def test_queued_emails_wake_up_the_dequeue_emails_job(self):
+        alice = self.make_participant('alice')
+        with self.db.get_connection() as conn:
+            conn.autocommit = True
+            try:
+                conn.cursor().run("LISTEN cron")
+                alice.notify('low_balance', force_email=True, web=False)
+                select.select([conn], [], [], 5)
+                conn.poll()
+                assert [n.payload for n in conn.notifies] == ['dequeue_emails']
+            finally:
+                conn.autocommit = False
@@ -1,11 +1,19 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from collections import OrderedDict
+from datetime import timedelta
 from decimal import Decimal as D
 import json
+from time import sleep
 
 import mock
+from pando import Response
+from pando.utils import utcnow
 
-from liberapay.elsewhere._base import UserInfo
+from liberapay.elsewhere._base import Platform, RequestStats, UserInfo
+from liberapay.elsewhere._exceptions import RatelimitReached, UserNotFound
+from liberapay.elsewhere._paginators import PageIterator
+from liberapay.elsewhere._scheduler import scheduler
 from liberapay.models.account_elsewhere import AccountElsewhere
 from liberapay.testing import Harness
 import liberapay.testing.elsewhere as user_info_examples
@@ -40,6 +48,25 @@ class TestElsewhere(Harness):
             assert r.user_id is not None
             assert len(r.user_id) > 0
 
+    def test_extra_info_is_pruned(self):
+        domain, user_info = get_user_info_example('github')
+        r = self.platforms.github.extract_user_info(user_info, domain)
+        assert r.extra_info == {
+            'bio': '', 'blog': 'http://whit537.org/', 'company': 'Gratipay',
+            'created_at': '2009-10-03T02:47:57Z', 'followers': 90,
+            'following': 15, 'location': 'Pittsburgh, PA', 'public_repos': 25,
+        }
+
+    def test_xml_extra_info_is_converted_to_a_dict(self):
+        domain, user_info = get_user_info_example('openstreetmap')
+        r = self.platforms.openstreetmap.extract_user_info(user_info, domain)
+        user = r.extra_info['osm']['user']
+        assert user['@id'] == '12023'
+        assert user['blocks'] == {'received': {'@count': '0', '@active': '0'}}
+        assert user['description'] is None
+        account = AccountElsewhere.upsert(r)
+        assert account.extra_info['osm']['user']['@display_name'] == 'jbpbis'
+
     @mock.patch('requests_oauthlib.OAuth2Session.fetch_token')
     @mock.patch('liberapay.elsewhere._base.Platform.get_user_self_info')
     @mock.patch('liberapay.elsewhere._base.Platform.get_user_info')
@@ -103,6 +130,30 @@ class TestElsewhere(Harness):
             account = AccountElsewhere.upsert(platform.extract_user_info(user_info, domain))
             assert isinstance(account, AccountElsewhere)
 
+    def test_get_many(self):
+        bob = self.make_elsewhere('github', 2, 'bob')
+        infos = [
+            UserInfo(platform='github', user_id='1', user_name='alice', domain=''),
+            UserInfo(platform='github', user_id='2', user_name='bob', domain=''),
+            UserInfo(platform='github', user_id='5', user_name='dana', domain='',
+                     avatar_url='https://example.com/dana.png', extra_info={'x': 1}),
+            UserInfo(platform='github', user_id='1', user_name='alice', domain=''),
+        ]
+        accounts = AccountElsewhere.get_many('github', infos)
+        assert [a.user_name for a in accounts] == ['alice', 'bob', 'dana', 'alice']
+        assert accounts[0].id == accounts[3].id
+        assert accounts[1].id == bob.id
+        assert accounts[2].participant.status == 'stub'
+        assert accounts[2].participant.avatar_url == 'https://example.com/dana.png'
+        assert accounts[2].extra_info == {'x': 1}
+        n = self.db.one("SELECT count(*) FROM elsewhere")
+        assert n == 3
+        orphans = self.db.one("""
+            SELECT count(*) FROM participants p
+             WHERE NOT EXISTS (SELECT 1 FROM elsewhere e WHERE e.participant = p.id)
+        """)
+        assert orphans == 0
+
     @mock.patch('liberapay.elsewhere._base.Platform.get_user_info')
     def test_user_pages(self, get_user_info):
         for platform in self.platforms:
@@ -219,6 +270,193 @@ class TestConfirmTakeOver(Harness):
         assert response.headers[b'Location'] == b'/bob/edit'
 
 
+class TestSessions(Harness):
+
+    def test_app_sessions_are_reused(self):
+        platform = self.platforms.github
+        sess = platform.get_app_session(None)
+        assert platform.get_app_session(None) is sess
+        assert sess.get_adapter('https://api.github.com/') is platform.http_adapter
+
+    def test_user_sessions_share_the_connection_pool(self):
+        platform = self.platforms.twitter
+        sess = platform.get_auth_session('', dict(token='foo', token_secret='bar'))
+        assert sess.get_adapter('https://api.twitter.com/') is platform.http_adapter
+
+    def test_app_sessions_are_bounded(self):
+        platform = self.platforms.github
+        with mock.patch.object(platform, 'app_sessions', OrderedDict()), \
+             mock.patch.object(platform, 'app_sessions_size', 2), \
+             mock.patch.object(platform, 'create_app_session', side_effect=lambda d: object()):
+            a = Platform.get_app_session(platform, 'a')
+            Platform.get_app_session(platform, 'b')
+            assert Platform.get_app_session(platform, 'a') is a
+            Platform.get_app_session(platform, 'c')
+            assert list(platform.app_sessions) == ['a', 'c']
+
+    @mock.patch('requests_oauthlib.OAuth2Session.request')
+    def test_requests_are_counted(self, request):
+        request.return_value.status_code = 404
+        platform = self.platforms.github
+        with mock.patch.object(platform, 'request_stats', RequestStats()):
+            with self.assertRaises(Response) as cm:
+                platform.api_get('', '/users/nobody')
+            assert cm.exception.code == 404
+            stats = platform.request_stats.as_dict()
+        assert stats['count'] == 1
+        assert stats['errors'] == 1
+
+
+class TestUserInfoCache(Harness):
+
+    def setUp(self):
+        super(TestUserInfoCache, self).setUp()
+        self.platform = self.platforms.github
+        self.platform.user_info_cache_ttl = 60
+        self.platform.user_info_cache.clear()
+
+    def tearDown(self):
+        self.platform.user_info_cache_ttl = 0
+        self.platform.user_info_cache.clear()
+        super(TestUserInfoCache, self).tearDown()
+
+    @mock.patch('liberapay.elsewhere._base.Platform.get_user_info')
+    def test_user_info_is_cached(self, get_user_info):
+        get_user_info.return_value = UserInfo(
+            platform='github', user_id='0', user_name='alice', is_team=False,
+            domain='', extra_info={'id': 0},
+        )
+        r = self.client.GET('/on/github/bob/')
+        assert r.code == 200
+        a = self.platform.get_user_info_cached('', 'user_name', 'bob')
+        assert a.user_name == 'alice'
+        assert get_user_info.call_count == 1
+
+    @mock.patch('liberapay.elsewhere._base.Platform.get_user_info')
+    def test_user_info_cache_is_bounded(self, get_user_info):
+        get_user_info.side_effect = UserNotFound('bob')
+        with mock.patch.object(self.platform, 'user_info_cache_size', 3):
+            for name in ('a', 'b', 'c', 'd', 'e'):
+                with self.assertRaises(UserNotFound):
+                    self.platform.get_user_info_cached('', 'user_name', name)
+        keys = [k[2] for k in self.platform.user_info_cache]
+        assert keys == ['c', 'd', 'e']
+
+    @mock.patch('liberapay.elsewhere._base.Platform.get_user_info')
+    def test_user_not_found_is_cached(self, get_user_info):
+        get_user_info.side_effect = UserNotFound('bob')
+        for i in range(2):
+            r = self.client.GxT('/on/github/bob/')
+            assert r.code == 404
+        assert get_user_info.call_count == 1
+
+    @mock.patch('liberapay.elsewhere._base.Platform.get_user_info')
+    def test_unchanged_account_is_not_rewritten(self, get_user_info):
+        self.make_elsewhere('github', 1, 'alice', extra_info={'id': 1})
+        get_user_info.return_value = UserInfo(
+            platform='github', user_id='1', user_name='alice', is_team=False,
+            domain='', extra_info={'id': 1},
+        )
+        with mock.patch.object(AccountElsewhere, 'upsert') as upsert:
+            r = self.client.GET('/on/github/alice_old_name/')
+            assert r.code == 200
+            assert upsert.call_count == 0
+
+
+class TestPageIterator(Harness):
+
+    def get_page(self, url):
+        self.fetched.append(url)
+        n = int(url or 0)
+        links = {'next': str(n + 2)} if n < 8 else {}
+        return [n, n + 1], 10, links
+
+    def setUp(self):
+        super(TestPageIterator, self).setUp()
+        self.fetched = []
+
+    def test_iterates_over_all_the_pages(self):
+        for executor in (None, self.platforms.github.prefetch_executor):
+            self.fetched = []
+            it = PageIterator(self.get_page, executor)
+            assert list(it) == list(range(10))
+            assert self.fetched == [None, '2', '4', '6', '8']
+            assert it.complete
+            assert it.total_count == 10
+
+    def test_stops_at_max_pages(self):
+        it = PageIterator(self.get_page, max_pages=2)
+        assert list(it) == [0, 1, 2, 3]
+        assert self.fetched == [None, '2']
+        assert not it.complete
+        assert it.next_url == '4'
+
+    def test_stops_at_max_items(self):
+        it = PageIterator(self.get_page, max_items=3)
+        assert list(it) == [0, 1, 2]
+        assert self.fetched == [None, '2']
+        assert not it.complete
+
+    def test_stops_when_asked_to(self):
+        it = PageIterator(self.get_page, keep_going=lambda: len(self.fetched) < 3)
+        assert list(it.pages()) == [[0, 1], [2, 3], [4, 5]]
+        assert it.interrupted
+        assert not it.complete
+
+    def test_prefetches_the_next_page(self):
+        it = PageIterator(self.get_page, self.platforms.github.prefetch_executor)
+        pages = it.pages()
+        assert next(pages) == [0, 1]
+        for i in range(100):
+            if len(self.fetched) == 2:
+                break
+            sleep(0.01)
+        assert self.fetched == [None, '2']
+        pages.close()
+
+
+class TestRequestScheduler(Harness):
+
+    def test_background_requests_are_delayed_when_quota_is_low(self):
+        reset = utcnow() + timedelta(hours=1)
+        scheduler.after_response('github', 'api.github.com', 5000, 100, reset)
+        # Interactive requests go through
+        scheduler.before_request('github', 'api.github.com')
+        # Background ones don't
+        with scheduler.background():
+            with self.assertRaises(RatelimitReached):
+                scheduler.before_request('github', 'api.github.com')
+            # Other domains aren't affected
+            scheduler.before_request('github', 'example.com')
+
+    def test_background_requests_go_through_after_reset(self):
+        reset = utcnow() - timedelta(seconds=1)
+        scheduler.after_response('github', 'api.github.com', 5000, 0, reset)
+        with scheduler.background():
+            scheduler.before_request('github', 'api.github.com')
+
+    def test_ratelimits_are_only_stored_when_they_cross_the_reserve(self):
+        reset = utcnow() + timedelta(hours=1)
+        stored = lambda: self.db.one("SELECT remaining FROM platform_ratelimits")
+        scheduler.after_response('github', 'api.github.com', 5000, 4000, reset)
+        assert stored() == 4000
+        scheduler.after_response('github', 'api.github.com', 5000, 3000, reset)
+        assert stored() == 4000
+        scheduler.after_response('github', 'api.github.com', 5000, 900, reset)
+        assert stored() == 900
+
+    def test_background_requests_see_the_ratelimits_of_other_processes(self):
+        reset = utcnow() + timedelta(hours=1)
+        self.db.run("""
+            INSERT INTO platform_ratelimits
+                        (platform, domain, ratelimit, remaining, reset_at, ts)
+                 VALUES ('github', 'api.github.com', 5000, 0, %s, current_timestamp)
+        """, (reset,))
+        with scheduler.background():
+            with self.assertRaises(RatelimitReached):
+                scheduler.before_request('github', 'api.github.com')
+
+
 class TestFriendFinder(Harness):
 
     def test_twitter_get_friends_for(self):
@@ -5,6 +5,7 @@ from liberapay.exceptions import (
     EmailNotVerified, TooManyEmailAddresses, TooManyEmailVerifications,
 )
 from liberapay.models.participant import Participant
+from liberapay.security.rate_limiting import rate_limiter
 from liberapay.testing.emails import EmailHarness
 from liberapay.utils import b64encode_s, emails
 
@@ -201,6 +202,7 @@ class TestEmail(EmailHarness):
         self.alice.add_email('alice@example.co.uk')
         self.alice.add_email('alice@example.io')
         self.db.run("DELETE FROM rate_limiting")
+        rate_limiter.clear()
         self.alice.add_email('alice@example.co')
         self.alice.add_email('alice@example.eu')
         self.alice.add_email('alice@example.asia')
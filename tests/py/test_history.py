@@ -5,10 +5,15 @@ from decimal import Decimal
 import json
 
 from liberapay.billing.payday import Payday
+from liberapay.billing.transactions import _record_transfer_result, prepare_transfer
 from liberapay.models.participant import Participant
 from liberapay.testing import Harness
 from liberapay.testing.mangopay import FakeTransfersHarness
-from liberapay.utils.history import get_end_of_year_balance, iter_payday_events
+from liberapay.main import StreamingBody
+from liberapay.utils.history import (
+    EXPORT_QUERIES, _iter_export_query, get_balance_at, get_end_of_year_balance,
+    iter_payday_events, take_balance_snapshots
+)
 
 
 def make_history(harness):
@@ -133,6 +138,43 @@ class TestHistory(FakeTransfersHarness):
         balance = get_end_of_year_balance(self.db, self.alice, self.past_year, datetime.now().year)
         assert balance == 10
 
+    def test_balance_snapshots(self):
+        make_history(self)
+        take_balance_snapshots(self.db)
+        snapshots = self.db.all("SELECT at, balance FROM balances_at ORDER BY at")
+        assert snapshots
+        assert snapshots[-1].balance == 10
+        # Taking the snapshots again is a no-op
+        take_balance_snapshots(self.db)
+        assert self.db.all("SELECT at, balance FROM balances_at ORDER BY at") == snapshots
+        # The balances computed from the snapshots are the same as without them
+        year_end = datetime(self.past_year + 1, 1, 1)
+        balance = get_balance_at(self.db, self.alice.id, year_end)
+        assert balance == 10
+        self.db.run("DELETE FROM balances_at")
+        assert get_balance_at(self.db, self.alice.id, year_end) == balance
+
+    def test_balance_snapshots_are_corrected_when_a_transfer_succeeds(self):
+        make_history(self)
+        bob = self.make_participant('bob')
+        t_id = prepare_transfer(
+            self.db, self.alice.id, bob.id, Decimal('4.00'), 'tip',
+            self.alice.mangopay_wallet_id, bob.mangopay_wallet_id,
+        )
+        self.db.run("""
+            UPDATE transfers
+               SET timestamp = "timestamp" - interval '1 year'
+             WHERE id = %s
+        """, (t_id,))
+        take_balance_snapshots(self.db)
+        _record_transfer_result(self.db, t_id, 'succeeded')
+        year_end = datetime(self.past_year + 1, 1, 1)
+        assert get_balance_at(self.db, self.alice.id, year_end) == 6
+        assert get_balance_at(self.db, bob.id, year_end) == 4
+        self.db.run("DELETE FROM balances_at")
+        assert get_balance_at(self.db, self.alice.id, year_end) == 6
+        assert get_balance_at(self.db, bob.id, year_end) == 4
+
 
 class TestExport(Harness):
 
@@ -155,3 +197,56 @@ class TestExport(Harness):
     def test_export_csv(self):
         r = self.client.GET('/alice/wallet/export.csv?key=exchanges', auth_as=self.alice)
         assert r.text.count('\n') == 5
+
+    def test_export_csv_range_of_years(self):
+        year_range = '%s-%s' % (self.past_year, self.past_year + 1)
+        r = self.client.GET('/alice/wallet/export.csv?key=exchanges&year=' + year_range,
+                            auth_as=self.alice)
+        assert r.text.count('\n') == 9
+
+    def test_export_json_all_years(self):
+        r = self.client.GET('/alice/wallet/export.json?key=exchanges&year=all',
+                            auth_as=self.alice)
+        assert len(json.loads(r.text)) == 8
+
+    def test_export_csv_empty_year(self):
+        r = self.client.GET('/alice/wallet/export.csv?key=exchanges&year=2001',
+                            auth_as=self.alice)
+        assert r.text == 'timestamp,amount,fee,status,note\r\n'
+
+    def test_export_bad_year(self):
+        r = self.client.GxT('/alice/wallet/export.json?year=2017-2016', auth_as=self.alice)
+        assert r.code == 400
+        r = self.client.GxT('/alice/wallet/export.json?year=0', auth_as=self.alice)
+        assert r.code == 400
+        r = self.client.GxT('/alice/wallet/export.json?year=1-99999', auth_as=self.alice)
+        assert r.code == 400
+
+    def test_export_is_fetched_in_pages(self):
+        params = dict(
+            id=self.alice.id, start=datetime(self.past_year, 1, 1),
+            end=datetime(self.past_year + 2, 1, 1), base_url='',
+        )
+        sql = EXPORT_QUERIES['detailed']['exchanges']
+        pages = list(_iter_export_query(self.db, sql, params, True, page_size=3))
+        assert pages[0] == ['timestamp', 'amount', 'fee', 'status', 'note']
+        assert [len(rows) for rows in pages[1:]] == [3, 3, 2]
+        timestamps = [row[0] for rows in pages[1:] for row in rows]
+        assert timestamps == sorted(timestamps)
+
+    def test_streaming_body_is_closed(self):
+        closed = []
+
+        def chunks():
+            try:
+                yield 'a'
+                yield b'b'
+            finally:
+                closed.append(True)
+
+        body = StreamingBody(chunks())
+        body.charset = 'utf8'
+        it = iter(body)
+        assert next(it) == b'a'
+        body.close()
+        assert closed == [True]
@@ -62,6 +62,7 @@ class BrowseTestHarness(MangopayHarness):
                  VALUES (%s, %s, 'expense', '28.04', 'badges and stickers', null, '{}'::jsonb, 'new')
               RETURNING id
         """, (self.david.id, self.org.id))
+        self.db.refresh_explore_lists()
 
     def browse(self, **kw):
         for url in self.urls:
@@ -125,6 +126,24 @@ class TestPages(BrowseTestHarness):
 
         assert r.headers[b'Content-Type'] == b'text/html; charset=UTF-8'
 
+    def test_explore_individuals_is_paginated(self):
+        for i in range(31):
+            p = self.make_participant('user%i' % i, receiving=D(i + 1))
+            p.upsert_statement('en', "Hello.")
+        self.db.refresh_explore_lists()
+        r = self.client.GET('/explore/individuals')
+        assert 'user30' in r.text
+        assert 'user0' not in r.text
+        next_url = re.search(r'href="(/explore/individuals\?after=[^"]+)"', r.text).group(1)
+        # Refreshing the list doesn't shift the next page
+        self.make_participant('user31', receiving=D(100)).upsert_statement('en', "Hello.")
+        self.db.refresh_explore_lists()
+        r = self.client.GET(next_url)
+        assert 'user0' in r.text
+        assert 'user1' not in r.text
+        assert 'user30' not in r.text
+        assert '?after=' not in r.text
+
     def test_escaping_on_homepage(self):
         alice = self.make_participant('alice')
         expected = "<a href='/alice/edit'>"
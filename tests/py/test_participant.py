@@ -360,6 +360,18 @@ class Tests(Harness):
         assert carl.receiving == Decimal('3.00')
         assert carl.npatrons == 1
 
+    def test_current_tips_table_follows_the_tips_history(self):
+        alice = self.make_participant('alice', balance=100)
+        bob = self.make_participant('bob')
+        alice.set_tip_to(bob, '12.00')
+        alice.set_tip_to(bob, '3.00')
+        tips = self.db.all("SELECT amount, is_funded FROM current_tips WHERE tipper = %s",
+                           (alice.id,))
+        assert tips == [(Decimal('3.00'), True)]
+        self.db.run("UPDATE tips SET is_funded = false WHERE tipper = %s", (alice.id,))
+        assert self.db.one("SELECT is_funded FROM current_tips WHERE tipper = %s",
+                           (alice.id,)) is False
+
     def test_receiving_includes_taking_when_updated_from_set_tip_to(self):
         alice = self.make_participant('alice', balance=100)
         bob = self.make_participant('bob', taking=Decimal('42.00'))
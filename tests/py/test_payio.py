@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from decimal import Decimal as D
+import json
 
 import mock
 import pytest
@@ -12,11 +13,16 @@ from liberapay.billing.fees import (
     upcharge_card,
 )
 from liberapay.billing.transactions import (
+    _record_transfer_result,
     charge,
+    compact_cash_bundles,
     execute_direct_debit,
+    get_bundles_fragmentation,
+    get_total_bundles_fragmentation,
     payin_bank_wire,
     payout,
     prepare_direct_debit,
+    prepare_transfer,
     record_exchange,
     record_exchange_result,
     sync_with_mangopay,
@@ -31,7 +37,9 @@ from liberapay.exceptions import (
 from liberapay.models.exchange_route import ExchangeRoute
 from liberapay.models.participant import Participant
 from liberapay.testing import Foobar
-from liberapay.testing.mangopay import FakeTransfersHarness, MangopayHarness
+from liberapay.testing.mangopay import (
+    FakeTransactions, FakeTransfersHarness, MangopayHarness,
+)
 
 
 def fail_payin(payin):
@@ -411,7 +419,7 @@ class TestRecordExchange(MangopayHarness):
 
 class TestCashBundles(FakeTransfersHarness, MangopayHarness):
 
-    def test_cash_bundles_are_merged_after_transfer(self):
+    def test_cash_bundles_are_merged_by_compaction_after_transfers(self):
         bundles_count = lambda: self.db.one("SELECT count(*) FROM cash_bundles")
         assert bundles_count() == 0
         self.make_exchange('mango-cc', 45, 0, self.janet)
@@ -419,9 +427,59 @@ class TestCashBundles(FakeTransfersHarness, MangopayHarness):
         transfer(self.db, self.janet.id, self.homer.id, D('10.00'), 'tip')
         assert bundles_count() == 2
         transfer(self.db, self.homer.id, self.janet.id, D('5.00'), 'tip')
-        assert bundles_count() == 2
+        assert bundles_count() == 3
         transfer(self.db, self.homer.id, self.janet.id, D('5.00'), 'tip')
+        assert bundles_count() == 3
+        fragmentation = get_bundles_fragmentation(self.db)
+        assert [tuple(r) for r in fragmentation] == [(self.janet.id, 3, 1, 2)]
+        assert compact_cash_bundles(self.db) == 2
         assert bundles_count() == 1
+        assert get_bundles_fragmentation(self.db) == []
+        assert get_total_bundles_fragmentation(self.db) == (1, 0)
+        self.db.self_check()
+
+    def test_admin_can_see_bundles_fragmentation(self):
+        self.make_exchange('mango-cc', 45, 0, self.janet)
+        admin = self.make_participant('admin', privileges=1)
+        r = self.client.GET('/admin/bundles.json', auth_as=admin)
+        assert json.loads(r.text) == {'total': {'nbundles': 1, 'excess': 0}, 'owners': []}
+        r = self.client.GxT('/admin/bundles.json', auth_as=self.janet)
+        assert r.code == 403
+
+    def test_withdrawable_balance_is_computed_from_the_bundle_totals(self):
+        self.make_exchange('mango-cc', 45, 0, self.janet)
+        transfer(self.db, self.janet.id, self.homer.id, D('10.00'), 'tip')
+        totals = dict(self.db.all("SELECT owner, available FROM cash_bundle_totals"))
+        assert totals == {self.janet.id: 35, self.homer.id: 10}
+        assert self.janet.withdrawable_balance == 35
+        with mock.patch.multiple(transactions, QUARANTINE='1 month'):
+            assert self.janet.withdrawable_balance == 0
+        self.db.run("UPDATE cash_bundles SET ts = ts - interval '2 months'")
+        with mock.patch.multiple(transactions, QUARANTINE='1 month'):
+            assert self.janet.withdrawable_balance == 35
+            assert self.homer.withdrawable_balance == 10
+        self.db.self_check()
+
+    def test_lock_bundles_locks_the_covering_prefix(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        self.make_exchange('mango-cc', 20, 0, self.janet)
+        self.make_exchange('mango-cc', 30, 0, self.janet)
+        with self.assertRaises(NegativeBalance):
+            transfer(self.db, self.janet.id, self.homer.id, D('60.01'), 'tip')
+        transfer(self.db, self.janet.id, self.homer.id, D('25.00'), 'tip')
+        bundles = self.db.all("""
+            SELECT b.owner, b.amount, e.amount AS origin_amount
+              FROM cash_bundles b
+              JOIN exchanges e ON e.id = b.origin
+          ORDER BY e.amount, b.owner
+        """)
+        assert [(b.owner, b.amount, b.origin_amount) for b in bundles] == [
+            (self.homer.id, 10, 10),
+            (self.janet.id, 5, 20),
+            (self.homer.id, 15, 20),
+            (self.janet.id, 30, 30),
+        ]
+        assert not self.db.one("SELECT count(*) FROM cash_bundles WHERE locked_for IS NOT NULL")
         self.db.self_check()
 
     def test_cash_bundles_are_merged_after_payout_failure(self):
@@ -433,6 +491,58 @@ class TestCashBundles(FakeTransfersHarness, MangopayHarness):
         self.db.self_check()
 
 
+class TestSelfCheck(FakeTransfersHarness, MangopayHarness):
+
+    def test_incremental_check_catches_inconsistent_balance(self):
+        self.make_exchange('mango-cc', 45, 0, self.janet)
+        transfer(self.db, self.janet.id, self.homer.id, D('10.00'), 'tip')
+        self.db.self_check()
+        self.db.run("UPDATE participants SET balance = balance + 1 WHERE id = %s",
+                    (self.homer.id,))
+        self.make_exchange('mango-cc', 15, 0, self.homer)
+        with self.assertRaises(AssertionError):
+            self.db.self_check()
+        # The watermarks haven't moved, so the next check fails too
+        with self.assertRaises(AssertionError):
+            self.db.self_check()
+
+    def test_incremental_check_only_runs_the_necessary_checks(self):
+        self.make_exchange('mango-cc', 45, 0, self.janet)
+        self.db.self_check()
+        durations = self.db.self_check()
+        assert [name for name, duration in durations] == ['check_tips']
+
+    def test_incremental_check_waits_for_pending_transfers(self):
+        self.make_exchange('mango-cc', 45, 0, self.janet)
+        t_id = prepare_transfer(
+            self.db, self.janet.id, self.homer.id, D('10.00'), 'tip',
+            self.janet.mangopay_wallet_id, self.homer.mangopay_wallet_id,
+        )
+        self.db.self_check()
+        self.db.self_check()
+        watermarks = self.db.one("SELECT value FROM db_meta WHERE key = 'balance_checkpoints'")
+        assert watermarks['transfers'] == t_id - 1
+        _record_transfer_result(self.db, t_id, 'succeeded')
+        self.db.self_check()
+        durations = self.db.self_check()
+        assert [name for name, duration in durations] == ['check_tips']
+        expected = self.db.one("""
+            SELECT expected_balance FROM balance_checkpoints WHERE participant = %s
+        """, (self.homer.id,))
+        assert expected == 10
+
+    def test_full_check_rebuilds_checkpoints(self):
+        self.make_exchange('mango-cc', 45, 0, self.janet)
+        self.db.self_check()
+        self.db.run("DELETE FROM balance_checkpoints")
+        durations = self.db.self_check(full=True)
+        assert len(durations) == 8
+        expected = self.db.one("""
+            SELECT expected_balance FROM balance_checkpoints WHERE participant = %s
+        """, (self.janet.id,))
+        assert expected == 45
+
+
 class TestSync(MangopayHarness):
 
     def throw_transactions_back_in_time(self):
@@ -515,3 +625,46 @@ class TestSync(MangopayHarness):
         assert t.error == 'interrupted'
         assert Participant.from_username('david').balance == 0
         assert Participant.from_username('janet').balance == 10
+
+
+class TestSyncWithFakes(FakeTransfersHarness, MangopayHarness):
+
+    def make_pending_transfer(self, tipper, tippee, amount):
+        with mock.patch('liberapay.billing.transactions.record_transfer_result') as rtr:
+            rtr.side_effect = Foobar()
+            with self.assertRaises(Foobar):
+                transfer(self.db, tipper.id, tippee.id, amount, 'tip')
+        return self.db.one("SELECT id FROM transfers ORDER BY id DESC LIMIT 1")
+
+    def sync(self, fake):
+        with mock.patch.object(transactions, 'list_user_transactions', fake):
+            sync_with_mangopay(self.db)
+
+    def test_sync_fetches_the_transactions_of_each_user_once(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        t1 = self.make_pending_transfer(self.janet, self.david, D('3.00'))
+        t2 = self.make_pending_transfer(self.janet, self.homer, D('2.00'))
+        t3 = self.make_pending_transfer(self.janet, self.homer, D('1.00'))
+        fake = FakeTransactions()
+        fake.add(self.janet_id, 'TRANSFER', t1)
+        fake.add(self.janet_id, 'TRANSFER', t2)
+        self.sync(fake)
+        assert fake.calls == [(self.janet_id, 'TRANSFER', 1)]
+        statuses = dict(self.db.all("SELECT id, status FROM transfers"))
+        assert statuses == {t1: 'succeeded', t2: 'succeeded', t3: 'pre'}
+        assert Participant.from_username('david').balance == 3
+        assert Participant.from_username('homer').balance == 2
+
+    def test_sync_pages_back_to_the_oldest_pending_row(self):
+        self.make_exchange('mango-cc', 10, 0, self.janet)
+        t1 = self.make_pending_transfer(self.janet, self.david, D('3.00'))
+        fake = FakeTransactions(page_size=2)
+        for i in range(3):
+            fake.add(self.janet_id, 'TRANSFER', -i).CreationDate -= 86400 * 2
+        for i in range(2):
+            fake.add(self.janet_id, 'TRANSFER', -i)
+        fake.add(self.janet_id, 'TRANSFER', t1)
+        with mock.patch.object(transactions, 'MANGOPAY_PAGE_SIZE', 2):
+            self.sync(fake)
+        assert fake.calls == [(self.janet_id, 'TRANSFER', 1), (self.janet_id, 'TRANSFER', 2)]
+        assert self.db.one("SELECT status FROM transfers WHERE id = %s", (t1,)) == 'succeeded'
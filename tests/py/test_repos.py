@@ -0,0 +1,48 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from liberapay.elsewhere._base import RepoInfo
+from liberapay.models.repository import upsert_repos
+from liberapay.testing import Harness
+from liberapay.utils import utcnow
+
+
+def make_repo_info(remote_id, slug, **kw):
+    r = RepoInfo()
+    r.platform = 'github'
+    r.remote_id = remote_id
+    r.owner_id = '1'
+    r.name = slug.split('/')[-1]
+    r.slug = slug
+    r.description = kw.get('description')
+    r.last_update = utcnow()
+    r.is_fork = kw.get('is_fork', False)
+    r.stars_count = 0
+    r.extra_info = {}
+    return r
+
+
+class TestUpsertRepos(Harness):
+
+    def test_upsert_repos_inserts_and_updates(self):
+        alice = self.make_participant('alice')
+        repos = [make_repo_info('1', 'alice/foo'), make_repo_info('2', 'alice/{bar}')]
+        with self.db.get_cursor() as cursor:
+            r = upsert_repos(cursor, repos, alice, utcnow())
+        assert len(r) == 2
+        repos = [make_repo_info('2', 'alice/bar', description='100% {awesome}')]
+        with self.db.get_cursor() as cursor:
+            r = upsert_repos(cursor, repos, alice, utcnow())
+        assert len(r) == 1
+        assert r[0].slug == 'alice/bar'
+        assert r[0].description == '100% {awesome}'
+        assert self.db.one("SELECT count(*) FROM repositories") == 2
+
+    def test_upsert_repos_replaces_renamed_repos(self):
+        alice = self.make_participant('alice')
+        with self.db.get_cursor() as cursor:
+            upsert_repos(cursor, [make_repo_info('1', 'alice/foo')], alice, utcnow())
+        repos = [make_repo_info('2', 'alice/foo'), make_repo_info('2', 'alice/foo')]
+        with self.db.get_cursor() as cursor:
+            r = upsert_repos(cursor, repos, alice, utcnow())
+        assert len(r) == 1
+        assert self.db.all("SELECT remote_id FROM repositories") == ['2']
@@ -45,11 +45,13 @@ class TestPrivacy(Harness):
     def test_team_participant_does_show_up_on_explore_teams(self):
         alice = Participant.from_username('alice')
         self.make_participant('A-Team', kind='group').add_member(alice)
+        self.db.refresh_explore_lists()
         assert 'A-Team' in self.client.GET("/explore/teams/").text
 
     def test_team_participant_doesnt_show_up_on_explore_teams(self):
         alice = Participant.from_username('alice')
         self.make_participant('A-Team', kind='group', hide_from_lists=1).add_member(alice)
+        self.db.refresh_explore_lists()
         assert 'A-Team' not in self.client.GET("/explore/teams/").text
 
 
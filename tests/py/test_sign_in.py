@@ -9,6 +9,7 @@ from time import gmtime
 from six.moves.http_cookies import SimpleCookie
 
 from babel.messages.catalog import Message
+import mock
 from pando.utils import utcnow
 
 from liberapay.constants import SESSION
@@ -126,6 +127,38 @@ class TestLogIn(EmailHarness):
         alice.update_password(password)
         self.log_in_and_check(alice, password.encode('utf8'))
 
+    def test_password_verifications_are_cached(self):
+        alice = self.make_participant('alice')
+        alice.update_password(password)
+        with mock.patch.object(Participant, '_hash_password', wraps=Participant._hash_password) as h:
+            for i in range(3):
+                assert Participant.authenticate('id', 'password', alice.id, password)
+            assert h.call_count == 1
+            assert not Participant.authenticate('id', 'password', alice.id, 'incorrect')
+            assert h.call_count == 2
+
+    def test_password_cache_is_cleared_by_update_password(self):
+        alice = self.make_participant('alice')
+        alice.update_password(password)
+        assert Participant.authenticate('id', 'password', alice.id, password)
+        alice.update_password('new-password')
+        assert alice.id not in Participant._password_cache
+        assert not Participant.authenticate('id', 'password', alice.id, password)
+        assert Participant.authenticate('id', 'password', alice.id, 'new-password')
+
+    def test_password_is_rehashed_to_the_configured_cost(self):
+        alice = self.make_participant('alice')
+        alice.update_password(password)
+        alice = alice.refetch()
+        assert alice.password.split('$')[1] == '1'
+        old_mtime = alice.password_mtime
+        with mock.patch.object(self.website.app_conf, 'password_rounds', 2):
+            assert Participant.authenticate('id', 'password', alice.id, password)
+        alice = alice.refetch()
+        assert alice.password.split('$')[1] == '2'
+        assert alice.password_mtime == old_mtime
+        assert Participant.authenticate('id', 'password', alice.id, password)
+
     def test_email_login(self):
         email = 'alice@example.net'
         alice = self.make_participant('alice')
@@ -191,6 +224,85 @@ class TestLogIn(EmailHarness):
         assert not self.get_emails()
 
 
+class TestSignedSessions(EmailHarness):
+
+    def setUp(self):
+        super(TestSignedSessions, self).setUp()
+        patcher = mock.patch.object(self.website.env, 'session_signing_key', 'x' * 32)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def log_in(self, p):
+        p.update_password(password)
+        data = {'log-in.id': p.username, 'log-in.password': password}
+        r = self.client.POST('/sign-in', data, raise_immediately=False)
+        assert r.code == 302
+        return r.headers.cookie
+
+    def test_signed_session(self):
+        alice = self.make_participant('alice')
+        cookies = self.log_in(alice)
+        assert cookies[SESSION].value.count(':') == 4
+        assert alice.refetch().session_token is None
+        r = self.client.GET('/about/me/', cookies=cookies, raise_immediately=False)
+        assert r.code == 302
+        assert r.headers[b'Location'] == b'/alice/'
+        # A fresh cookie isn't refreshed
+        assert SESSION not in r.headers.cookie
+
+    def test_signed_session_is_refreshed(self):
+        alice = self.make_participant('alice')
+        alice.authenticated = True
+        cookies = SimpleCookie()
+        with mock.patch('liberapay.models.participant.utcnow') as now:
+            now.return_value = utcnow() - timedelta(hours=2)
+            alice.sign_in(cookies)
+        r = self.client.GET('/about/me/', cookies=cookies, raise_immediately=False)
+        assert r.code == 302
+        assert r.headers.cookie[SESSION].value != cookies[SESSION].value
+
+    def test_tampered_signed_session_is_rejected(self):
+        alice = self.make_participant('alice')
+        bob = self.make_participant('bob')
+        cookies = self.log_in(alice)
+        creds = cookies[SESSION].value.split(':')
+        creds[0] = str(bob.id)
+        cookies[SESSION] = ':'.join(creds)
+        r = self.client.GET('/about/me/', cookies=cookies, raise_immediately=False)
+        assert r.code == 403
+
+    def test_expired_signed_session_is_rejected(self):
+        alice = self.make_participant('alice')
+        alice.authenticated = True
+        cookies = SimpleCookie()
+        with mock.patch('liberapay.models.participant.utcnow') as now:
+            now.return_value = utcnow() - timedelta(days=1)
+            alice.sign_in(cookies)
+        r = self.client.GET('/about/me/', cookies=cookies, raise_immediately=False)
+        assert r.code == 403
+
+    def test_sign_out_revokes_signed_sessions(self):
+        alice = self.make_participant('alice')
+        cookies = self.log_in(alice)
+        cookies2 = self.log_in(alice)
+        r = self.client.POST('/sign-out', {}, cookies=cookies, raise_immediately=False)
+        assert r.code == 302
+        assert alice.refetch().session_generation == 1
+        r = self.client.GET('/about/me/', cookies=cookies2, raise_immediately=False)
+        assert r.code == 403
+
+    def test_logging_in_again_gives_a_valid_session(self):
+        alice = self.make_participant('alice')
+        cookies = self.log_in(alice)
+        data = {'log-in.id': alice.username, 'log-in.password': password}
+        r = self.client.POST('/sign-in', data, cookies=cookies, raise_immediately=False)
+        assert r.code == 302
+        cookies = r.headers.cookie
+        r = self.client.GET('/about/me/', cookies=cookies, raise_immediately=False)
+        assert r.code == 302
+        assert r.headers[b'Location'] == b'/alice/'
+
+
 class TestSignIn(EmailHarness):
 
     def sign_in(self, custom={}, extra={}, url='/sign-in', **kw):
@@ -189,6 +189,25 @@ class Tests(Harness):
         alice = Participant.from_username('alice')
         assert alice.receiving == alice.taking == 25
 
+    def test_current_takes_table_is_kept_up_to_date(self):
+        team, alice, bob = self.make_team_of_two()
+        team.set_take_for(alice, D('12.00'), alice)
+        takes = dict(self.db.all("SELECT member, amount FROM current_takes WHERE team = %s",
+                                 (team.id,)))
+        assert takes == {alice.id: D('12.00'), bob.id: D('0.00')}
+        team.set_take_for(bob, None, bob)
+        takes = self.db.all("SELECT member FROM current_takes WHERE team = %s", (team.id,))
+        assert takes == [alice.id]
+
+    def test_compute_actual_takes_is_cached_until_the_takes_change(self):
+        team, alice = self.make_team_of_one()
+        takes = team.compute_actual_takes()
+        assert team.compute_actual_takes() is takes
+        team.set_take_for(alice, D('5.00'), alice)
+        takes2 = team.compute_actual_takes()
+        assert takes2 is not takes
+        assert takes2[alice.id]['nominal_take'] == 5
+
     # get_takes_last_week - gtlw
 
     def test_gtlwf_works_during_payday(self):
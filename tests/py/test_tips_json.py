@@ -2,6 +2,7 @@ from __future__ import print_function, unicode_literals
 
 import json
 
+from liberapay.models.participant import Participant
 from liberapay.testing import Harness
 
 
@@ -79,3 +80,64 @@ class TestTipsJson(Harness):
 
     def test_also_prune_as_0(self):
         self.also_prune_variant('0', 2)
+
+    def test_post_reports_errors_per_tip(self):
+        self.make_participant("test_tippee1")
+        test_tipper = self.make_participant("test_tipper", balance=100)
+
+        data = [
+            {'username': 'test_tippee1', 'amount': '1.00', 'period': 'weekly'},
+            {'username': 'test_tipper', 'amount': '1.00', 'period': 'weekly'},
+            {'username': 'nobody', 'amount': '1.00', 'period': 'weekly'},
+            {'username': 'test_tippee1', 'amount': '1000.00', 'period': 'weekly'},
+        ]
+        response = self.client.POST('/test_tipper/tips.json',
+                                    body=json.dumps(data).encode('ascii'),
+                                    content_type='application/json',
+                                    auth_as=test_tipper,
+                                    )
+
+        assert response.code == 200
+        r = json.loads(response.text)
+        assert r[0] == {'username': 'test_tippee1', 'amount': '1.00'}
+        assert [t['error'] for t in r[1:]] == ['NoSelfTipping', 'NoTippee', 'BadAmount']
+        assert test_tipper.refetch().giving == 1
+        assert Participant.from_username('test_tippee1').receiving == 1
+
+    def test_post_with_duplicate_tippees_inserts_one_tip(self):
+        tippee = self.make_participant("test_tippee1")
+        test_tipper = self.make_participant("test_tipper", balance=100)
+
+        data = [
+            {'username': 'test_tippee1', 'amount': '1.00', 'period': 'weekly'},
+            {'username': 'test_tippee1', 'amount': '2.00', 'period': 'weekly'},
+        ]
+        response = self.client.POST('/test_tipper/tips.json',
+                                    body=json.dumps(data).encode('ascii'),
+                                    content_type='application/json',
+                                    auth_as=test_tipper,
+                                    )
+
+        assert response.code == 200
+        assert [t['amount'] for t in json.loads(response.text)] == ['2.00', '2.00']
+        tips = self.db.all("SELECT amount FROM tips WHERE tippee = %s", (tippee.id,))
+        assert tips == [2]
+
+    def test_post_reports_bad_usernames_per_tip(self):
+        self.make_participant("test_tippee1")
+        test_tipper = self.make_participant("test_tipper", balance=100)
+
+        data = [
+            {'username': 42, 'amount': '1.00', 'period': 'weekly'},
+            {'username': 'test_tippee1', 'amount': '1.00', 'period': 'weekly'},
+        ]
+        response = self.client.POST('/test_tipper/tips.json',
+                                    body=json.dumps(data).encode('ascii'),
+                                    content_type='application/json',
+                                    auth_as=test_tipper,
+                                    )
+
+        assert response.code == 200
+        r = json.loads(response.text)
+        assert r[0]['error'] == 'TypeError'
+        assert r[1] == {'username': 'test_tippee1', 'amount': '1.00'}
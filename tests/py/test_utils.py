@@ -5,10 +5,14 @@ from datetime import timedelta
 
 from pando.http.response import Response
 from markupsafe import escape
+import mock
 
 from liberapay import utils
+from liberapay.exceptions import InvalidPageCursor
+from liberapay.security.rate_limiting import RateLimiter
 from liberapay.testing import Harness
 from liberapay.utils import i18n, markdown, b64encode_s, b64decode_s
+from liberapay.utils.pagination import Keyset
 
 
 class Tests(Harness):
@@ -197,3 +201,56 @@ class Tests(Harness):
 
     def test_b64decode_s_returns_default_if_passed_on_error(self):
         assert b64decode_s('abcd', default='error') == 'error'
+
+    # Keyset pagination
+    # =================
+
+    def test_keyset_sql(self):
+        keyset = Keyset([('ts', 'timestamptz'), ('id', 'bigint')], descending=True)
+        condition, order_by, params = keyset.sql()
+        assert condition == 'true'
+        assert order_by == 'ts DESC, id DESC'
+        condition, order_by, params = keyset.sql(['2017-01-01', 5], backward=True)
+        assert condition == '(ts, id) > (%(keyset_0)s::timestamptz, %(keyset_1)s::bigint)'
+        assert order_by == 'ts ASC, id ASC'
+        assert params == {'keyset_0': '2017-01-01', 'keyset_1': 5}
+
+    def test_keyset_cursor_roundtrip(self):
+        keyset = Keyset([('id', 'bigint')])
+        assert keyset.decode_cursor(keyset.encode_cursor((42,))) == [42]
+
+    def test_keyset_rejects_invalid_cursors(self):
+        keyset = Keyset([('id', 'bigint')])
+        for cursor in ('abc', b64encode_s('{}'), keyset.encode_cursor((1, 2))):
+            with self.assertRaises(InvalidPageCursor):
+                keyset.decode_cursor(cursor)
+
+    # Rate limiting
+
+    def test_rate_limiter_rejects_attempts_over_the_cap(self):
+        limiter = RateLimiter({'test': (3, 60*60)})
+        assert limiter.hit(self.db, 'test', 'alice') == 2
+        assert limiter.hit(self.db, 'test', 'alice') == 1
+        assert limiter.hit(self.db, 'test', 'alice') == 0
+        assert limiter.hit(self.db, 'test', 'alice') is None
+        assert limiter.hit(self.db, 'test', 'bob') == 2
+
+    def test_rate_limiter_accepts_attempts_locally_and_flushes_them(self):
+        limiter = RateLimiter({'test': (10, 60*60)})
+        assert limiter.hit(self.db, 'test', 'alice') == 9
+        db = mock.Mock(wraps=self.db)
+        assert limiter.hit(db, 'test', 'alice') == 8
+        assert limiter.hit(db, 'test', 'alice') == 7
+        assert db.one.call_count == 0
+        assert limiter.flush(self.db) == 1
+        counter = self.db.one("SELECT counter FROM rate_limiting WHERE key = 'test:alice'")
+        assert counter == 3
+        assert limiter.flush(self.db) == 0
+
+    def test_rate_limiter_flushes_keys_containing_colons(self):
+        limiter = RateLimiter({'test': (10, 60*60)})
+        assert limiter.hit(self.db, 'test', '2001:db8::1') == 9
+        assert limiter.hit(self.db, 'test', '2001:db8::1') == 8
+        assert limiter.flush(self.db) == 1
+        counter = self.db.one("SELECT counter FROM rate_limiting WHERE key = 'test:2001:db8::1'")
+        assert counter == 2